@@ -2,9 +2,16 @@ import streamlit as st
 import sqlite3
 import pandas as pd
 import os
+import time
+from contextlib import closing
+
+from db import delete_user
 
 # ================= 配置 =================
 DB_FILE = "users.db"
+PAGE_SIZE = 50      # 每页显示的用户数
+CACHE_TTL = 60      # 查询结果最多缓存多少秒（库里有变化时立即失效）
+ACTIVE_TOP = 20     # “最近活跃”列表的长度
 st.set_page_config(page_title="Newton Admin Panel", page_icon="🛡️", layout="wide")
 
 # ================= CSS 美化 =================
@@ -17,32 +24,90 @@ st.markdown("""
 
 
 # ================= 数据库函数 =================
-def load_data():
-    """读取所有用户数据"""
-    if not os.path.exists(DB_FILE):
-        return pd.DataFrame()
+# 所有查询都走索引：用户名前缀搜索是主键上的范围查询，分页用 keyset（上一页最后一个用户名），
+# 每用户的消息数 / 字数 / 最后活跃时间读 user_stats（chat_history 上的触发器维护），不扫对话表。
+# 查询结果用 st.cache_data 缓存，缓存键带上 data_version()，库里有变化就自动失效。
+def connect():
+    return sqlite3.connect(DB_FILE, timeout=5)
 
-    conn = sqlite3.connect(DB_FILE)
-    try:
-        # 读取数据到 Pandas DataFrame，方便展示
-        df = pd.read_sql_query("SELECT * FROM users", conn)
-    except Exception as e:
-        st.error(f"数据库读取错误: {e}")
-        df = pd.DataFrame()
-    finally:
-        conn.close()
-    return df
+
+def prefix_range(prefix):
+    """前缀搜索改写成主键范围 [prefix, prefix + U+FFFF)，LIKE 'x%' 用不上索引"""
+    return prefix, prefix + "\uffff"
+
+
+def schema_ready():
+    """user_stats 由服务端启动时的迁移创建；旧库需要先启动一次服务端"""
+    if not os.path.exists(DB_FILE):
+        return False
+    with closing(connect()) as conn:
+        row = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='user_stats'").fetchone()
+    return row is not None
+
+
+def data_version():
+    """用户表版本 + 对话删除次数 + 最新对话 id：任何一项变了，缓存的查询结果就作废"""
+    with closing(connect()) as conn:
+        return conn.execute(
+            "SELECT (SELECT value FROM meta WHERE key='users_version'), "
+            "(SELECT value FROM meta WHERE key='history_version'), "
+            "(SELECT MAX(id) FROM chat_history)").fetchone()
+
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
+def load_totals(version):
+    with closing(connect()) as conn:
+        return conn.execute(
+            "SELECT (SELECT COUNT(*) FROM users), COALESCE(SUM(messages), 0), COALESCE(SUM(chars), 0) "
+            "FROM user_stats").fetchone()
+
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
+def count_users(prefix, version):
+    with closing(connect()) as conn:
+        return conn.execute("SELECT COUNT(*) FROM users WHERE username >= ? AND username < ?",
+                            prefix_range(prefix)).fetchone()[0]
+
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
+def load_page(prefix, after, version, limit=PAGE_SIZE):
+    """按用户名升序取一页（after 之后的 limit 条），多取一条用来判断有没有下一页"""
+    lo, hi = prefix_range(prefix)
+    with closing(connect()) as conn:
+        df = pd.read_sql_query(
+            "SELECT u.username, u.password_hash, u.memos_user_id, u.current_conv_id, "
+            "COALESCE(s.messages, 0) AS messages, COALESCE(s.chars, 0) AS chars, s.last_active "
+            "FROM users u LEFT JOIN user_stats s ON s.username = u.username "
+            "WHERE u.username >= ? AND u.username < ? AND u.username > ? "
+            "ORDER BY u.username LIMIT ?",
+            conn, params=(lo, hi, after or "", limit + 1))
+    return df.head(limit), len(df) > limit
+
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
+def load_recent_active(version, limit=ACTIVE_TOP):
+    with closing(connect()) as conn:
+        return pd.read_sql_query(
+            "SELECT username, messages, chars, last_active FROM user_stats "
+            "ORDER BY last_active DESC LIMIT ?", conn, params=(limit,))
 
 
 def delete_user_by_name(username):
-    """根据用户名删除记录"""
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
+    """在一个事务里删除用户及其全部数据（db.delete_user），提交后删掉该用户的归档文件"""
+    conn = sqlite3.connect(DB_FILE, timeout=5, isolation_level=None)
     try:
-        c.execute("DELETE FROM users WHERE username=?", (username,))
-        conn.commit()
+        conn.execute("BEGIN IMMEDIATE")
+        paths = delete_user(conn, username)
+        conn.execute("COMMIT")
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
         return True
     except Exception as e:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
         st.error(f"删除失败: {e}")
         return False
     finally:
@@ -55,59 +120,86 @@ st.caption("仅限管理员在服务器本地操作 • `users.db`")
 
 st.divider()
 
+if not schema_ready():
+    st.info("数据库为空、文件不存在 (users.db) 或尚未迁移：请先启动一次服务端。")
+    st.stop()
+
 # 1. 刷新数据
 if st.button("🔄 刷新列表"):
+    st.cache_data.clear()
+    st.rerun()
+
+version = data_version()
+total_users, total_messages, total_chars = load_totals(version)
+
+col1, col2, col3 = st.columns(3)
+col1.metric("用户总数", total_users)
+col2.metric("对话消息数", total_messages)
+col3.metric("对话总字数", total_chars)
+
+# 2. 按用户名前缀搜索 + 分页
+prefix = st.text_input("按用户名前缀搜索:", placeholder="留空显示全部").strip()
+if st.session_state.get("prefix") != prefix:
+    # 换了搜索条件就回到第一页；pages 里存的是每一页之前那一页的最后一个用户名
+    st.session_state.prefix = prefix
+    st.session_state.pages = [None]
+
+after = st.session_state.pages[-1]
+df, has_next = load_page(prefix, after, version)
+page_no = len(st.session_state.pages)
+matched = count_users(prefix, version)
+st.subheader(f"匹配用户: {matched} • 第 {page_no} / {max(1, -(-matched // PAGE_SIZE))} 页")
+
+st.dataframe(
+    df,
+    use_container_width=True,
+    hide_index=True,
+    column_config={
+        "username": "用户名 (User ID)",
+        "password_hash": "密码哈希 (SHA256)",
+        "memos_user_id": "Memos 内部 ID",
+        "current_conv_id": "当前会话 ID",
+        "messages": "消息数",
+        "chars": "对话字数",
+        "last_active": "最后活跃",
+    }
+)
+
+prev_col, next_col, _ = st.columns([1, 1, 6])
+if prev_col.button("⬅️ 上一页", disabled=page_no == 1, use_container_width=True):
+    st.session_state.pages.pop()
+    st.rerun()
+if next_col.button("下一页 ➡️", disabled=not has_next, use_container_width=True):
+    st.session_state.pages.append(df["username"].iloc[-1])
     st.rerun()
 
-df = load_data()
-
-# 2. 展示数据表格
-if not df.empty:
-    st.subheader(f"当前用户总数: {len(df)}")
-
-    # 隐藏过长的哈希显示，或者直接展示
-    # 这里我们完整展示，并在 Streamlit 原生表格里支持搜索/排序
-    st.dataframe(
-        df,
-        use_container_width=True,
-        hide_index=True,
-        column_config={
-            "username": "用户名 (User ID)",
-            "password_hash": "密码哈希 (SHA256)",
-            "memos_user_id": "Memos 内部 ID",
-            "current_conv_id": "当前会话 ID"
-        }
+with st.expander("🕒 最近活跃的用户"):
+    st.dataframe(load_recent_active(version), use_container_width=True, hide_index=True)
+
+st.divider()
+
+# 3. 删除用户区域 (危险操作)
+st.subheader("🧨 危险操作区")
+
+col1, col2 = st.columns([3, 1])
+
+with col1:
+    # 下拉选择要删除的用户（当前页），其他用户先用上面的搜索找到
+    user_to_delete = st.selectbox(
+        "选择要删除的用户（连同其全部对话记录）:",
+        options=df["username"].tolist(),
+        index=None,
+        placeholder="请选择..."
     )
 
-    st.divider()
-
-    # 3. 删除用户区域 (危险操作)
-    st.subheader("🧨 危险操作区")
-
-    col1, col2 = st.columns([3, 1])
-
-    with col1:
-        # 下拉选择要删除的用户
-        user_to_delete = st.selectbox(
-            "选择要删除的用户:",
-            options=df["username"].tolist(),
-            index=None,
-            placeholder="请选择..."
-        )
-
-    with col2:
-        st.write("")  # 占位对齐
-        st.write("")
-        if st.button("🗑️ 确认删除用户", type="primary", use_container_width=True):
-            if user_to_delete:
-                if delete_user_by_name(user_to_delete):
-                    st.success(f"用户 [{user_to_delete}] 已从数据库移除！")
-                    import time
-
-                    time.sleep(1)
-                    st.rerun()
-            else:
-                st.warning("请先选择一个用户。")
-
-else:
-    st.info("数据库为空或文件不存在 (users.db)。")
\ No newline at end of file
+with col2:
+    st.write("")  # 占位对齐
+    st.write("")
+    if st.button("🗑️ 确认删除用户", type="primary", use_container_width=True):
+        if user_to_delete:
+            if delete_user_by_name(user_to_delete):
+                st.success(f"用户 [{user_to_delete}] 及其对话记录已从数据库移除！")
+                time.sleep(1)
+                st.rerun()
+        else:
+            st.warning("请先选择一个用户。")
@@ -0,0 +1,256 @@
+import math
+import time
+import asyncio
+import itertools
+from collections import OrderedDict, deque
+
+from db import run_db, try_lease, release_lease, WORKER_ID
+
+# ================= 配置区 =================
+ADMISSION_MAX_ACTIVE = 8     # 同时进行的上游 LLM 流式调用上限（按服务商配额调整）
+ADMISSION_PER_USER = 1       # 每个用户同时只能有几路生成
+ADMISSION_MAX_QUEUE = 32     # 全局排队上限，超出直接返回 429
+ADMISSION_USER_QUEUE = 2     # 单个用户最多排几条，避免一个人占满队列
+ADMISSION_MAX_WAIT = 15.0    # 排队超过多少秒放弃，返回 429
+WAIT_SAMPLES = 1000          # 保留最近多少次排队耗时用于统计
+USER_LEASE_TTL = 120.0       # 多 worker 时每用户生成租约的有效期（进程崩溃后最多锁住这么久）
+USER_LEASE_RENEW = 30.0      # 生成进行中每隔多少秒续租一次（必须明显小于 USER_LEASE_TTL）
+USER_LEASE_POLL = 0.25       # 租约被别的进程占着时的重试间隔（秒）
+
+
+class AdmissionRejected(Exception):
+    """队列已满或排队超时；retry_after 为建议的重试间隔（秒）"""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """一次已放行的上游调用；release 可重复调用，只生效一次"""
+
+    def __init__(self, controller, username, waited, lease=None):
+        self.controller = controller
+        self.username = username
+        self.waited = waited
+        self.lease = lease  # 多 worker 时的跨进程租约 (name, holder)
+        self.renewer = None  # 租约的续期任务，放行期间一直运行
+        self.granted_at = time.monotonic()
+        self._released = False
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        self.controller._release(self.username, time.monotonic() - self.granted_at)
+        if self.renewer is not None:
+            self.renewer.cancel()
+        if self.lease is not None:
+            self.controller._drop_lease(self.lease)
+
+    async def aclose(self):
+        # 给 starlette 的 BackgroundTask 用（异步函数才会在事件循环线程里执行）
+        self.release()
+
+
+class AdmissionController:
+    """上游 LLM 调用的准入控制：全局并发上限 + 每用户并发上限 + 有界等待队列
+
+    有空位时按用户轮转放行（每次放行后该用户排到队尾），一个用户连发多条也不会饿死别人。
+    所有状态只在事件循环线程里读写，不需要加锁。
+    """
+
+    def __init__(self, max_active=ADMISSION_MAX_ACTIVE, per_user=ADMISSION_PER_USER,
+                 max_queue=ADMISSION_MAX_QUEUE, user_queue=ADMISSION_USER_QUEUE, max_wait=ADMISSION_MAX_WAIT):
+        self.max_active = max_active
+        self.per_user = per_user
+        self.max_queue = max_queue
+        self.user_queue = user_queue
+        self.max_wait = max_wait
+        self._active = {}              # username -> 进行中的调用数
+        self._total = 0
+        self._queues = OrderedDict()   # username -> deque[Future]，顺序即轮转顺序
+        self._depth = 0
+        self._waits = deque(maxlen=WAIT_SAMPLES)
+        self._avg_hold = 10.0          # 每次调用占用时长的滑动平均（秒），用于估算重试间隔
+        self.peak_depth = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.shared = False
+        self._lease_ids = itertools.count()
+        self._bg = set()
+
+    def configure(self, workers):
+        """多 worker 部署：全局上限和队列按进程数平分，每用户上限改由数据库租约跨进程保证
+
+        全局上限是静态平分的，不在进程间共享：一个 worker 满了而另一个空闲时，请求也只能在本进程排队，
+        总并发不会超过 max_active，但负载不均时实际能用到的会少一些（uvicorn 按连接分配，通常比较均匀）。
+        """
+        if workers <= 1:
+            return
+        self.max_active = max(1, math.ceil(self.max_active / workers))
+        self.max_queue = max(1, math.ceil(self.max_queue / workers))
+        self.shared = True
+
+    def _has_room(self, username):
+        return self._total < self.max_active and self._active.get(username, 0) < self.per_user
+
+    def retry_after(self):
+        """按当前队列深度和平均占用时长估算多久后大概能排上"""
+        estimate = (self._depth + 1) * self._avg_hold / self.max_active
+        return max(1, min(60, math.ceil(estimate)))
+
+    def check(self, username):
+        """快速预检：队列已满时立即拒绝，不必先做检索等准备工作"""
+        if self._has_room(username) and username not in self._queues:
+            return
+        if self._depth >= self.max_queue or len(self._queues.get(username, ())) >= self.user_queue:
+            self.rejected += 1
+            raise AdmissionRejected("queue full", self.retry_after())
+
+    async def acquire(self, username):
+        """排队直到放行，返回 Ticket；队列满或等待超时抛 AdmissionRejected"""
+        if not self.shared:
+            return await self._acquire_local(username)
+        self.check(username)
+        lease = await self._take_lease(username)
+        try:
+            ticket = await self._acquire_local(username)
+        except BaseException:
+            self._drop_lease(lease)
+            raise
+        ticket.lease = lease
+        ticket.renewer = asyncio.get_running_loop().create_task(self._renew_lease(lease))
+        return ticket
+
+    async def _take_lease(self, username):
+        """拿到该用户的跨进程生成租约（同一用户在别的 worker 上正在生成时等待）"""
+        name = f"stream:{username}"
+        holder = f"{WORKER_ID}:{next(self._lease_ids)}"
+        deadline = time.monotonic() + self.max_wait
+        while not await run_db(try_lease, name, holder, USER_LEASE_TTL):
+            if time.monotonic() >= deadline:
+                self.timed_out += 1
+                raise AdmissionRejected("user busy in another worker", self.retry_after())
+            await asyncio.sleep(USER_LEASE_POLL)
+        return name, holder
+
+    async def _renew_lease(self, lease):
+        """生成可能比 USER_LEASE_TTL 长：放行期间定期续期，否则租约过期后别的 worker 会放行同一用户"""
+        while True:
+            await asyncio.sleep(USER_LEASE_RENEW)
+            try:
+                renewed = await run_db(try_lease, *lease, USER_LEASE_TTL)
+            except Exception as e:
+                print(f"⚠️ 生成租约续期失败: {e}")
+                continue
+            if not renewed:
+                # 事件循环卡顿超过 TTL 时租约可能已被别的进程拿走，只能放弃
+                print(f"⚠️ 生成租约 {lease[0]} 已被其他进程接管")
+                return
+
+    def _drop_lease(self, lease):
+        task = asyncio.get_running_loop().create_task(run_db(release_lease, *lease))
+        self._bg.add(task)
+        task.add_done_callback(self._bg.discard)
+
+    async def _acquire_local(self, username):
+        if self._has_room(username) and username not in self._queues:
+            self._grant(username)
+            self._waits.append(0.0)
+            return Ticket(self, username, 0.0)
+        self.check(username)
+
+        fut = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(username, deque()).append(fut)
+        self._depth += 1
+        self.peak_depth = max(self.peak_depth, self._depth)
+        t0 = time.monotonic()
+        try:
+            await asyncio.wait({fut}, timeout=self.max_wait)
+        except BaseException:
+            # 客户端断开等导致取消：已经被放行的要把名额还回去
+            if not self._abandon(username, fut):
+                self._release(username, 0.0)
+            raise
+        if not self._abandon(username, fut):
+            waited = time.monotonic() - t0
+            self._waits.append(waited)
+            return Ticket(self, username, waited)
+        self.timed_out += 1
+        raise AdmissionRejected("queue timeout", self.retry_after())
+
+    def _abandon(self, username, fut):
+        """撤出队列；返回 True 表示确实没被放行"""
+        if fut.done():
+            return False
+        fut.cancel()
+        queue = self._queues.get(username)
+        if queue is not None:
+            try:
+                queue.remove(fut)
+                self._depth -= 1
+            except ValueError:
+                pass
+            if not queue:
+                del self._queues[username]
+        return True
+
+    def _grant(self, username):
+        self._active[username] = self._active.get(username, 0) + 1
+        self._total += 1
+        self.admitted += 1
+
+    def _release(self, username, held):
+        count = self._active.get(username, 0) - 1
+        if count > 0:
+            self._active[username] = count
+        else:
+            self._active.pop(username, None)
+        self._total -= 1
+        if held:
+            self._avg_hold = 0.9 * self._avg_hold + 0.1 * held
+        self._dispatch()
+
+    def _dispatch(self):
+        """有空位时按轮转顺序放行排队中的用户"""
+        while self._total < self.max_active and self._queues:
+            for username in list(self._queues):
+                if self._active.get(username, 0) >= self.per_user:
+                    continue
+                queue = self._queues.pop(username)
+                fut = queue.popleft()
+                self._depth -= 1
+                if queue:
+                    self._queues[username] = queue  # 重新插入即排到轮转队尾
+                self._grant(username)
+                fut.set_result(True)
+                break
+            else:
+                return  # 排队的用户都已达到各自的并发上限
+
+    def stats(self):
+        waits = sorted(self._waits)
+
+        def pct(p):
+            return round(waits[min(len(waits) - 1, int(p * len(waits)))] * 1000, 1) if waits else 0.0
+
+        return {
+            "shared": self.shared,
+            "active": self._total,
+            "max_active": self.max_active,
+            "queued": self._depth,
+            "queued_users": len(self._queues),
+            "peak_queued": self.peak_depth,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "wait_ms": {"p50": pct(0.5), "p95": pct(0.95), "max": pct(1.0)},
+            "avg_hold_s": round(self._avg_hold, 2),
+            "retry_after": self.retry_after(),
+        }
+
+
+admission = AdmissionController()
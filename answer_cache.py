@@ -0,0 +1,127 @@
+import re
+import time
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+
+# ================= 配置区 =================
+ANSWER_CACHE_ENABLED = False      # 默认关闭，需要时手动打开
+ANSWER_CACHE_MAX_ENTRIES = 2000
+ANSWER_CACHE_MAX_BYTES = 32 * 1024 * 1024
+ANSWER_CACHE_TTL = 7 * 24 * 3600  # 答案缓存有效期（秒）
+REPLAY_CHUNK_CHARS = 4            # 回放时每次输出多少字符
+REPLAY_INTERVAL = 0.02            # 回放时每块之间的间隔（秒），模拟打字速度
+
+# 等价的 LaTeX 写法，统一成一种
+_LATEX_ALIASES = [
+    (re.compile(r"\\[dt]frac(?![a-zA-Z])"), r"\\frac"),
+    (re.compile(r"\\displaystyle(?![a-zA-Z])"), ""),
+    (re.compile(r"\\(left|right|big|Big|bigg|Bigg)(?![a-zA-Z])"), ""),
+    (re.compile(r"\\[,;:! ]"), ""),                  # 排版用的间距命令
+    (re.compile(r"\\mathrm\{d\}"), "d"),
+    (re.compile(r"\\operatorname\{(\w+)\}"), r"\\\1"),
+    (re.compile(r"\\le(?![a-zA-Z])"), r"\\leq"),
+    (re.compile(r"\\ge(?![a-zA-Z])"), r"\\geq"),
+]
+_MATH_DELIMS = [("\\[", "$"), ("\\]", "$"), ("\\(", "$"), ("\\)", "$"), ("$$", "$")]
+_FULLWIDTH = str.maketrans("？，。：；！（）【】“”", "?,.:;!()[]\"\"")
+_COMMAND_SPACE = re.compile(r"(\\[a-zA-Z]+)\s+(?=[a-zA-Z])")
+_TRAILING = re.compile(r"[\s?.!。？！~～]+$")
+
+
+def normalize_question(text):
+    """把问题规范化成缓存键：折叠空白、统一 LaTeX 等价写法和全角标点
+
+    数学符号大小写有含义，所以不做大小写折叠。
+    """
+    text = text.translate(_FULLWIDTH)
+    for old, new in _MATH_DELIMS:
+        text = text.replace(old, new)
+    for pattern, repl in _LATEX_ALIASES:
+        text = pattern.sub(repl, text)
+    # 空白基本不影响含义，整体去掉；只保留命令名和后面字母之间的一个空格（\le b 不能变成 \leb）
+    text = _COMMAND_SPACE.sub("\\1\0", text)
+    text = re.sub(r"\s+", "", text).replace("\0", " ")
+    return _TRAILING.sub("", text)
+
+
+class AnswerCache:
+    """规范化问题 -> 完整回答 的 LRU 缓存（按条数和总字节数限容）
+
+    只在 prompt 不含任何个性化内容（记忆、摘要、历史）时使用，
+    所以同一道题对所有人的回答可以共享。
+    """
+
+    def __init__(self, max_entries=ANSWER_CACHE_MAX_ENTRIES, max_bytes=ANSWER_CACHE_MAX_BYTES,
+                 ttl=ANSWER_CACHE_TTL):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._items = OrderedDict()  # key -> (expires_at, answer)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key_for(question):
+        normalized = normalize_question(question)
+        if not normalized:
+            return None
+        return hashlib.sha256(normalized.encode()).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and item[0] > time.monotonic():
+                self._items.move_to_end(key)
+                self.hits += 1
+                return item[1]
+            if item is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def put(self, key, answer):
+        size = len(answer.encode())
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+            self._items[key] = (time.monotonic() + self.ttl, answer)
+            self._bytes += size
+            while len(self._items) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._items))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, key):
+        _, answer = self._items.pop(key)
+        self._bytes -= len(answer.encode())
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "enabled": ANSWER_CACHE_ENABLED,
+                "size": len(self._items),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
+
+
+async def replay(answer, chunk_chars=REPLAY_CHUNK_CHARS, interval=REPLAY_INTERVAL):
+    """把缓存的回答按固定节奏切块吐出，前端看起来和实时生成一样"""
+    for i in range(0, len(answer), chunk_chars):
+        yield answer[i:i + chunk_chars]
+        if interval:
+            await asyncio.sleep(interval)
+
+
+answer_cache = AnswerCache()
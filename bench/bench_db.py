@@ -0,0 +1,128 @@
+"""数据访问层基准：旧版“每次调用都 sqlite3.connect + 在事件循环里同步执行” vs 新版连接池
+
+用法: python bench/bench_db.py [--users 50] [--requests 2000] [--concurrency 32]
+
+每个“请求”模拟一次 /chat 的数据库部分：get_user + get_chat_history + 两次 save_chat_message。
+"""
+import os
+import sys
+import time
+import asyncio
+import sqlite3
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import db  # noqa: E402
+
+
+# ================= 旧版实现（照搬重构前的 server.py） =================
+LEGACY_DB_FILE = None
+
+
+def legacy_get_user(username):
+    conn = sqlite3.connect(LEGACY_DB_FILE)
+    c = conn.cursor()
+    c.execute("SELECT * FROM users WHERE username=?", (username,))
+    user = c.fetchone()
+    conn.close()
+    return user
+
+
+def legacy_get_chat_history(username, limit=10):
+    conn = sqlite3.connect(LEGACY_DB_FILE)
+    c = conn.cursor()
+    c.execute("SELECT role, content FROM chat_history WHERE username=? ORDER BY id DESC LIMIT ?", (username, limit))
+    rows = c.fetchall()
+    conn.close()
+    return [{"role": role, "content": content} for role, content in reversed(rows)]
+
+
+def legacy_save_chat_message(username, role, content):
+    conn = sqlite3.connect(LEGACY_DB_FILE)
+    c = conn.cursor()
+    c.execute("INSERT INTO chat_history (username, role, content) VALUES (?, ?, ?)", (username, role, content))
+    conn.commit()
+    conn.close()
+
+
+async def legacy_request(username):
+    # 原来的 get_user / get_chat_history 直接在 async 函数里同步调用
+    legacy_get_user(username)
+    legacy_get_chat_history(username, limit=20)
+    await asyncio.to_thread(legacy_save_chat_message, username, "user", "问题")
+    await asyncio.to_thread(legacy_save_chat_message, username, "assistant", "回答" * 50)
+
+
+async def pooled_request(username):
+    await db.run_db(db.get_user, username)
+    await db.run_db(db.get_chat_history, username, db.DEFAULT_CONV_ID, limit=20)
+    await db.run_db(db.save_chat_message, username, db.DEFAULT_CONV_ID, "user", "问题")
+    await db.run_db(db.save_chat_message, username, db.DEFAULT_CONV_ID, "assistant", "回答" * 50)
+
+
+async def drive(handler, users, total, concurrency):
+    sem = asyncio.Semaphore(concurrency)
+    lags = []
+
+    async def one(i):
+        async with sem:
+            await handler(users[i % len(users)])
+
+    async def probe():
+        # 事件循环延迟：sleep(0.01) 实际多睡了多久
+        while True:
+            t = time.perf_counter()
+            await asyncio.sleep(0.01)
+            lags.append(time.perf_counter() - t - 0.01)
+
+    probe_task = asyncio.create_task(probe())
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    elapsed = time.perf_counter() - start
+    probe_task.cancel()
+    lags.sort()
+    p99_lag = lags[int(len(lags) * 0.99)] if lags else 0.0
+    return total / elapsed, p99_lag
+
+
+def prepare(path, users):
+    db.close_pool()
+    db.DB_FILE = path
+    db.init_db()
+    for u in users:
+        db.create_user(u, "pw")
+    db.close_pool()
+
+
+def main():
+    global LEGACY_DB_FILE
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    args = parser.parse_args()
+
+    users = [f"student{i}" for i in range(args.users)]
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_path = os.path.join(tmp, "legacy.db")
+        pooled_path = os.path.join(tmp, "pooled.db")
+
+        prepare(legacy_path, users)
+        # 旧版数据库保持默认的 rollback journal
+        sqlite3.connect(legacy_path).execute("PRAGMA journal_mode=DELETE").connection.close()
+        LEGACY_DB_FILE = legacy_path
+        rps_old, lag_old = asyncio.run(drive(legacy_request, users, args.requests, args.concurrency))
+
+        prepare(pooled_path, users)
+        db.DB_FILE = pooled_path
+        rps_new, lag_new = asyncio.run(drive(pooled_request, users, args.requests, args.concurrency))
+        db.close_pool()
+
+    print(f"旧版 (每次 connect): {rps_old:8.1f} req/s | 事件循环 p99 延迟 {lag_old * 1000:6.1f} ms")
+    print(f"新版 (连接池 + WAL): {rps_new:8.1f} req/s | 事件循环 p99 延迟 {lag_new * 1000:6.1f} ms")
+    print(f"吞吐提升: x{rps_new / rps_old:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""上游池基准：单上游 vs 多上游路由 vs 多上游 + 对冲，比较首字耗时（TTFT）分布和失败率
+
+用法: python bench/bench_llm.py [--requests 300] [--concurrency 16]
+
+会在本机启动三个假上游（bench/fake_openai.py）：
+  fast  —— 首字 ~0.15s，5% 的请求长尾 +1.5s
+  slow  —— 首字 ~0.6s
+  flaky —— 首字 ~0.15s，30% 的请求直接 503
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import subprocess
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+import llm_pool  # noqa: E402
+from llm_pool import LLMPool, Endpoint  # noqa: E402
+
+UPSTREAMS = {
+    "fast": (5101, ["--ttft", "0.15", "--tail-rate", "0.05", "--tail", "1.5"]),
+    "slow": (5102, ["--ttft", "0.6"]),
+    "flaky": (5103, ["--ttft", "0.15", "--error-rate", "0.3"]),
+}
+MESSAGES = [{"role": "user", "content": "何为流数？"}]
+
+
+def start_upstreams():
+    procs = []
+    for name, (port, extra) in UPSTREAMS.items():
+        procs.append(subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, "fake_openai.py"),
+                                       "--port", str(port)] + extra))
+    for port, _ in UPSTREAMS.values():
+        for _ in range(100):
+            try:
+                httpx.get(f"http://127.0.0.1:{port}/stats", timeout=0.2)
+                break
+            except httpx.HTTPError:
+                time.sleep(0.1)
+    return procs
+
+
+def endpoints(names):
+    return [Endpoint(base_url=f"http://127.0.0.1:{UPSTREAMS[n][0]}/v1", api_key="fake", model="fake", name=n)
+            for n in names]
+
+
+async def drive(pool, total, concurrency):
+    sem = asyncio.Semaphore(concurrency)
+    ttfts = []
+    errors = 0
+
+    async def one():
+        nonlocal errors
+        async with sem:
+            t0 = time.perf_counter()
+            first = None
+            try:
+                async for chunk in pool.stream_chat(MESSAGES):
+                    if first is None and chunk.choices and chunk.choices[0].delta.content:
+                        first = time.perf_counter() - t0
+            except Exception:
+                errors += 1
+                return
+            if first is not None:
+                ttfts.append(first)
+
+    await asyncio.gather(*(one() for _ in range(total)))
+    await pool.close()
+    ttfts.sort()
+
+    def pct(p):
+        return ttfts[min(len(ttfts) - 1, int(p * len(ttfts)))] * 1000 if ttfts else 0.0
+
+    return pct(0.5), pct(0.95), pct(0.99), errors, pool.snapshot()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=16)
+    args = parser.parse_args()
+
+    # 对冲阈值下限调低一点，让短时间的压测也能看出效果
+    llm_pool.HEDGE_MIN_DELAY = 0.2
+    llm_pool.HEDGE_MIN_SAMPLES = 10
+    procs = start_upstreams()
+    try:
+        cases = [
+            ("单上游 (fast)", ["fast"], False),
+            ("多上游路由", ["fast", "slow", "flaky"], False),
+            ("多上游 + 对冲", ["fast", "slow", "flaky"], True),
+        ]
+        for label, names, hedge in cases:
+            pool = LLMPool(endpoints(names), hedge=hedge)
+            p50, p95, p99, errors, snap = asyncio.run(drive(pool, args.requests, args.concurrency))
+            print(f"{label:14s} TTFT p50 {p50:7.1f} ms | p95 {p95:7.1f} ms | p99 {p99:7.1f} ms | "
+                  f"失败 {errors:3d} | 切换 {snap['failovers']:3d} | 对冲 {snap['hedges']:3d} "
+                  f"(胜 {snap['hedge_wins']})")
+    finally:
+        for p in procs:
+            p.terminate()
+
+
+if __name__ == "__main__":
+    main()
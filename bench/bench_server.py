@@ -0,0 +1,300 @@
+"""整机压测：在本地假上游上启动 server.py 的 app，模拟 N 个学生 注册 -> 登录 -> 问候 -> 多轮对话
+
+用法: python bench/bench_server.py [--students 30] [--turns 3] [--ttft 0.3] [--token-rate 60] [--tokens 80]
+                                   [--search-latency 0.15] [--add-latency 0.3] [--label dev]
+                                   [--out bench/results/xxx.json] [--compare 旧结果.json]
+
+不调用任何付费接口：
+  * LLM 上游是 bench/fake_openai.py（子进程），首字延迟和出字速度可配；
+  * MemOS 换成 bench/fake_memos.py 的假客户端（检索/写入延迟可配）；
+  * 数据库和访问日志放在临时目录，不碰 users.db。
+服务端单独一个进程（--serve 模式），压测端的开销不会算进服务端的事件循环延迟。
+结果（TTFT p50/p95/p99、tokens/s、req/s、事件循环延迟等）打印出来并存成 JSON，
+用 --compare 和之前版本的结果逐项对比。
+"""
+import os
+import sys
+import json
+import time
+import types
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT_DIR)
+
+
+# ================= 服务端（子进程） =================
+def serve(args):
+    """用假 MemOS 替换 SDK 后 import server，在临时库上启动 uvicorn"""
+    import uvicorn
+    from fake_memos import FakeMemOSClient
+
+    def make_client(api_key=None):
+        return FakeMemOSClient(api_key, search_latency=args.search_latency, add_latency=args.add_latency)
+
+    # server.py 在 import 时就构造 MemOSClient，所以要在 import 之前换掉
+    fake_module = types.ModuleType("memos.api.client")
+    fake_module.MemOSClient = make_client
+    for name in ("memos", "memos.api"):
+        sys.modules.setdefault(name, types.ModuleType(name))
+    sys.modules["memos.api.client"] = fake_module
+
+    import db
+    import metrics
+    db.DB_FILE = os.path.join(args.workdir, "bench.db")
+    metrics.ACCESS_LOG_FILE = os.path.join(args.workdir, "access.log")
+    import server
+
+    lags = []
+    probe = {"task": None}
+
+    async def lag_probe():
+        # 事件循环延迟：sleep(0.01) 实际多睡了多久
+        while True:
+            t = time.perf_counter()
+            await asyncio.sleep(0.01)
+            lags.append(time.perf_counter() - t - 0.01)
+
+    async def bench_lag(reset: bool = False):
+        if reset or probe["task"] is None:
+            lags.clear()
+            if probe["task"] is None:
+                probe["task"] = asyncio.create_task(lag_probe())
+            return {}
+        samples = sorted(lags)
+        if not samples:
+            return {}
+        return {
+            "p50_ms": round(samples[len(samples) // 2] * 1000, 2),
+            "p99_ms": round(samples[int(len(samples) * 0.99)] * 1000, 2),
+            "max_ms": round(samples[-1] * 1000, 2),
+        }
+
+    server.app.add_api_route("/bench/lag", bench_lag, methods=["GET"])
+    server.init_db()
+    uvicorn.run(server.app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+# ================= 压测端 =================
+class Student:
+    def __init__(self, name):
+        self.name = name
+        self.ttfts = []
+        self.tokens = 0
+        self.stream_rates = []
+        self.greet_times = []
+        self.errors = []
+        self.rejected = 0
+        self.turns = 0
+
+
+async def run_student(client, student, turns, questions):
+    auth = {"username": student.name, "password": "bench-pw"}
+    try:
+        await client.post("/api/register", json=auth)
+        r = await client.post("/api/login", json=auth)
+        if not r.json().get("success"):
+            student.errors.append("login failed")
+            return
+        t0 = time.perf_counter()
+        r = await client.post("/api/greet", json={"userId": student.name})
+        await r.aread()
+        student.greet_times.append(time.perf_counter() - t0)
+    except httpx.HTTPError as e:
+        student.errors.append(f"auth: {e}")
+        return
+
+    for turn in range(turns):
+        question = questions[turn % len(questions)]
+        t0 = time.perf_counter()
+        first = None
+        try:
+            async with client.stream("POST", "/chat", json={"message": question, "userId": student.name},
+                                     headers={"Accept": "application/x-ndjson"}) as r:
+                if r.status_code == 429:
+                    student.rejected += 1
+                    await asyncio.sleep(float(r.headers.get("retry-after", "1")))
+                    continue
+                async for line in r.aiter_lines():
+                    if not line.strip():
+                        continue
+                    f = json.loads(line)
+                    if f["type"] == "delta" and first is None:
+                        first = time.perf_counter()
+                        student.ttfts.append(first - t0)
+                    elif f["type"] == "done":
+                        completion = f.get("usage", {}).get("completion_tokens", 0)
+                        student.tokens += completion
+                        if first is not None and completion:
+                            student.stream_rates.append(completion / max(time.perf_counter() - first, 1e-6))
+                    elif f["type"] == "error":
+                        student.errors.append(f["message"])
+            student.turns += 1
+        except httpx.HTTPError as e:
+            student.errors.append(f"chat: {e}")
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+def ms(value):
+    return round(value * 1000, 1) if value is not None else None
+
+
+async def drive(args, base_url):
+    questions = ["何为流数？", "求 $\\int_0^1 x^2 dx$", "请证明 $\\sqrt{2}$ 是无理数", "解释一下泰勒展开"]
+    students = [Student(f"bench{i}") for i in range(args.students)]
+    limits = httpx.Limits(max_connections=args.students * 2, max_keepalive_connections=args.students)
+    async with httpx.AsyncClient(base_url=base_url, timeout=120, limits=limits) as client:
+        await client.get("/bench/lag", params={"reset": True})
+        sem = asyncio.Semaphore(args.concurrency or args.students)
+
+        async def one(s):
+            async with sem:
+                await run_student(client, s, args.turns, questions)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(s) for s in students))
+        elapsed = time.perf_counter() - start
+        lag = (await client.get("/bench/lag")).json()
+        stats = (await client.get("/api/stats")).json()
+
+    ttfts = [t for s in students for t in s.ttfts]
+    greets = [t for s in students for t in s.greet_times]
+    rates = [r for s in students for r in s.stream_rates]
+    turns = sum(s.turns for s in students)
+    requests = turns + sum(len(s.greet_times) for s in students) + 2 * len(students)
+    return {
+        "elapsed_s": round(elapsed, 2),
+        "chat_turns": turns,
+        "requests_per_s": round(requests / elapsed, 2),
+        "chat_turns_per_s": round(turns / elapsed, 2),
+        "ttft_ms": {"p50": ms(percentile(ttfts, 0.5)), "p95": ms(percentile(ttfts, 0.95)),
+                    "p99": ms(percentile(ttfts, 0.99))},
+        "greet_ms": {"p50": ms(percentile(greets, 0.5)), "p95": ms(percentile(greets, 0.95))},
+        "tokens_per_s": round(sum(s.tokens for s in students) / elapsed, 1),
+        "stream_tokens_per_s_p50": round(percentile(rates, 0.5) or 0, 1),
+        "event_loop_lag_ms": lag,
+        "rejected_429": sum(s.rejected for s in students),
+        "errors": sum(len(s.errors) for s in students),
+        "error_samples": [e for s in students for e in s.errors][:5],
+        "server": {"admission": stats.get("admission"), "memos": stats.get("memos")},
+    }
+
+
+def wait_ready(url, proc, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"{url} 启动失败")
+        try:
+            httpx.get(url, timeout=0.5)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"等待 {url} 超时")
+
+
+def git_rev():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, text=True).strip()
+    except Exception:
+        return None
+
+
+def compare(old, new):
+    """逐项打印新旧结果的差异（只比较数值型的关键指标）"""
+    keys = [("ttft_ms", "p50"), ("ttft_ms", "p95"), ("ttft_ms", "p99"), ("requests_per_s",),
+            ("tokens_per_s",), ("event_loop_lag_ms", "p99_ms"), ("errors",), ("rejected_429",)]
+    print(f"\n对比 {old.get('label')}@{old.get('git_rev')} -> {new.get('label')}@{new.get('git_rev')}")
+    for path in keys:
+        a, b = old["results"], new["results"]
+        for k in path:
+            a = a.get(k) if isinstance(a, dict) else None
+            b = b.get(k) if isinstance(b, dict) else None
+        if a is None or b is None:
+            continue
+        change = f"{(b - a) / a * 100:+.1f}%" if a else ""
+        print(f"  {'.'.join(path):24s} {a:>10} -> {b:>10} {change}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--students", type=int, default=30)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--concurrency", type=int, default=0, help="同时在线的学生数，0 表示全部")
+    parser.add_argument("--ttft", type=float, default=0.3, help="假 LLM 的首字延迟（秒）")
+    parser.add_argument("--token-rate", type=float, default=60.0, help="假 LLM 每秒出多少 token")
+    parser.add_argument("--tokens", type=int, default=80, help="每个回答多少 token")
+    parser.add_argument("--search-latency", type=float, default=0.15)
+    parser.add_argument("--add-latency", type=float, default=0.3)
+    parser.add_argument("--port", type=int, default=5150)
+    parser.add_argument("--llm-port", type=int, default=5151)
+    parser.add_argument("--label", default="dev")
+    parser.add_argument("--out", default=None)
+    parser.add_argument("--compare", default=None, help="之前保存的结果 JSON")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        sys.path.insert(0, BENCH_DIR)
+        serve(args)
+        return
+
+    with tempfile.TemporaryDirectory() as workdir:
+        env = dict(os.environ, LLM_ENDPOINTS=json.dumps([{
+            "name": "fake", "base_url": f"http://127.0.0.1:{args.llm_port}/v1", "api_key": "bench", "model": "fake",
+        }]))
+        llm_proc = subprocess.Popen([
+            sys.executable, os.path.join(BENCH_DIR, "fake_openai.py"), "--port", str(args.llm_port),
+            "--ttft", str(args.ttft), "--token-delay", str(1 / args.token_rate), "--tokens", str(args.tokens),
+        ])
+        server_proc = subprocess.Popen([
+            sys.executable, os.path.abspath(__file__), "--serve", "--port", str(args.port),
+            "--workdir", workdir, "--search-latency", str(args.search_latency),
+            "--add-latency", str(args.add_latency),
+        ], env=env, cwd=workdir, stdout=subprocess.DEVNULL)
+        try:
+            wait_ready(f"http://127.0.0.1:{args.llm_port}/stats", llm_proc)
+            wait_ready(f"http://127.0.0.1:{args.port}/api/stats", server_proc)
+            results = asyncio.run(drive(args, f"http://127.0.0.1:{args.port}"))
+        finally:
+            server_proc.terminate()
+            llm_proc.terminate()
+            server_proc.wait(10)
+            llm_proc.wait(10)
+
+    config = {k: v for k, v in vars(args).items() if k not in ("serve", "workdir", "out", "compare")}
+    report = {"label": args.label, "git_rev": git_rev(), "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "config": config, "results": results}
+    r = results
+    print(f"学生 {args.students} × {args.turns} 轮 | 用时 {r['elapsed_s']}s | {r['requests_per_s']} req/s | "
+          f"{r['tokens_per_s']} tokens/s")
+    print(f"TTFT p50 {r['ttft_ms']['p50']} ms | p95 {r['ttft_ms']['p95']} ms | p99 {r['ttft_ms']['p99']} ms | "
+          f"问候 p50 {r['greet_ms']['p50']} ms")
+    print(f"事件循环延迟 {r['event_loop_lag_ms']} | 429: {r['rejected_429']} | 错误: {r['errors']}")
+
+    out = args.out or os.path.join(BENCH_DIR, "results", f"{args.label}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"结果已保存: {out}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+"""首屏加载压测：server.py 直接托管 index.html 和 /static 资源时，一次冷加载 / 热加载要传多少字节、花多久
+
+用法: python bench/bench_static.py [--runs 5] [--parallel 6] [--rtt-ms 30] [--mbps 20]
+                                   [--dist static/dist] [--label dev] [--out bench/results/xxx.json]
+                                   [--compare 旧结果.json]
+
+模拟浏览器：
+  * 冷加载：新连接、空缓存，先取 /，再并发（最多 --parallel 个连接）取页面直接引用的 /static 资源，
+    最后取 CSS 里 url() 引用的字体；
+  * 热加载：/ 带 If-None-Match 验证（应当 304），immutable 的资源直接用缓存，其余资源带 ETag 验证。
+本机回环测出来的墙钟时间只反映服务端开销，所以另外按 --rtt-ms / --mbps 估算校园网下的加载时间：
+每一波请求 = 建连 1 个 RTT + 每个连接上的请求轮数 × RTT + 这一波字节数 / 带宽。
+没有构建过（开发模式）时第三方库仍走 CDN，这部分无法在本地测量，只统计引用个数。
+服务端复用 bench_server.py 的 --serve 模式（临时库、假 MemOS），LLM 地址随便填，不会被调用。
+"""
+import os
+import re
+import sys
+import json
+import gzip
+import time
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from bench_server import wait_ready, git_rev, percentile
+from static_assets import DIST_DIR
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 只有能解压 br 时才声明支持，否则按 gzip 测
+ACCEPT_ENCODING = "br, gzip" if brotli is not None else "gzip"
+
+_PAGE_REF = re.compile(r"(?:src|href)=\"(/static/[^\"]+)\"")
+_EXTERNAL_REF = re.compile(r"(?:src|href)=\"(https?://[^\"]+)\"")
+_CSS_URL = re.compile(r"url\(\s*['\"]?([^'\")]+?)['\"]?\s*\)")
+
+
+def decode(response, raw):
+    encoding = response.headers.get("content-encoding")
+    if encoding == "gzip":
+        return gzip.decompress(raw)
+    if encoding == "br":
+        return brotli.decompress(raw)
+    return raw
+
+
+def header_bytes(response):
+    # 状态行 + 每行 "k: v\r\n"，近似 HTTP/1.1 线上的头部大小
+    return 17 + sum(len(k) + len(v) + 4 for k, v in response.headers.items())
+
+
+class Load:
+    """一次页面加载：按波次记录每个请求的线上字节数"""
+
+    def __init__(self):
+        self.waves = []  # 每一波 [(url, status, 线上字节)]
+        self.validators = {}  # url -> (etag, cache-control)
+        self.external = []
+        self.cached = 0  # 热加载时直接用缓存、没发请求的资源数
+
+    def add_wave(self, results):
+        self.waves.append(results)
+
+    @property
+    def requests(self):
+        return sum(len(w) for w in self.waves)
+
+    @property
+    def wire_bytes(self):
+        return sum(size for w in self.waves for _, _, size in w)
+
+    def modeled_ms(self, rtt_ms, mbps, parallel):
+        """每一波：建连（只有第一次）+ 请求轮数 × RTT + 字节数 / 带宽"""
+        total = 0.0
+        connections = 0
+        for wave in self.waves:
+            if not wave:
+                continue
+            needed = min(len(wave), parallel)
+            if needed > connections:
+                total += rtt_ms  # 新连接的握手并行进行，算一个 RTT
+                connections = needed
+            rounds = -(-len(wave) // parallel)
+            total += rounds * rtt_ms
+            total += sum(size for _, _, size in wave) * 8 / (mbps * 1000)
+        return total
+
+
+async def fetch(client, url, headers=None):
+    async with client.stream("GET", url, headers=headers) as r:
+        raw = b"".join([chunk async for chunk in r.aiter_raw()])
+    return r, raw
+
+
+async def cold_load(base_url, parallel):
+    load = Load()
+    limits = httpx.Limits(max_connections=parallel, max_keepalive_connections=parallel)
+    headers = {"Accept-Encoding": ACCEPT_ENCODING}
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, headers=headers) as client:
+        r, raw = await fetch(client, "/")
+        r.raise_for_status()
+        load.add_wave([("/", r.status_code, header_bytes(r) + len(raw))])
+        load.validators["/"] = (r.headers.get("etag"), r.headers.get("cache-control", ""))
+        html = decode(r, raw).decode("utf-8")
+        load.external = sorted(set(_EXTERNAL_REF.findall(html)))
+
+        async def wave(urls):
+            responses = await asyncio.gather(*(fetch(client, u) for u in urls))
+            results, bodies = [], {}
+            for url, (resp, body) in zip(urls, responses):
+                results.append((url, resp.status_code, header_bytes(resp) + len(body)))
+                load.validators[url] = (resp.headers.get("etag"), resp.headers.get("cache-control", ""))
+                if url.endswith(".css") and resp.status_code == 200:
+                    bodies[url] = decode(resp, body).decode("utf-8")
+            load.add_wave(results)
+            return bodies
+
+        direct = list(dict.fromkeys(_PAGE_REF.findall(html)))
+        stylesheets = await wave(direct)
+        # CSS 里的 url() 相对于 CSS 自己的路径，构建产物里都在 /static/ 下
+        nested = []
+        for url, css in stylesheets.items():
+            for ref in _CSS_URL.findall(css):
+                if ref.startswith(("data:", "http")):
+                    continue
+                nested.append(url.rsplit("/", 1)[0] + "/" + ref)
+        nested = [u for u in dict.fromkeys(nested) if u not in load.validators]
+        if nested:
+            await wave(nested)
+    return load
+
+
+async def warm_load(base_url, parallel, cold):
+    """带着冷加载留下的缓存再开一次页面"""
+    load = Load()
+    limits = httpx.Limits(max_connections=parallel, max_keepalive_connections=parallel)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits,
+                                 headers={"Accept-Encoding": ACCEPT_ENCODING}) as client:
+        revalidate = [(url, etag) for url, (etag, cache_control) in cold.validators.items()
+                      if "immutable" not in cache_control]
+
+        async def one(url, etag):
+            r, raw = await fetch(client, url, {"If-None-Match": etag} if etag else None)
+            return url, r.status_code, header_bytes(r) + len(raw)
+
+        first = [item for item in revalidate if item[0] == "/"]
+        rest = [item for item in revalidate if item[0] != "/"]
+        load.add_wave([await one(*item) for item in first])
+        if rest:
+            load.add_wave(list(await asyncio.gather(*(one(*item) for item in rest))))
+    load.cached = len(cold.validators) - len(revalidate)
+    return load
+
+
+async def drive(args, base_url):
+    cold_times, warm_times = [], []
+    cold = warm = None
+    for _ in range(args.runs):
+        t0 = time.perf_counter()
+        cold = await cold_load(base_url, args.parallel)
+        cold_times.append(time.perf_counter() - t0)
+        t0 = time.perf_counter()
+        warm = await warm_load(base_url, args.parallel, cold)
+        warm_times.append(time.perf_counter() - t0)
+    stats = httpx.get(f"{base_url}/api/stats").json().get("static", {})
+    return {
+        "built": stats.get("built"),
+        "accept_encoding": ACCEPT_ENCODING,
+        "cold": {
+            "requests": cold.requests,
+            "wire_kb": round(cold.wire_bytes / 1024, 1),
+            "waves": len(cold.waves),
+            "wall_ms_p50": round(percentile(cold_times, 0.5) * 1000, 1),
+            "modeled_ms": round(cold.modeled_ms(args.rtt_ms, args.mbps, args.parallel), 1),
+            "external_refs": len(cold.external),
+            "files": [{"url": url, "status": status, "bytes": size} for wave in cold.waves for url, status, size in wave],
+        },
+        "warm": {
+            "requests": warm.requests,
+            "not_modified": sum(1 for w in warm.waves for _, status, _ in w if status == 304),
+            "cached": warm.cached,
+            "wire_kb": round(warm.wire_bytes / 1024, 1),
+            "wall_ms_p50": round(percentile(warm_times, 0.5) * 1000, 1),
+            "modeled_ms": round(warm.modeled_ms(args.rtt_ms, args.mbps, args.parallel), 1),
+        },
+    }
+
+
+def compare(old, new):
+    keys = [("cold", "requests"), ("cold", "wire_kb"), ("cold", "modeled_ms"), ("cold", "external_refs"),
+            ("warm", "requests"), ("warm", "wire_kb"), ("warm", "modeled_ms")]
+    print(f"\n对比 {old.get('label')}@{old.get('git_rev')} -> {new.get('label')}@{new.get('git_rev')}")
+    for section, key in keys:
+        a = old["results"].get(section, {}).get(key)
+        b = new["results"].get(section, {}).get(key)
+        if a is None or b is None:
+            continue
+        change = f"{(b - a) / a * 100:+.1f}%" if a else ""
+        print(f"  {section + '.' + key:24s} {a:>10} -> {b:>10} {change}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--parallel", type=int, default=6, help="浏览器对同一主机的最大连接数")
+    parser.add_argument("--rtt-ms", type=float, default=30.0, help="估算用的往返时延")
+    parser.add_argument("--mbps", type=float, default=20.0, help="估算用的下行带宽")
+    parser.add_argument("--dist", default=DIST_DIR, help="要测的构建产物目录；不存在时测开发模式")
+    parser.add_argument("--port", type=int, default=5160)
+    parser.add_argument("--label", default="dev")
+    parser.add_argument("--out", default=None)
+    parser.add_argument("--compare", default=None, help="之前保存的结果 JSON")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        env = dict(os.environ, NEWTON_STATIC_DIST=os.path.abspath(args.dist), LLM_ENDPOINTS=json.dumps([{
+            "name": "unused", "base_url": "http://127.0.0.1:9/v1", "api_key": "bench", "model": "unused",
+        }]))
+        server_proc = subprocess.Popen([
+            sys.executable, os.path.join(BENCH_DIR, "bench_server.py"), "--serve", "--port", str(args.port),
+            "--workdir", workdir,
+        ], env=env, cwd=workdir, stdout=subprocess.DEVNULL)
+        try:
+            wait_ready(f"http://127.0.0.1:{args.port}/api/stats", server_proc)
+            results = asyncio.run(drive(args, f"http://127.0.0.1:{args.port}"))
+        finally:
+            server_proc.terminate()
+            server_proc.wait(10)
+
+    config = {k: v for k, v in vars(args).items() if k not in ("out", "compare")}
+    report = {"label": args.label, "git_rev": git_rev(), "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "config": config, "results": results}
+    c, w = results["cold"], results["warm"]
+    print(f"{'构建产物' if results['built'] else '开发模式'} | Accept-Encoding: {results['accept_encoding']} | "
+          f"估算网络 RTT {args.rtt_ms:g} ms, {args.mbps:g} Mbps")
+    for f in c["files"]:
+        print(f"  {f['url']:48s} {f['status']} {f['bytes'] / 1024:8.1f} KB")
+    print(f"冷加载 {c['requests']} 个请求 / {c['waves']} 波 | {c['wire_kb']} KB | "
+          f"本机 p50 {c['wall_ms_p50']} ms | 估算 {c['modeled_ms']} ms")
+    if c["external_refs"]:
+        print(f"  ⚠️ 另有 {c['external_refs']} 个 CDN 引用未计入（运行 python build_static.py 后可离线加载）")
+    print(f"热加载 {w['requests']} 个请求（{w['not_modified']} 个 304，{w['cached']} 个直接用缓存）| "
+          f"{w['wire_kb']} KB | 本机 p50 {w['wall_ms_p50']} ms | 估算 {w['modeled_ms']} ms")
+
+    out = args.out or os.path.join(BENCH_DIR, "results", f"static-{args.label}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"结果已保存: {out}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""假 MemOS 客户端：和 MemOSClient 同样的同步接口（search_memory / add_message），可配置延迟和失败率
+
+MemOSClient 本身是同步 HTTP SDK，服务端通过 MemoryAdapter 的线程池调用它；
+这里用 time.sleep 模拟网络耗时，压测时走的仍是同一条线程池 + 截止时间 + 熔断的路径。
+写入的消息按用户保存，检索时把最近几条当作“记忆”返回。
+"""
+import time
+import random
+import threading
+from collections import defaultdict, deque
+
+
+class FakeMemOSClient:
+    def __init__(self, api_key=None, search_latency=0.15, add_latency=0.3, jitter=0.3, error_rate=0.0):
+        self.search_latency = search_latency
+        self.add_latency = add_latency
+        self.jitter = jitter          # 延迟上下浮动的比例
+        self.error_rate = error_rate
+        self._memories = defaultdict(lambda: deque(maxlen=20))
+        self._lock = threading.Lock()
+        self.searches = 0
+        self.adds = 0
+
+    def _sleep(self, base):
+        time.sleep(max(0.0, base * (1 + random.uniform(-self.jitter, self.jitter))))
+        if random.random() < self.error_rate:
+            raise RuntimeError("injected MemOS failure")
+
+    def search_memory(self, query, user_id, conversation_id):
+        self._sleep(self.search_latency)
+        with self._lock:
+            self.searches += 1
+            items = list(self._memories[user_id])[-5:]
+        return {
+            "memory_detail_list": [
+                {"memory_key": f"对话{i}", "memory_value": content, "tags": [], "relativity": 1.0 - i * 0.1}
+                for i, content in enumerate(reversed(items))
+            ],
+            "preference_detail_list": [{"preference": "喜欢先看结论再看推导", "reasoning": "bench"}] if items else [],
+        }
+
+    def add_message(self, messages, user_id, conversation_id):
+        self._sleep(self.add_latency)
+        with self._lock:
+            self.adds += 1
+            for m in messages:
+                if m["role"] == "user":
+                    self._memories[user_id].append(m["content"][:200])
+        return {"success": True}
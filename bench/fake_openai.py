@@ -0,0 +1,108 @@
+"""本地假 OpenAI 兼容上游：可注入首字延迟、长尾、逐 token 延迟和错误，用于压测和故障演练
+
+用法: python bench/fake_openai.py --port 5101 [--ttft 0.2] [--jitter 0.05] [--tail-rate 0.1 --tail 2.0]
+                                  [--token-delay 0.01] [--tokens 40] [--error-rate 0.2] [--error-status 503]
+
+只实现 /v1/chat/completions（流式和非流式），回答内容是固定的牛顿腔调文本。
+"""
+import json
+import time
+import random
+import asyncio
+import argparse
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.requests import ClientDisconnect
+
+ANSWER = "吾乃艾萨克·牛顿。\n\n设 $f(x)=x^2$，则\n\n$$f'(x)=2x$$\n\n此乃流数之法，汝当细察。"
+
+
+def make_app(ttft=0.2, jitter=0.05, tail_rate=0.0, tail=2.0, token_delay=0.01, tokens=40,
+             error_rate=0.0, error_status=503):
+    app = FastAPI()
+    stats = {"requests": 0, "errors": 0, "cancelled": 0}
+
+    def pieces():
+        step = max(1, len(ANSWER) // tokens)
+        return [ANSWER[i:i + step] for i in range(0, len(ANSWER), step)]
+
+    def first_delay():
+        delay = max(0.0, random.gauss(ttft, jitter))
+        if random.random() < tail_rate:
+            delay += tail
+        return delay
+
+    def chunk(delta, finish=None, usage=None):
+        body = {"id": "fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": "fake",
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish}]}
+        if usage:
+            body["usage"] = usage
+        return "data: " + json.dumps(body, ensure_ascii=False) + "\n\n"
+
+    @app.post("/v1/chat/completions")
+    async def completions(request: Request):
+        try:
+            body = await request.json()
+        except ClientDisconnect:
+            # 对冲输掉的一方可能在请求体发完之前就被取消
+            stats["cancelled"] += 1
+            return JSONResponse({}, status_code=499)
+        stats["requests"] += 1
+        if random.random() < error_rate:
+            stats["errors"] += 1
+            await asyncio.sleep(first_delay() / 2)
+            return JSONResponse({"error": {"message": "injected failure", "type": "server_error"}},
+                                status_code=error_status)
+        delay = first_delay()
+        usage = {"prompt_tokens": 100, "completion_tokens": tokens, "total_tokens": 100 + tokens}
+
+        if not body.get("stream"):
+            await asyncio.sleep(delay + token_delay * tokens)
+            return {"id": "fake", "object": "chat.completion", "created": int(time.time()), "model": "fake",
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": ANSWER},
+                                 "finish_reason": "stop"}],
+                    "usage": usage}
+
+        async def gen():
+            try:
+                await asyncio.sleep(delay)
+                for piece in pieces():
+                    yield chunk({"content": piece})
+                    await asyncio.sleep(token_delay)
+                yield chunk({}, finish="stop",
+                            usage=usage if body.get("stream_options", {}).get("include_usage") else None)
+                yield "data: [DONE]\n\n"
+            except asyncio.CancelledError:
+                stats["cancelled"] += 1
+                raise
+
+        return StreamingResponse(gen(), media_type="text/event-stream")
+
+    @app.get("/stats")
+    async def stats_endpoint():
+        return stats
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=5101)
+    parser.add_argument("--ttft", type=float, default=0.2)
+    parser.add_argument("--jitter", type=float, default=0.05)
+    parser.add_argument("--tail-rate", type=float, default=0.0, help="多大比例的请求额外慢 --tail 秒")
+    parser.add_argument("--tail", type=float, default=2.0)
+    parser.add_argument("--token-delay", type=float, default=0.01)
+    parser.add_argument("--tokens", type=int, default=40)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=503)
+    args = parser.parse_args()
+    app = make_app(args.ttft, args.jitter, args.tail_rate, args.tail, args.token_delay, args.tokens,
+                   args.error_rate, args.error_status)
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
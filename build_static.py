@@ -0,0 +1,267 @@
+"""前端构建：把 index.html 依赖的 CDN 资源放到本地，生成由 server.py 直接托管的 static/dist
+
+    python build_static.py              # 缺的第三方文件先下载到 static/vendor，再构建
+    python build_static.py --fetch      # 只下载（在联网的机器上执行一次，static/vendor 可以整个拷到离线机器）
+    python build_static.py --offline    # 只用 static/vendor 里已有的文件构建
+
+构建产物（static/dist）：
+  * tailwind.<哈希>.css   Tailwind CLI 按 index.html 里实际出现的 class 生成，替代运行时 JIT 的 CDN 脚本
+  * 其余 js / css / 字体 / 头像，文件名带内容哈希，浏览器可以永久缓存
+  * 文本文件旁边的 .gz / .br 预压缩版本（.br 需要安装 brotli）
+  * index.html            所有外部引用改成 /static/<带哈希的文件名>
+  * manifest.json         static_assets.StaticAssets 启动时按它加载
+源码里的 index.html 保持引用 CDN，不构建也能直接打开调试。
+"""
+import os
+import re
+import sys
+import gzip
+import json
+import shutil
+import hashlib
+import platform
+import argparse
+import tempfile
+import subprocess
+import urllib.request
+from urllib.parse import urljoin, urlsplit
+
+from static_assets import BASE_DIR, SOURCE_HTML, DIST_DIR, STATIC_PREFIX, LOCAL_FILES, COMPRESSIBLE
+
+# 可选依赖：装了 brotli 就额外生成 .br（比 gzip 再小 15%~20%）
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# ================= 配置区 =================
+VENDOR_DIR = os.path.join(BASE_DIR, "static", "vendor")
+TAILWIND_VERSION = "3.4.17"
+# 下载字体 CSS 时用现代浏览器的 UA，Google Fonts 才会只给 woff2
+FETCH_USER_AGENT = ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+                    "(KHTML, like Gecko) Chrome/120.0 Safari/537.36")
+FETCH_TIMEOUT = 30
+# index.html 里的外部引用 -> (本地文件名, 下载地址)。CSS 里 url() 引用的字体下载时一并取回
+CDN_ASSETS = {
+    "https://cdn.jsdelivr.net/npm/marked/marked.min.js":
+        ("marked.min.js", "https://cdn.jsdelivr.net/npm/marked@12.0.2/marked.min.js"),
+    "https://cdn.jsdelivr.net/npm/katex@0.16.9/dist/katex.min.css":
+        ("katex.min.css", "https://cdn.jsdelivr.net/npm/katex@0.16.9/dist/katex.min.css"),
+    "https://cdn.jsdelivr.net/npm/katex@0.16.9/dist/katex.min.js":
+        ("katex.min.js", "https://cdn.jsdelivr.net/npm/katex@0.16.9/dist/katex.min.js"),
+    "https://cdn.jsdelivr.net/npm/katex@0.16.9/dist/contrib/auto-render.min.js":
+        ("auto-render.min.js", "https://cdn.jsdelivr.net/npm/katex@0.16.9/dist/contrib/auto-render.min.js"),
+    "https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css":
+        ("fontawesome.min.css", "https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css"),
+    "https://fonts.googleapis.com/css2?family=JetBrains+Mono:wght@400;700&family=Orbitron:wght@500;700&display=swap":
+        ("fonts.css", "https://fonts.googleapis.com/css2?family=JetBrains+Mono:wght@400;700"
+                      "&family=Orbitron:wght@500;700&display=swap"),
+}
+TAILWIND_TAG = '<script src="https://cdn.tailwindcss.com"></script>'
+
+_CSS_URL = re.compile(r"url\(\s*(['\"]?)([^'\")]+)\1\s*\)")
+# @font-face 里 woff2 之后的旧格式（woff / ttf / eot / svg），现代浏览器用不到，不下载
+_LEGACY_FONT = re.compile(r",\s*url\([^)]*\)\s*format\(\s*['\"](?:woff|truetype|opentype|embedded-opentype|svg)['\"]\s*\)")
+_ICON_RULE = re.compile(r"([^{}]+)\{[^{}]*\}")
+_ICON_SELECTOR = re.compile(r"\.(fa-[a-z0-9-]+)::?before")
+
+
+# ================= 下载第三方文件 =================
+def _get(url):
+    request = urllib.request.Request(url, headers={"User-Agent": FETCH_USER_AGENT})
+    with urllib.request.urlopen(request, timeout=FETCH_TIMEOUT) as r:
+        return r.read()
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def fetch_css(url, name, vendor_dir):
+    """下载 CSS 以及它 url() 引用的文件，引用改成同目录下的文件名"""
+    css = _LEGACY_FONT.sub("", _get(url).decode("utf-8"))
+
+    def localize(m):
+        ref = m.group(2)
+        if ref.startswith("data:"):
+            return m.group(0)
+        src = urljoin(url, ref)
+        local = os.path.basename(urlsplit(src).path)
+        path = os.path.join(vendor_dir, local)
+        if not os.path.exists(path):
+            _write(path, _get(src))
+        return f"url({local})"
+
+    _write(os.path.join(vendor_dir, name), _CSS_URL.sub(localize, css).encode("utf-8"))
+
+
+def tailwind_binary_name():
+    system = {"Windows": "windows", "Darwin": "macos"}.get(platform.system(), "linux")
+    arch = "arm64" if platform.machine().lower() in ("arm64", "aarch64") else "x64"
+    return f"tailwindcss-{system}-{arch}" + (".exe" if system == "windows" else "")
+
+
+def fetch(vendor_dir=VENDOR_DIR, force=False):
+    """下载缺少的第三方文件和 Tailwind 独立 CLI（不需要 Node.js），返回下载的文件数"""
+    fetched = 0
+    for name, url in CDN_ASSETS.values():
+        if os.path.exists(os.path.join(vendor_dir, name)) and not force:
+            continue
+        print(f"⬇️ {url}")
+        if name.endswith(".css"):
+            fetch_css(url, name, vendor_dir)
+        else:
+            _write(os.path.join(vendor_dir, name), _get(url))
+        fetched += 1
+    binary = os.path.join(vendor_dir, tailwind_binary_name())
+    if not os.path.exists(binary) and shutil.which("tailwindcss") is None:
+        url = (f"https://github.com/tailwindlabs/tailwindcss/releases/download/v{TAILWIND_VERSION}/"
+               f"{tailwind_binary_name()}")
+        print(f"⬇️ {url}")
+        _write(binary, _get(url))
+        os.chmod(binary, 0o755)
+        fetched += 1
+    return fetched
+
+
+def missing_vendor_files(vendor_dir=VENDOR_DIR):
+    return [name for name, _ in CDN_ASSETS.values() if not os.path.exists(os.path.join(vendor_dir, name))]
+
+
+# ================= 构建 =================
+def fingerprint(name, data):
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{hashlib.sha1(data).hexdigest()[:10]}{ext}"
+
+
+def purge_icons(css, html):
+    """Font Awesome 每个图标是一条 .fa-xxx:before{content:...}，只保留 index.html 用到的图标"""
+    used = set(re.findall(r"fa-[a-z0-9-]+", html))
+
+    def keep(m):
+        selectors = [_ICON_SELECTOR.fullmatch(s.strip()) for s in m.group(1).split(",")]
+        if all(selectors) and not any(s.group(1) in used for s in selectors):
+            return ""
+        return m.group(0)
+
+    return _ICON_RULE.sub(keep, css)
+
+
+def build_tailwind(html_path, vendor_dir=VENDOR_DIR):
+    """用 Tailwind CLI 扫描 index.html（包括 JS 里拼出来的 class），只生成用到的工具类"""
+    binary = shutil.which("tailwindcss") or os.path.join(vendor_dir, tailwind_binary_name())
+    if not os.path.exists(binary):
+        raise SystemExit(f"❌ 找不到 Tailwind CLI：先运行 python build_static.py --fetch，或把 tailwindcss 放进 PATH")
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, "input.css")
+        output = os.path.join(tmp, "tailwind.css")
+        with open(source, "w", encoding="utf-8") as f:
+            f.write("@tailwind base;\n@tailwind components;\n@tailwind utilities;\n")
+        subprocess.run([binary, "-i", source, "-o", output, "--content", html_path, "--minify"],
+                       check=True, capture_output=True)
+        with open(output, "rb") as f:
+            return f.read()
+
+
+class DistWriter:
+    """往 dist 目录写带哈希的文件和预压缩版本，记录 manifest"""
+
+    def __init__(self, dist_dir):
+        self.dist_dir = dist_dir
+        self.files = {}  # 原文件名 -> 带哈希的文件名
+        self.sizes = []  # (文件名, 原始, gzip, br)
+
+    def add(self, name, data, hashed=True):
+        if name in self.files:  # 同一个字体可能被多条 @font-face 引用
+            return STATIC_PREFIX + self.files[name]
+        out = fingerprint(name, data) if hashed else name
+        path = os.path.join(self.dist_dir, out)
+        _write(path, data)
+        gz = br = None
+        if out.endswith(COMPRESSIBLE):
+            gz = gzip.compress(data, 9, mtime=0)
+            _write(path + ".gz", gz)
+            if brotli is not None:
+                br = brotli.compress(data, quality=11)
+                _write(path + ".br", br)
+        self.files[name] = out
+        self.sizes.append((out, len(data), len(gz) if gz else None, len(br) if br else None))
+        return STATIC_PREFIX + out
+
+    def write_manifest(self):
+        manifest = {"files": sorted(self.files.values()), "sources": self.files}
+        _write(os.path.join(self.dist_dir, "manifest.json"), json.dumps(manifest, indent=2).encode("utf-8"))
+
+
+def build(vendor_dir=VENDOR_DIR, dist_dir=DIST_DIR, html_path=SOURCE_HTML):
+    with open(html_path, encoding="utf-8") as f:
+        html = f.read()
+    if os.path.isdir(dist_dir):
+        shutil.rmtree(dist_dir)
+    out = DistWriter(dist_dir)
+
+    def add_css(name, css):
+        # 先放 CSS 引用的字体，再把 url() 换成带哈希的路径（同一目录，用相对路径即可）
+        def rewrite(m):
+            ref = m.group(2)
+            if ref.startswith("data:"):
+                return m.group(0)
+            with open(os.path.join(vendor_dir, ref), "rb") as f:
+                return f"url({out.add(ref, f.read())[len(STATIC_PREFIX):]})"
+        return out.add(name, _CSS_URL.sub(rewrite, css).encode("utf-8"))
+
+    html = html.replace(TAILWIND_TAG, f'<link rel="stylesheet" href="{out.add("tailwind.css", build_tailwind(html_path, vendor_dir))}">')
+    for ref, (name, _) in CDN_ASSETS.items():
+        with open(os.path.join(vendor_dir, name), "rb") as f:
+            data = f.read()
+        if name.endswith(".css"):
+            css = data.decode("utf-8")
+            if name.startswith("fontawesome"):
+                css = purge_icons(css, html)
+            url = add_css(name, css)
+        else:
+            url = out.add(name, data)
+        html = html.replace(ref, url)
+    for name in LOCAL_FILES:
+        with open(os.path.join(BASE_DIR, name), "rb") as f:
+            html = html.replace(name, out.add(name, f.read()))
+
+    leftover = sorted(set(re.findall(r"https://[^\s\"'`)]+", html)))
+    if leftover:
+        print(f"⚠️ index.html 里还有外部引用（离线时不可用）: {leftover}")
+    out.add("index.html", html.encode("utf-8"), hashed=False)
+    out.write_manifest()
+    return out
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="构建离线可用、预压缩的前端静态资源")
+    parser.add_argument("--fetch", action="store_true", help="只下载第三方文件到 static/vendor")
+    parser.add_argument("--force", action="store_true", help="重新下载已有的第三方文件")
+    parser.add_argument("--offline", action="store_true", help="不联网，只用已下载的文件")
+    args = parser.parse_args(argv)
+
+    if not args.offline:
+        print(f"📦 下载了 {fetch(force=args.force)} 个第三方文件")
+        if args.fetch:
+            return
+    missing = missing_vendor_files()
+    if missing:
+        print(f"❌ static/vendor 缺少: {missing}（先在联网的机器上运行 python build_static.py --fetch）")
+        sys.exit(1)
+
+    out = build()
+    total = [0, 0, 0]
+    for name, raw, gz, br in out.sizes:
+        print(f"  {name:48s} {raw:>9,} B" + (f"  gz {gz:>8,}" if gz else "") + (f"  br {br:>8,}" if br else ""))
+        total[0] += raw
+        total[1] += gz or raw
+        total[2] += br or gz or raw
+    print(f"✅ 已生成 {len(out.sizes)} 个文件到 {DIST_DIR}：原始 {total[0]:,} B，gzip 后 {total[1]:,} B"
+          + (f"，brotli 后 {total[2]:,} B" if brotli is not None else "（未安装 brotli，只生成 .gz）"))
+
+
+if __name__ == "__main__":
+    main()
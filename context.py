@@ -0,0 +1,215 @@
+import re
+import asyncio
+
+from db import get_pool, run_db, try_lease, release_lease, WORKER_ID, CLEARED_UPTO
+
+# 可选依赖：装了 tiktoken 就精确计数，否则按字符估算
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:
+    _encoding = None
+
+# ================= 配置区 =================
+CONTEXT_TOKEN_BUDGET = 6000   # 整个 prompt 的 token 上限
+MEMORY_TOKEN_BUDGET = 800     # 其中长期记忆最多占多少
+SUMMARY_TOKEN_BUDGET = 600    # 其中早前对话摘要最多占多少
+MESSAGE_OVERHEAD = 4          # 每条消息的格式开销（role 等）
+SUMMARY_TRIGGER = 10          # 窗口之外累计多少条未摘要的消息时更新一次摘要
+SUMMARY_MAX_BATCH = 40        # 每次最多把多少条旧消息并入摘要
+SUMMARY_DELAY = 5.0           # 对话结束后多少秒检查是否需要更新摘要
+SUMMARY_LEASE_TTL = 300.0     # 摘要租约有效期：多 worker 时同一对话同时只有一个进程在更新摘要
+
+_CJK = re.compile(r"[\u3000-\u303f\u3400-\u9fff\uff00-\uffef]")
+
+
+# ================= token 计数 =================
+def count_tokens(text):
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    # 估算：中日文字符约 1 token/字，其余约 4 字符/token
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def truncate_to_tokens(text, budget):
+    """按行截断到 budget 以内（记忆/摘要都是一行一条），单行超长时再按字符截"""
+    if count_tokens(text) <= budget:
+        return text
+    kept, used = [], 0
+    for line in text.split("\n"):
+        cost = count_tokens(line) + 1
+        if used + cost > budget:
+            break
+        kept.append(line)
+        used += cost
+    if kept:
+        return "\n".join(kept)
+    # 第一行就超了：按比例截字符
+    ratio = budget / max(count_tokens(text), 1)
+    return text[:int(len(text) * ratio)]
+
+
+_SENTENCE_END = re.compile(r"(?<=[。！？；!?;\n])|(?<=\.)\s")
+
+
+def truncate_to_sentences(text, budget):
+    """在句子边界截断到 budget 以内，截掉了内容时末尾加省略号；第一句就超长时退回按字符截"""
+    if count_tokens(text) <= budget:
+        return text
+    kept, used = "", 0
+    for sentence in _SENTENCE_END.split(text):
+        cost = count_tokens(sentence)
+        if used + cost > budget:
+            break
+        kept += sentence
+        used += cost
+    if not kept.strip():
+        kept = truncate_to_tokens(text, budget - 1)
+    return kept.rstrip() + "…"
+
+
+# ================= 组装 prompt =================
+def assemble_messages(system_instruction, question, history, memory_context="", summary="",
+                      budget=CONTEXT_TOKEN_BUDGET):
+    """在 token 预算内组装消息列表
+
+    固定部分（系统指令、问题）先占预算；记忆和早前摘要按各自上限截断；
+    剩下的预算从最新的一轮往前装历史，装不下的最旧轮次直接丢弃（它们由滚动摘要覆盖）。
+    返回 (messages, 统计信息)。
+    """
+    memory_context = truncate_to_tokens(memory_context, MEMORY_TOKEN_BUDGET) if memory_context else ""
+    summary = truncate_to_tokens(summary, SUMMARY_TOKEN_BUDGET) if summary else ""
+
+    system_message = f"【系统指令】{system_instruction}"
+    if memory_context:
+        system_message += f"\n【记忆】{memory_context}"
+    if summary:
+        system_message += f"\n【早前对话摘要】{summary}"
+
+    fixed = count_tokens(system_message) + count_tokens(question) + 2 * MESSAGE_OVERHEAD
+    remaining = budget - fixed
+
+    # 从新到旧按“轮”装入，保证 user/assistant 成对
+    kept = []
+    i = len(history)
+    while i > 0:
+        j = i - 1
+        if history[j]["role"] == "assistant" and j > 0 and history[j - 1]["role"] == "user":
+            j -= 1
+        turn = history[j:i]
+        cost = sum(count_tokens(m["content"]) + MESSAGE_OVERHEAD for m in turn)
+        if cost > remaining:
+            break
+        kept[:0] = turn
+        remaining -= cost
+        i = j
+
+    messages = [{"role": "system", "content": system_message}]
+    messages.extend(kept)
+    messages.append({"role": "user", "content": question})
+    stats = {
+        "tokens": budget - remaining,
+        "history_kept": len(kept),
+        "history_dropped": len(history) - len(kept),
+    }
+    return messages, stats
+
+
+# ================= 滚动摘要 =================
+def get_history_summary(username, conv_id):
+    with get_pool().connection() as conn:
+        row = conn.execute("SELECT summary FROM history_summaries WHERE username=? AND conv_id=?",
+                           (username, conv_id)).fetchone()
+    return row[0] if row else ""
+
+
+def unsummarized_messages(username, conv_id, window, limit=SUMMARY_MAX_BATCH):
+    """返回 (该对话已有的摘要, 窗口之外还没并入摘要的旧消息 [(id, role, content)])"""
+    with get_pool().connection() as conn:
+        row = conn.execute("SELECT summary, upto_id FROM history_summaries WHERE username=? AND conv_id=?",
+                           (username, conv_id)).fetchone()
+        summary, upto_id = row if row else ("", 0)
+        # 清空过的历史（等待后台删除）不再进摘要
+        upto_id = max(upto_id, conn.execute(f"SELECT {CLEARED_UPTO}", (username,)).fetchone()[0])
+        # 最近 window 条留给原文历史，不进摘要
+        boundary = conn.execute(
+            "SELECT id FROM chat_history WHERE username=? AND conv_id=? ORDER BY id DESC LIMIT 1 OFFSET ?",
+            (username, conv_id, window - 1)).fetchone()
+        if boundary is None:
+            return summary, []
+        rows = conn.execute(
+            "SELECT id, role, content FROM chat_history WHERE username=? AND conv_id=? AND id>? AND id<? "
+            "ORDER BY id LIMIT ?", (username, conv_id, upto_id, boundary[0], limit)).fetchall()
+    return summary, rows
+
+
+def save_history_summary(username, conv_id, summary, upto_id):
+    with get_pool().connection() as conn:
+        conn.execute(
+            "INSERT INTO history_summaries (username, conv_id, summary, upto_id, updated_at) "
+            "VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP) "
+            "ON CONFLICT(username, conv_id) DO UPDATE SET summary=excluded.summary, upto_id=excluded.upto_id, "
+            "updated_at=CURRENT_TIMESTAMP",
+            (username, conv_id, summary, upto_id))
+        conn.commit()
+
+
+class HistorySummarizer:
+    """把滑出历史窗口的旧对话增量并入每个对话的滚动摘要
+
+    summarize 是 async def summarize(old_summary, messages) -> str，由 server.py 提供（调用 LLM）。
+    """
+
+    def __init__(self, summarize, window):
+        self.summarize = summarize
+        self.window = window
+        self._timers = {}
+        self._running = set()
+        self._tasks = set()
+
+    def schedule(self, username, conv_id, delay=SUMMARY_DELAY):
+        key = (username, conv_id)
+        if key in self._timers or key in self._running:
+            return
+        loop = asyncio.get_running_loop()
+        self._timers[key] = loop.call_later(delay, self._fire, key)
+
+    def _fire(self, key):
+        self._timers.pop(key, None)
+        task = asyncio.create_task(self.update(*key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def update(self, username, conv_id):
+        key = (username, conv_id)
+        self._running.add(key)
+        lease = f"summary:{username}:{conv_id}"
+        try:
+            if not await run_db(try_lease, lease, WORKER_ID, SUMMARY_LEASE_TTL):
+                return  # 其他 worker 正在更新，它会读到同样的旧消息
+            summary, rows = await run_db(unsummarized_messages, username, conv_id, self.window)
+            if len(rows) < SUMMARY_TRIGGER:
+                return
+            new_summary = await self.summarize(summary, [{"role": r, "content": c} for _, r, c in rows])
+            if new_summary:
+                await run_db(save_history_summary, username, conv_id, new_summary, rows[-1][0])
+                print(f"🗜️ 已将 {username}/{conv_id} 的 {len(rows)} 条旧消息并入摘要")
+        except Exception as e:
+            print(f"⚠️ 更新对话摘要失败 {username}/{conv_id}: {e}")
+        finally:
+            self._running.discard(key)
+            try:
+                await run_db(release_lease, lease, WORKER_ID)
+            except Exception:
+                pass  # 放不掉就等它过期
+
+    async def stop(self):
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
@@ -0,0 +1,900 @@
+import os
+import sqlite3
+import json
+import hashlib
+import uuid
+import queue
+import asyncio
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import observe
+
+# ================= 配置区 =================
+DB_FILE = "users.db"
+POOL_SIZE = 8            # 长连接池上限（同时也是 DB 线程池的线程数）
+BUSY_TIMEOUT_MS = 5000   # 写锁冲突时的等待时间
+STATEMENT_CACHE = 128    # 每个连接缓存的预编译语句数量
+FLUSH_INTERVAL_MS = 200  # 对话写入队列的最长攒批时间
+FLUSH_MAX_ROWS = 256     # 攒够这么多行立即提交
+RECENT_WINDOW = 40       # 每个活跃用户在内存里保留的最近消息条数
+RECENT_MAX_USERS = 2000  # 内存窗口最多覆盖的用户数（LRU 淘汰）
+USER_CACHE_SIZE = 5000   # 用户记录缓存条数
+USER_CACHE_TTL = 300     # 用户记录缓存有效期（秒）
+USER_VERSION_CHECK = 1.0 # 每隔多少秒检查一次库里的 users_version（跨进程失效）
+DEFAULT_CONV_ID = "conv_default"  # 注册时的第一个对话（也是多对话之前所有历史所在的对话）
+CONV_TITLE_CHARS = 40    # 没起标题的对话用第一句提问的前多少个字做标题
+
+# 本进程的标识（多进程部署时用于租约、发件箱领取等）
+WORKER_ID = f"{os.getpid()}-{time.time_ns()}"
+
+
+# ================= 连接池 =================
+class ConnectionPool:
+    """有界的 SQLite 长连接池
+
+    连接按需创建，最多 size 个；用完归还而不是关闭，
+    这样 sqlite3 模块在每个连接上缓存的预编译语句可以一直复用。
+    """
+
+    def __init__(self, path, size=POOL_SIZE):
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.path,
+            timeout=BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE,
+        )
+        # 只对新建的库生效（必须在切换 WAL 之前）：删除/归档腾出的页可以由 retention.py 增量回收
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        return conn
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                try:
+                    return self._connect()
+                except Exception:
+                    self._created -= 1
+                    raise
+        # 已达上限，等待其他线程归还
+        return self._idle.get()
+
+    @contextmanager
+    def connection(self):
+        conn = self._acquire()
+        try:
+            yield conn
+        except Exception:
+            # 出错时回滚未提交的事务，避免把脏连接放回池里
+            conn.rollback()
+            raise
+        finally:
+            self._idle.put(conn)
+
+    def close(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_executor = None
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(DB_FILE, POOL_SIZE)
+    return _pool
+
+
+def close_pool():
+    """关闭所有连接（进程退出或切换 DB_FILE 时调用）"""
+    global _pool, _executor
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _executor = None
+
+
+async def run_db(func, *args, **kwargs):
+    """在专用线程池里执行同步的数据库函数，不阻塞事件循环"""
+    global _executor
+    if _executor is None:
+        with _pool_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix="newton-db")
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, lambda: func(*args, **kwargs))
+
+
+# ================= 数据库 =================
+def _migrate_conversations(c):
+    """历史、摘要、归档、本地索引都改为按 (username, conv_id) 划分
+
+    已有的消息都归到 conv_default（也就是所有老用户的 current_conv_id）。
+    ALTER TABLE 不能重放，所以这条迁移是函数：init_db 拿到写锁后确认没人执行过才调用。
+    conversations.last_active 和标题（第一句提问）由 chat_history 上的触发器维护。
+    """
+    for table in ("chat_history", "archive_segments"):
+        if "conv_id" not in {row[1] for row in c.execute(f"PRAGMA table_info({table})")}:
+            c.execute(f"ALTER TABLE {table} ADD COLUMN conv_id TEXT NOT NULL DEFAULT '{DEFAULT_CONV_ID}'")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_chat_history_conv ON chat_history (username, conv_id, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_archive_segments_conv ON archive_segments (username, conv_id, last_id)")
+    c.execute("""CREATE TABLE IF NOT EXISTS conversations (
+        username TEXT,
+        conv_id TEXT,
+        title TEXT,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        last_active DATETIME DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (username, conv_id)
+    )""")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_conversations_active ON conversations (username, last_active)")
+    c.execute(f"""INSERT OR IGNORE INTO conversations (username, conv_id, title, created_at, last_active)
+        SELECT username, conv_id,
+            (SELECT substr(content, 1, {CONV_TITLE_CHARS}) FROM chat_history f
+             WHERE f.username = h.username AND f.conv_id = h.conv_id AND f.role = 'user' ORDER BY f.id LIMIT 1),
+            MIN(timestamp), MAX(timestamp)
+        FROM chat_history h GROUP BY username, conv_id""")
+    c.execute("INSERT OR IGNORE INTO conversations (username, conv_id) "
+              f"SELECT username, COALESCE(current_conv_id, '{DEFAULT_CONV_ID}') FROM users")
+    c.execute(f"""CREATE TRIGGER IF NOT EXISTS conversations_ins AFTER INSERT ON chat_history BEGIN
+        INSERT INTO conversations (username, conv_id, title, last_active)
+            VALUES (NEW.username, NEW.conv_id,
+                    CASE WHEN NEW.role = 'user' THEN substr(NEW.content, 1, {CONV_TITLE_CHARS}) END, NEW.timestamp)
+            ON CONFLICT(username, conv_id) DO UPDATE SET last_active = excluded.last_active,
+                title = COALESCE(conversations.title, excluded.title);
+    END""")
+    # 滚动摘要改为每个对话一份（主键变了，只能重建表）
+    c.execute("""CREATE TABLE IF NOT EXISTS history_summaries_v2 (
+        username TEXT,
+        conv_id TEXT,
+        summary TEXT,
+        upto_id INTEGER DEFAULT 0,
+        updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (username, conv_id)
+    )""")
+    c.execute("INSERT OR IGNORE INTO history_summaries_v2 (username, conv_id, summary, upto_id, updated_at) "
+              f"SELECT username, '{DEFAULT_CONV_ID}', summary, upto_id, updated_at FROM history_summaries")
+    c.execute("DROP TABLE history_summaries")
+    c.execute("ALTER TABLE history_summaries_v2 RENAME TO history_summaries")
+    # 本地索引的 owner 改为 (用户, 对话) 的哈希：清空后由 local_recall.catch_up 在后台重建
+    c.execute("DELETE FROM chat_fts")
+    c.execute("UPDATE meta SET value=0 WHERE key='fts_upto'")
+
+
+def _migrate_archived_stats(c):
+    """归档只是把消息从热表搬进文件，user_stats 的消息数 / 字数不该因此减少
+
+    retention.archive_conversation 在删除热表之前把 meta.archiving 置 1（同一个写事务里，
+    别的连接看不到），user_stats_del 触发器据此跳过；archive_segments.chars 记下每段的字数，
+    清空历史删掉归档段时再从统计里扣掉。本迁移之前归档的段 chars 为空：它们当时已经被扣掉了，不再重复扣。
+    """
+    if "chars" not in {row[1] for row in c.execute("PRAGMA table_info(archive_segments)")}:
+        c.execute("ALTER TABLE archive_segments ADD COLUMN chars INTEGER")
+    c.execute("INSERT OR IGNORE INTO meta VALUES ('archiving', 0)")
+    c.execute("DROP TRIGGER IF EXISTS user_stats_del")
+    c.execute("""CREATE TRIGGER user_stats_del AFTER DELETE ON chat_history
+        WHEN (SELECT value FROM meta WHERE key = 'archiving') = 0 BEGIN
+        UPDATE user_stats SET messages = messages - 1, chars = chars - LENGTH(OLD.content)
+            WHERE username = OLD.username;
+        UPDATE meta SET value = value + 1 WHERE key = 'history_version';
+    END""")
+
+
+
+# 结构迁移：按顺序执行，PRAGMA user_version 记录已执行到第几条
+MIGRATIONS = [
+    # 1: 按用户倒序取历史 / keyset 分页用的复合索引
+    "CREATE INDEX IF NOT EXISTS idx_chat_history_user_id ON chat_history (username, id)",
+    # 2: users 表的版本号。任何进程（包括 admin.py）改动 users 都会由触发器自增，
+    #    各进程据此让自己的用户缓存失效
+    """CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER);
+    INSERT OR IGNORE INTO meta VALUES ('users_version', 0);
+    CREATE TRIGGER IF NOT EXISTS users_version_ins AFTER INSERT ON users
+        BEGIN UPDATE meta SET value = value + 1 WHERE key = 'users_version'; END;
+    CREATE TRIGGER IF NOT EXISTS users_version_upd AFTER UPDATE ON users
+        BEGIN UPDATE meta SET value = value + 1 WHERE key = 'users_version'; END;
+    CREATE TRIGGER IF NOT EXISTS users_version_del AFTER DELETE ON users
+        BEGIN UPDATE meta SET value = value + 1 WHERE key = 'users_version'; END""",
+    # 3: 写给 MemOS 的持久化发件箱，由 outbox.OutboxWorker 在后台投递
+    """CREATE TABLE IF NOT EXISTS memos_outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT,
+        memos_user_id TEXT,
+        conv_id TEXT,
+        messages TEXT,
+        status TEXT DEFAULT 'pending',
+        attempts INTEGER DEFAULT 0,
+        next_attempt_at REAL DEFAULT 0,
+        lease_until REAL DEFAULT 0,
+        claimed_by TEXT,
+        last_error TEXT,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS idx_memos_outbox_status ON memos_outbox (status, id)""",
+    # 4: 预生成的登录问候（greetings.GreetingService 在对话结束后刷新）
+    """CREATE TABLE IF NOT EXISTS greetings (
+        username TEXT PRIMARY KEY,
+        greeting TEXT,
+        version INTEGER DEFAULT 1,
+        history_id INTEGER DEFAULT 0,
+        updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )""",
+    # 5: 每个用户滑出历史窗口的旧对话的滚动摘要（context.HistorySummarizer 增量更新）
+    """CREATE TABLE IF NOT EXISTS history_summaries (
+        username TEXT PRIMARY KEY,
+        summary TEXT,
+        upto_id INTEGER DEFAULT 0,
+        updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )""",
+    # 6: 跨进程租约（多 worker 部署时的每用户并发上限、单例后台任务等）
+    """CREATE TABLE IF NOT EXISTS leases (
+        name TEXT PRIMARY KEY,
+        holder TEXT,
+        expires_at REAL
+    )""",
+    # 7: 每用户的消息数 / 字数 / 最后活跃时间，由 chat_history 上的触发器维护，管理面板直接分页读取；
+    #    history_version 在删除对话时自增（新增对话看 MAX(id) 即可），管理面板据此让缓存失效
+    """CREATE TABLE IF NOT EXISTS user_stats (
+        username TEXT PRIMARY KEY,
+        messages INTEGER DEFAULT 0,
+        chars INTEGER DEFAULT 0,
+        last_active DATETIME
+    );
+    INSERT OR REPLACE INTO user_stats (username, messages, chars, last_active)
+        SELECT username, COUNT(*), COALESCE(SUM(LENGTH(content)), 0), MAX(timestamp)
+        FROM chat_history GROUP BY username;
+    CREATE INDEX IF NOT EXISTS idx_user_stats_active ON user_stats (last_active);
+    INSERT OR IGNORE INTO meta VALUES ('history_version', 0);
+    CREATE TRIGGER IF NOT EXISTS user_stats_ins AFTER INSERT ON chat_history BEGIN
+        INSERT INTO user_stats (username, messages, chars, last_active)
+            VALUES (NEW.username, 1, LENGTH(NEW.content), NEW.timestamp)
+            ON CONFLICT(username) DO UPDATE SET messages = messages + 1, chars = chars + excluded.chars,
+                last_active = excluded.last_active;
+    END;
+    CREATE TRIGGER IF NOT EXISTS user_stats_del AFTER DELETE ON chat_history BEGIN
+        UPDATE user_stats SET messages = messages - 1, chars = chars - LENGTH(OLD.content)
+            WHERE username = OLD.username;
+        UPDATE meta SET value = value + 1 WHERE key = 'history_version';
+    END""",
+    # 8: 本地召回用的全文索引（local_recall.py）。分词在 Python 里做好再写入 terms，
+    #    owner 是用户名的哈希；fts_upto 记录已建索引的最大 chat_history.id，删除对话时同步删索引
+    """CREATE VIRTUAL TABLE IF NOT EXISTS chat_fts USING fts5(owner, terms, tokenize="unicode61 tokenchars '_'");
+    INSERT OR IGNORE INTO meta VALUES ('fts_upto', 0);
+    CREATE TRIGGER IF NOT EXISTS chat_fts_del AFTER DELETE ON chat_history BEGIN
+        DELETE FROM chat_fts WHERE rowid = OLD.id;
+    END""",
+    # 9: 冷热分层（retention.py）。清空历史只记下水位 history_clears.upto_id，读取时过滤，
+    #    后台再分批真正删除；旧对话归档成压缩文件，archive_segments 是文件索引
+    """CREATE TABLE IF NOT EXISTS history_clears (username TEXT PRIMARY KEY, upto_id INTEGER);
+    CREATE TABLE IF NOT EXISTS archive_segments (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT,
+        first_id INTEGER,
+        last_id INTEGER,
+        first_ts DATETIME,
+        last_ts DATETIME,
+        rows INTEGER,
+        bytes INTEGER,
+        path TEXT,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS idx_archive_segments_user ON archive_segments (username, last_id)""",
+    # 10: 每个用户可以有多个对话，见 _migrate_conversations
+    _migrate_conversations,
+    # 11: 发件箱按用户找“队头”（claim_batch 里的 NOT EXISTS）用的索引
+    "CREATE INDEX IF NOT EXISTS idx_memos_outbox_user ON memos_outbox (username, id)",
+    # 12: 用户被删除（可能是 admin.py 在另一个进程里删的）之后，服务端还在路上的写入
+    #    （写入队列、问候、摘要、发件箱）直接丢弃，不会留给之后同名注册的新账号
+    """CREATE TRIGGER IF NOT EXISTS chat_history_user_guard BEFORE INSERT ON chat_history
+        WHEN NOT EXISTS (SELECT 1 FROM users WHERE username = NEW.username) BEGIN SELECT RAISE(IGNORE); END;
+    CREATE TRIGGER IF NOT EXISTS memos_outbox_user_guard BEFORE INSERT ON memos_outbox
+        WHEN NOT EXISTS (SELECT 1 FROM users WHERE username = NEW.username) BEGIN SELECT RAISE(IGNORE); END;
+    CREATE TRIGGER IF NOT EXISTS greetings_user_guard BEFORE INSERT ON greetings
+        WHEN NOT EXISTS (SELECT 1 FROM users WHERE username = NEW.username) BEGIN SELECT RAISE(IGNORE); END;
+    CREATE TRIGGER IF NOT EXISTS history_summaries_user_guard BEFORE INSERT ON history_summaries
+        WHEN NOT EXISTS (SELECT 1 FROM users WHERE username = NEW.username) BEGIN SELECT RAISE(IGNORE); END""",
+    # 13: 归档不减少 user_stats 的消息数 / 字数，见 _migrate_archived_stats
+    _migrate_archived_stats,
+]
+
+
+
+# 已清空（等待后台删除）的水位，拼在按用户查询 chat_history 的 WHERE 里：id > CLEARED_UPTO（参数为用户名）
+CLEARED_UPTO = "(SELECT COALESCE(MAX(upto_id), 0) FROM history_clears WHERE username=?)"
+# 按 username 关联的全部表，删除用户时逐一清理（新增带 username 的表要加到这里）；
+# chat_history 要在 user_stats 之前删，触发器会更新统计和全文索引
+USER_TABLES = ("chat_history", "archive_segments", "history_clears", "history_summaries", "conversations",
+               "greetings", "memos_outbox", "user_stats")
+
+
+def init_db():
+    with get_pool().connection() as conn:
+        c = conn.cursor()
+        c.execute(
+            '''CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, password_hash TEXT, memos_user_id TEXT, current_conv_id TEXT)''')
+        # 对话历史表
+        c.execute(
+            '''CREATE TABLE IF NOT EXISTS chat_history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT,
+                role TEXT,
+                content TEXT,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+            )''')
+        conn.commit()
+
+        # 迁移脚本都是幂等的，并且在 IMMEDIATE 事务里执行：
+        # 多个进程同时启动时也只会有一个真正执行，其余的重放一遍无副作用
+        version = c.execute("PRAGMA user_version").fetchone()[0]
+        for i, sql in enumerate(MIGRATIONS[version:], start=version + 1):
+            if callable(sql):
+                # 不能重放的迁移：拿到写锁后再确认一次版本
+                c.execute("BEGIN IMMEDIATE")
+                if c.execute("PRAGMA user_version").fetchone()[0] < i:
+                    sql(c)
+                    c.execute(f"PRAGMA user_version={i}")
+                conn.commit()
+            else:
+                c.executescript(f"BEGIN IMMEDIATE; {sql}; PRAGMA user_version={i}; COMMIT;")
+            print(f"🛠️ 数据库迁移到版本 {i}")
+
+
+# ================= 跨进程共享状态 =================
+def read_meta(key):
+    with get_pool().connection() as conn:
+        row = conn.execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+    return row[0] if row else 0
+
+
+def bump_meta(key):
+    """把 meta 里的计数器加一（不存在时创建），其他进程据此让本地缓存失效"""
+    with get_pool().connection() as conn:
+        conn.execute("INSERT INTO meta (key, value) VALUES (?, 1) "
+                     "ON CONFLICT(key) DO UPDATE SET value = value + 1", (key,))
+        conn.commit()
+
+
+def try_lease(name, holder, ttl):
+    """尝试拿到名为 name 的租约：没人持有、已过期或本来就是自己持有时成功（并续期）"""
+    now = time.time()
+    with get_pool().connection() as conn:
+        cur = conn.execute(
+            "INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET holder=excluded.holder, expires_at=excluded.expires_at "
+            "WHERE leases.expires_at < ? OR leases.holder = excluded.holder",
+            (name, holder, now + ttl, now))
+        conn.commit()
+        return cur.rowcount == 1
+
+
+def release_lease(name, holder):
+    with get_pool().connection() as conn:
+        conn.execute("DELETE FROM leases WHERE name=? AND holder=?", (name, holder))
+        conn.commit()
+
+
+# ================= 用户记录缓存 =================
+class UserCache:
+    """带 TTL 的 LRU 用户记录缓存（也缓存“用户不存在”）
+
+    本进程内的写入直接调用 invalidate；其他进程的改动通过 meta.users_version 发现，
+    最多延迟 USER_VERSION_CHECK 秒。
+    """
+
+    _MISSING = object()
+
+    def __init__(self, maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items = OrderedDict()  # username -> (expires_at, row)
+        self._lock = threading.Lock()
+        self._gen = 0
+        self._version = None
+        self._checked_at = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, username):
+        now = time.monotonic()
+        with self._lock:
+            item = self._items.get(username)
+            if item is not None and item[0] > now:
+                self._items.move_to_end(username)
+                self.hits += 1
+                return item[1]
+            if item is not None:
+                del self._items[username]
+            self.misses += 1
+            return self._MISSING
+
+    def begin_load(self):
+        with self._lock:
+            return self._gen
+
+    def put(self, username, row, token):
+        with self._lock:
+            if self._gen != token:
+                return
+            self._items[username] = (time.monotonic() + self.ttl, row)
+            self._items.move_to_end(username)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def invalidate(self, username=None):
+        with self._lock:
+            self._gen += 1
+            self.invalidations += 1
+            if username is None:
+                self._items.clear()
+            else:
+                self._items.pop(username, None)
+
+    def sync_version(self, read_version):
+        """按间隔调用 read_version() 读取库里的 users_version，变了就清空缓存"""
+        now = time.monotonic()
+        if now - self._checked_at < USER_VERSION_CHECK:
+            return
+        self._checked_at = now
+        version = read_version()
+        if version != self._version:
+            if self._version is not None:
+                self.invalidate()
+            self._version = version
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._items),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "invalidations": self.invalidations,
+            }
+
+
+user_cache = UserCache()
+
+
+def _read_users_version():
+    with get_pool().connection() as conn:
+        row = conn.execute("SELECT value FROM meta WHERE key='users_version'").fetchone()
+    return row[0] if row else None
+
+
+def get_user(username):
+    user_cache.sync_version(_read_users_version)
+    user = user_cache.get(username)
+    if user is not UserCache._MISSING:
+        return user
+    token = user_cache.begin_load()
+    with get_pool().connection() as conn:
+        user = conn.execute("SELECT * FROM users WHERE username=?", (username,)).fetchone()
+    user_cache.put(username, user, token)
+    return user
+
+
+def create_user(username, password):
+    memos_uid = f"user_{username}_{str(uuid.uuid4())[:8]}"
+    pwd_hash = hashlib.sha256(password.encode()).hexdigest()
+    with get_pool().connection() as conn:
+        # INSERT OR IGNORE 让“检查是否存在 + 插入”成为一条原子语句
+        cur = conn.execute("INSERT OR IGNORE INTO users VALUES (?, ?, ?, ?)",
+                           (username, pwd_hash, memos_uid, DEFAULT_CONV_ID))
+        if cur.rowcount == 1:
+            conn.execute("INSERT OR IGNORE INTO conversations (username, conv_id) VALUES (?, ?)",
+                         (username, DEFAULT_CONV_ID))
+        conn.commit()
+    user_cache.invalidate(username)
+    if cur.rowcount == 1:
+        # 注册成功说明这个用户名之前不存在：本进程里按用户名留下的状态（最近消息窗口、排队的写入）
+        # 只可能属于被 admin.py 删掉的同名旧账号，不能带进新账号的 prompt
+        recent_history.forget(username)
+        chat_writer.drop(username)
+    return cur.rowcount == 1
+
+
+def verify_user(username, password):
+    user = get_user(username)
+    if not user: return False
+    return user[1] == hashlib.sha256(password.encode()).hexdigest()
+
+
+# ================= 多对话 =================
+# 当前对话记在 users.current_conv_id：/chat 的历史、摘要、本地召回和 MemOS 检索/写入都按它划分
+def create_conversation(username, title=None):
+    """新建一个对话并切换过去，返回 conv_id"""
+    conv_id = f"conv_{uuid.uuid4().hex[:12]}"
+    with get_pool().connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("INSERT INTO conversations (username, conv_id, title) VALUES (?, ?, ?)",
+                     (username, conv_id, title[:CONV_TITLE_CHARS] if title else None))
+        conn.execute("UPDATE users SET current_conv_id=? WHERE username=?", (conv_id, username))
+        conn.commit()
+    user_cache.invalidate(username)
+    return conv_id
+
+
+def switch_conversation(username, conv_id):
+    """切换到该用户已有的对话，对话不存在时返回 False"""
+    with get_pool().connection() as conn:
+        cur = conn.execute(
+            "UPDATE users SET current_conv_id=? WHERE username=? "
+            "AND EXISTS (SELECT 1 FROM conversations WHERE username=? AND conv_id=?)",
+            (conv_id, username, username, conv_id))
+        conn.commit()
+    user_cache.invalidate(username)
+    return cur.rowcount == 1
+
+
+def list_conversations(username, limit=50):
+    """最近活跃的在前，走 (username, last_active) 索引"""
+    with get_pool().connection() as conn:
+        rows = conn.execute(
+            "SELECT conv_id, title, created_at, last_active FROM conversations WHERE username=? "
+            "ORDER BY last_active DESC LIMIT ?", (username, limit)).fetchall()
+    return [{"conv_id": c, "title": t, "created_at": ca, "last_active": la} for c, t, ca, la in rows]
+
+
+# ================= 对话写入队列 (write-behind) =================
+class ChatWriter:
+    """把所有会话的对话消息攒成一批，在一个事务里提交（group commit）
+
+    每 FLUSH_INTERVAL_MS 毫秒或攒够 FLUSH_MAX_ROWS 行提交一次，
+    一批只有一次 fsync。还没落盘的消息可以通过 read_consistent 读到（read-your-writes）。
+    同一轮对话要写给 MemOS 的发件箱记录也在同一个事务里落盘。
+
+    _gen 是一个顺序锁计数器：提交开始和结束时各加一，奇数表示正在提交。
+    读者在 _gen 为偶数且读库前后不变时，才能保证“库里的行”和“队列里的行”不重不漏。
+    """
+
+    def __init__(self, interval_ms=FLUSH_INTERVAL_MS, max_rows=FLUSH_MAX_ROWS):
+        self.interval = interval_ms / 1000
+        self.max_rows = max_rows
+        self._pending = []         # [(username, conv_id, role, content)]
+        self._pending_outbox = []  # [(username, memos_user_id, conv_id, messages_json)]
+        self._gen = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        self._listeners = []
+        self._batch_hooks = []
+
+    def add_listener(self, func):
+        """注册提交成功后的回调 func(写入的发件箱条数)，在写入线程里调用"""
+        self._listeners.append(func)
+
+    def add_batch_hook(self, func):
+        """注册 func(conn)：每批消息插入后、提交前在同一个事务里调用（如更新本地全文索引）
+
+        hook 出错只回滚它自己的改动，对话照常提交。
+        """
+        self._batch_hooks.append(func)
+
+    def submit(self, username, conv_id, messages, outbox=None):
+        """入队一组消息 [(role, content), ...]，同一组保证在同一个事务里提交
+
+        outbox 为 (memos_user_id, conv_id, messages_json) 时同时写一条 MemOS 发件箱记录。
+        """
+        with self._cond:
+            if self._thread is None:
+                self._start()
+            self._pending.extend((username, conv_id, role, content) for role, content in messages)
+            if outbox is not None:
+                self._pending_outbox.append((username,) + tuple(outbox))
+            if len(self._pending) >= self.max_rows:
+                self._cond.notify_all()
+
+    def _start(self):
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="newton-chat-writer", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._stopping or len(self._pending) >= self.max_rows,
+                                    timeout=self.interval)
+                stopping = self._stopping
+            self.flush()
+            if stopping:
+                return
+
+    def flush(self):
+        """立即提交当前队列里的全部消息"""
+        with self._cond:
+            self._cond.wait_for(lambda: self._gen % 2 == 0)
+            if not self._pending and not self._pending_outbox:
+                return 0
+            batch, self._pending = self._pending, []
+            outbox, self._pending_outbox = self._pending_outbox, []
+            self._gen += 1
+        start = time.perf_counter()
+        try:
+            with get_pool().connection() as conn:
+                conn.executemany(
+                    "INSERT INTO chat_history (username, conv_id, role, content) VALUES (?, ?, ?, ?)", batch)
+                conn.executemany(
+                    "INSERT INTO memos_outbox (username, memos_user_id, conv_id, messages) VALUES (?, ?, ?, ?)",
+                    outbox)
+                for hook in self._batch_hooks:
+                    conn.execute("SAVEPOINT batch_hook")
+                    try:
+                        hook(conn)
+                        conn.execute("RELEASE batch_hook")
+                    except Exception as e:
+                        conn.execute("ROLLBACK TO batch_hook")
+                        conn.execute("RELEASE batch_hook")
+                        print(f"⚠️ 写入批次的附加处理失败（对话照常提交）: {e}")
+                conn.commit()
+        except Exception as e:
+            print(f"❌ 对话批量写入失败，稍后重试: {e}")
+            with self._cond:
+                self._pending[:0] = batch
+                self._pending_outbox[:0] = outbox
+                self._gen += 1
+                self._cond.notify_all()
+            time.sleep(self.interval)
+            return 0
+        observe("db_write", time.perf_counter() - start)
+        with self._cond:
+            self._gen += 1
+            self._cond.notify_all()
+        if outbox:
+            for func in self._listeners:
+                func(len(outbox))
+        return len(batch)
+
+    def read_consistent(self, username, conv_id, read_db):
+        """执行 read_db()，并返回 (库里的结果, 该对话尚未落盘的消息)，两者之间不重不漏"""
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._gen % 2 == 0)
+                gen = self._gen
+                pending = [(role, content) for u, c, role, content in self._pending if u == username and c == conv_id]
+            rows = read_db()
+            with self._cond:
+                if self._gen == gen:
+                    return rows, pending
+
+    def drop(self, username):
+        """丢弃该用户排队中的全部写入（包括发件箱记录）：同名账号被删除后又重新注册时调用"""
+        with self._cond:
+            self._cond.wait_for(lambda: self._gen % 2 == 0)
+            self._pending = [m for m in self._pending if m[0] != username]
+            self._pending_outbox = [o for o in self._pending_outbox if o[0] != username]
+
+    def discard(self, username, delete_db):
+        """丢弃该用户排队中的消息，并执行 delete_db()（清空历史用；发件箱记录保留）"""
+        with self._cond:
+            self._cond.wait_for(lambda: self._gen % 2 == 0)
+            self._pending = [m for m in self._pending if m[0] != username]
+        delete_db()
+
+    def stop(self):
+        """停止后台线程，并把剩余消息全部落盘（进程退出前调用）"""
+        with self._cond:
+            thread = self._thread
+            self._stopping = True
+            self._cond.notify_all()
+        if thread is not None:
+            thread.join()
+        self._thread = None
+        self.flush()
+
+
+chat_writer = ChatWriter()
+
+
+# ================= 最近消息窗口 =================
+class RecentHistory:
+    """每个活跃对话最近 RECENT_WINDOW 条消息的环形缓冲，键为 (username, conv_id)
+
+    写入时同步追加，所以 /chat 取历史时通常不用碰 SQLite。
+    只有已经完整加载过的对话才会被追加；加载期间如果有写入，这次加载作废，下次再从库里读。
+    """
+
+    def __init__(self, window=RECENT_WINDOW, max_users=RECENT_MAX_USERS):
+        self.window = window
+        self.max_users = max_users
+        # 多 worker 部署时关闭：其他进程的写入不会追加到本进程的窗口里
+        self.enabled = True
+        self._users = OrderedDict()  # (username, conv_id) -> deque[(role, content)]
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, limit):
+        if not self.enabled or limit > self.window:
+            return None
+        with self._lock:
+            buf = self._users.get(key)
+            if buf is None:
+                return None
+            self._users.move_to_end(key)
+            return list(buf)[-limit:] if limit else []
+
+    def begin_load(self):
+        with self._lock:
+            return self._writes
+
+    def fill(self, key, messages, token):
+        with self._lock:
+            if not self.enabled or self._writes != token:
+                return
+            self._users[key] = deque(messages[-self.window:], maxlen=self.window)
+            self._users.move_to_end(key)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+
+    def append(self, key, messages):
+        with self._lock:
+            self._writes += 1
+            buf = self._users.get(key)
+            if buf is not None:
+                buf.extend(messages)
+
+    def forget(self, username):
+        """移除该用户所有对话的窗口（之后从库里重新加载）"""
+        with self._lock:
+            self._writes += 1
+            for key in [k for k in self._users if k[0] == username]:
+                del self._users[key]
+
+    def reset(self, username):
+        """清空该用户所有对话的窗口"""
+        with self._lock:
+            self._writes += 1
+            for key in self._users:
+                if key[0] == username:
+                    self._users[key] = deque(maxlen=self.window)
+
+
+recent_history = RecentHistory()
+
+
+# 对话历史管理函数
+def get_chat_history(username, conv_id, limit=10):
+    """获取该对话最近的历史（包含写入队列里还没落盘的消息）"""
+    key = (username, conv_id)
+    cached = recent_history.get(key, limit)
+    if cached is not None:
+        return [{"role": role, "content": content} for role, content in cached]
+
+    # 未命中：按窗口大小读一次库，顺便把窗口填上
+    n = max(limit, recent_history.window)
+    token = recent_history.begin_load()
+
+    def read_db():
+        with get_pool().connection() as conn:
+            return conn.execute(
+                f"SELECT role, content FROM chat_history WHERE username=? AND conv_id=? AND id > {CLEARED_UPTO} "
+                "ORDER BY id DESC LIMIT ?",
+                (username, conv_id, username, n)
+            ).fetchall()
+
+    rows, pending = chat_writer.read_consistent(username, conv_id, read_db)
+    # 反转顺序（从旧到新），再接上排队中的消息
+    merged = list(reversed(rows)) + pending
+    recent_history.fill(key, merged, token)
+    return [{"role": role, "content": content} for role, content in merged[-limit:]] if limit else []
+
+
+def get_chat_page(username, conv_id, before_id=None, limit=50):
+    """keyset 分页读取历史：返回 before_id 之前（更旧）的 limit 条，按从旧到新排列
+
+    返回 (messages, next_before)，next_before 为 None 表示热表已经到头。
+    走 (username, conv_id, id) 索引，翻到多深都不需要 OFFSET 扫描。
+    最新一页（before_id 为 None）末尾接上写入队列里还没落盘的消息，它们的 id 为 None。
+    """
+    def read_db():
+        with get_pool().connection() as conn:
+            if before_id is None:
+                return conn.execute(
+                    "SELECT id, role, content, timestamp FROM chat_history WHERE username=? AND conv_id=? "
+                    f"AND id > {CLEARED_UPTO} ORDER BY id DESC LIMIT ?",
+                    (username, conv_id, username, limit + 1)).fetchall()
+            return conn.execute(
+                "SELECT id, role, content, timestamp FROM chat_history WHERE username=? AND conv_id=? "
+                f"AND id > {CLEARED_UPTO} AND id<? ORDER BY id DESC LIMIT ?",
+                (username, conv_id, username, before_id, limit + 1)).fetchall()
+
+    if before_id is None:
+        rows, pending = chat_writer.read_consistent(username, conv_id, read_db)
+    else:
+        rows, pending = read_db(), []
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    messages = [{"id": i, "role": role, "content": content, "timestamp": ts}
+                for i, role, content, ts in reversed(rows)]
+    messages.extend({"id": None, "role": role, "content": content, "timestamp": None} for role, content in pending)
+    next_before = rows[-1][0] if has_more else None
+    return messages, next_before
+
+
+def queue_chat_messages(username, conv_id, messages, memos_uid=None):
+    """把一轮对话 [(role, content), ...] 放入写入队列，由后台线程批量提交
+
+    memos_uid 不为 None 时，这轮对话同时进入 MemOS 发件箱（写到同一个 conv_id）。
+    """
+    outbox = None
+    if memos_uid is not None:
+        payload = json.dumps([{"role": role, "content": content} for role, content in messages], ensure_ascii=False)
+        outbox = (memos_uid, conv_id, payload)
+    chat_writer.submit(username, conv_id, messages, outbox)
+    recent_history.append((username, conv_id), messages)
+
+
+def save_chat_message(username, conv_id, role, content):
+    """保存单条对话消息"""
+    with get_pool().connection() as conn:
+        conn.execute(
+            "INSERT INTO chat_history (username, conv_id, role, content) VALUES (?, ?, ?, ?)",
+            (username, conv_id, role, content)
+        )
+        conn.commit()
+    recent_history.append((username, conv_id), [(role, content)])
+
+
+def clear_chat_history(username):
+    """清除用户所有对话的历史（包括还在写入队列里的），对话列表本身保留
+
+    只记下清空水位，所有读取立即看不到这些消息；真正的删除（连同归档文件）由 retention.py 在后台分批完成，
+    历史再长也不会长时间占住写锁。
+    """
+    def delete_db():
+        with get_pool().connection() as conn:
+            conn.execute(
+                "INSERT INTO history_clears (username, upto_id) "
+                "VALUES (?, (SELECT COALESCE(MAX(id), 0) FROM chat_history WHERE username=?)) "
+                "ON CONFLICT(username) DO UPDATE SET upto_id=MAX(upto_id, excluded.upto_id)",
+                (username, username))
+            conn.execute("DELETE FROM history_summaries WHERE username=?", (username,))
+            conn.commit()
+
+    chat_writer.discard(username, delete_db)
+    recent_history.reset(username)
+
+
+def delete_user(conn, username):
+    """在调用方的事务里删除用户及其全部数据（对话、归档索引、摘要、问候、待投递的记忆、统计）
+
+    返回该用户的归档文件路径，由调用方在提交之后删除；否则同名重新注册的用户会从归档里读到旧对话。
+    users 表上的触发器会自增 users_version，服务端的用户缓存随之失效。
+    """
+    paths = [path for (path,) in conn.execute("SELECT path FROM archive_segments WHERE username=?", (username,))]
+    for table in USER_TABLES:
+        conn.execute(f"DELETE FROM {table} WHERE username=?", (username,))
+    conn.execute("DELETE FROM users WHERE username=?", (username,))
+    return paths
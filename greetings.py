@@ -0,0 +1,128 @@
+import asyncio
+
+from db import get_pool, run_db, try_lease, release_lease, WORKER_ID
+
+# ================= 配置区 =================
+GREETING_REFRESH_DELAY = 90.0    # 最后一轮对话结束多少秒后重新生成问候（等记忆写入 MemOS）
+GREETING_SWEEP_INTERVAL = 600.0  # 定时巡检间隔：补上因重启等原因漏掉的刷新
+GREETING_SWEEP_BATCH = 20
+GREETING_CONCURRENCY = 2         # 同时在生成的问候数，避免和 /chat 抢上游配额
+GREETING_LEASE_TTL = 120.0       # 每用户生成租约的有效期：多 worker 时同一用户只由一个进程生成
+
+
+# ================= 问候表操作 =================
+def get_greeting(username):
+    """返回 (greeting, version)，没有时返回 None"""
+    with get_pool().connection() as conn:
+        return conn.execute("SELECT greeting, version FROM greetings WHERE username=?", (username,)).fetchone()
+
+
+def save_greeting(username, greeting):
+    """保存新问候，版本号自增；同时记下生成时该用户最新的对话 id，用于判断是否过期"""
+    with get_pool().connection() as conn:
+        row = conn.execute("SELECT MAX(id) FROM chat_history WHERE username=?", (username,)).fetchone()
+        conn.execute(
+            "INSERT INTO greetings (username, greeting, version, history_id, updated_at) "
+            "VALUES (?, ?, 1, ?, CURRENT_TIMESTAMP) "
+            "ON CONFLICT(username) DO UPDATE SET greeting=excluded.greeting, version=greetings.version + 1, "
+            "history_id=excluded.history_id, updated_at=CURRENT_TIMESTAMP",
+            (username, greeting, row[0] or 0))
+        conn.commit()
+
+
+def greeting_is_fresh(username):
+    """问候生成之后没有新对话（例如另一个 worker 刚为同一用户生成过）"""
+    with get_pool().connection() as conn:
+        row = conn.execute(
+            "SELECT g.history_id >= COALESCE((SELECT MAX(h.id) FROM chat_history h WHERE h.username = g.username), 0) "
+            "FROM greetings g WHERE g.username=?", (username,)).fetchone()
+    return bool(row and row[0])
+
+
+def stale_greeting_users(limit=GREETING_SWEEP_BATCH):
+    """生成问候之后又有新对话的用户"""
+    with get_pool().connection() as conn:
+        rows = conn.execute(
+            "SELECT g.username FROM greetings g "
+            "WHERE (SELECT MAX(h.id) FROM chat_history h WHERE h.username = g.username) > g.history_id "
+            "LIMIT ?", (limit,)
+        ).fetchall()
+    return [r[0] for r in rows]
+
+
+# ================= 后台预生成 =================
+class GreetingService:
+    """对话结束后在后台为用户预生成下一次登录的问候
+
+    generate 是 async def generate(username) -> str | None，由 server.py 提供
+    （检索最新记忆 + 调用 LLM）。同一用户在 GREETING_REFRESH_DELAY 内的多轮对话只触发一次生成。
+    """
+
+    def __init__(self, generate):
+        self.generate = generate
+        self._timers = {}  # username -> asyncio.TimerHandle
+        self._sem = asyncio.Semaphore(GREETING_CONCURRENCY)
+        self._tasks = set()
+        self._sweeper = None
+        self.generated = 0
+
+    def start(self):
+        self._sweeper = asyncio.create_task(self._sweep())
+
+    def schedule(self, username, delay=GREETING_REFRESH_DELAY):
+        """（重新）计时：用户最后一轮对话之后 delay 秒再生成"""
+        timer = self._timers.pop(username, None)
+        if timer is not None:
+            timer.cancel()
+        loop = asyncio.get_running_loop()
+        self._timers[username] = loop.call_later(delay, self._fire, username)
+
+    def _fire(self, username):
+        self._timers.pop(username, None)
+        task = asyncio.create_task(self.refresh(username))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def refresh(self, username):
+        lease = f"greeting:{username}"
+        async with self._sem:
+            try:
+                if not await run_db(try_lease, lease, WORKER_ID, GREETING_LEASE_TTL):
+                    return  # 另一个 worker 正在为这个用户生成
+                if await run_db(greeting_is_fresh, username):
+                    return
+                greeting = await self.generate(username)
+                if greeting:
+                    await run_db(save_greeting, username, greeting)
+                    self.generated += 1
+                    print(f"📝 已为 {username} 预生成问候")
+            except Exception as e:
+                print(f"❌ 预生成问候失败 {username}: {e}")
+            finally:
+                try:
+                    await run_db(release_lease, lease, WORKER_ID)
+                except Exception:
+                    pass  # 放不掉就等它过期
+
+    async def _sweep(self):
+        while True:
+            await asyncio.sleep(GREETING_SWEEP_INTERVAL)
+            try:
+                # 多 worker 时只由持有巡检租约的进程巡检；它退出后租约过期，别的进程接手
+                if not await run_db(try_lease, "greeting-sweep", WORKER_ID, GREETING_SWEEP_INTERVAL * 2):
+                    continue
+                for username in await run_db(stale_greeting_users):
+                    if username not in self._timers:
+                        await self.refresh(username)
+            except Exception as e:
+                print(f"⚠️ 问候巡检失败: {e}")
+
+    async def stop(self):
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        tasks = list(self._tasks) + ([self._sweeper] if self._sweeper else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._sweeper = None
@@ -0,0 +1,258 @@
+"""批量把资料灌进 MemOS 长期记忆（取代 old/inject_memory.py 的逐行串行写入）
+
+    python ingest.py --user <memos_user_id>                    # 默认资料 old/newton_bio.txt
+    python ingest.py a.txt b.txt --users-file cohort.txt       # 一次给一批用户灌注
+    python ingest.py --all-users                               # users.db 里的全部用户
+    python ingest.py --dry-run                                 # 只看切分结果，不写入
+
+流程：按段落切成完整的片段（丢掉“编辑词条”“收藏”这类页面碎片，段落前带上所属小标题，
+超长段落按句子拆开）→ 规范化后按哈希去重 → 固定数量的并发 worker 在令牌桶限速下写入，
+失败按指数退避重试。每写成功一条就追加到检查点文件，中断后重跑会跳过已写入的 (用户, 片段)。
+"""
+import re
+import sys
+import time
+import asyncio
+import hashlib
+import argparse
+
+from db import get_pool
+
+# ================= 配置区 =================
+MEMOS_API_KEY = "yourapi"
+DEFAULT_SOURCE = "old/newton_bio.txt"
+CONV_ID = "history_injection_01"   # 专门的对话 ID，方便管理
+CHECKPOINT_FILE = "ingest.ckpt"    # 已写入的 (用户, 片段) 记录，一行一条，只追加
+CHUNK_MAX_CHARS = 400              # 单条记忆的最大字数，超长段落按句子拆开
+HEADING_MAX_CHARS = 20             # 不超过这么长、又不是句子的单独一行视为小标题
+SENTENCE_MIN_CHARS = 20            # 段落里短于这个长度、又没有句末标点的行视为页面碎片
+CONCURRENCY = 4                    # 同时进行的写入数
+RATE = 2.0                         # 令牌桶：每秒平均写入数
+BURST = 4                          # 令牌桶容量（允许的瞬时突发）
+WRITE_TIMEOUT = 30.0               # 单次写入的截止时间（秒）
+MAX_ATTEMPTS = 4                   # 每条最多尝试次数（退避 2s、4s、8s）
+
+_CITATION = re.compile(r"\[\d+(?:-\d+)?\]")
+_SENTENCE_END = re.compile(r"(?<=[。！？；!?;])")
+_HEADING_NOISE = re.compile(r"^\d+|编辑$")
+_NORMALIZE = re.compile(r"[\s\W_]+")
+
+
+# ================= 切分与去重 =================
+def _is_sentence(line):
+    return len(line) >= SENTENCE_MIN_CHARS or bool(re.search(r"[。！？!?]", line))
+
+
+def _split_long(text, limit=CHUNK_MAX_CHARS):
+    """按句子把长段落装成不超过 limit 字的若干块；单句超长时硬切"""
+    chunks, current = [], ""
+    for sentence in filter(None, _SENTENCE_END.split(text)):
+        while len(sentence) > limit:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(sentence[:limit])
+            sentence = sentence[limit:]
+        if current and len(current) + len(sentence) > limit:
+            chunks.append(current)
+            current = ""
+        current += sentence
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def chunk_text(text):
+    """把百科式的纯文本切成 [片段]；空行分隔的块里，句子行是正文，其余是标题/图注/导航"""
+    passages = []
+    heading = ""
+    for block in re.split(r"\n\s*\n", _CITATION.sub("", text)):
+        lines = [line.strip() for line in block.splitlines() if line.strip()]
+        body = [line for line in lines if _is_sentence(line)]
+        if not body:
+            # 整块都是短行：最后一行若像标题就作为后续段落的小标题
+            if lines and len(lines[-1]) <= HEADING_MAX_CHARS:
+                heading = _HEADING_NOISE.sub("", lines[-1]).strip()
+            continue
+        for paragraph in body:
+            for piece in _split_long(paragraph):
+                passages.append(f"【{heading}】{piece}" if heading else piece)
+    return passages
+
+
+def chunk_id(passage):
+    """去掉空白和标点后的内容哈希，用于去重和检查点"""
+    return hashlib.sha1(_NORMALIZE.sub("", passage).encode("utf-8")).hexdigest()[:16]
+
+
+def load_passages(paths):
+    """读取并切分所有资料，返回去重后的 [(chunk_id, 片段)]"""
+    seen = set()
+    passages = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            for passage in chunk_text(f.read()):
+                cid = chunk_id(passage)
+                if cid not in seen:
+                    seen.add(cid)
+                    passages.append((cid, passage))
+    return passages
+
+
+# ================= 限速与检查点 =================
+class TokenBucket:
+    """平均每秒 rate 个令牌，最多攒 burst 个；只在事件循环线程里使用"""
+
+    def __init__(self, rate=RATE, burst=BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    async def take(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class Checkpoint:
+    """追加写的检查点：每行 "<user_id> <chunk_id>"，写一行 flush 一次，进程被杀也最多丢最后一行"""
+
+    def __init__(self, path=CHECKPOINT_FILE):
+        self.path = path
+        self.done = set()
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) == 2:
+                        self.done.add(tuple(parts))
+        except FileNotFoundError:
+            pass
+        self._file = open(path, "a", encoding="utf-8")
+
+    def mark(self, user_id, cid):
+        self.done.add((user_id, cid))
+        self._file.write(f"{user_id} {cid}\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+# ================= 写入 =================
+def ingest_messages(passage):
+    # 模拟“上帝”告诉牛顿这些事实，MemOS 会把它们存成长期记忆
+    return [
+        {"role": "user", "content": f"请记住关于你自己的这段历史：{passage}"},
+        {"role": "assistant", "content": "吾已铭记于心。"},
+    ]
+
+
+async def ingest(client, jobs, checkpoint, conv_id=CONV_ID, concurrency=CONCURRENCY, rate=RATE, burst=BURST):
+    """jobs 为 [(user_id, chunk_id, 片段)]；返回 (成功数, 失败数)"""
+    queue = asyncio.Queue()
+    for job in jobs:
+        queue.put_nowait(job)
+    bucket = TokenBucket(rate, burst)
+    total = len(jobs)
+    counts = {"ok": 0, "failed": 0}
+
+    async def write(user_id, cid, passage):
+        for attempt in range(MAX_ATTEMPTS):
+            await bucket.take()
+            try:
+                await asyncio.wait_for(asyncio.to_thread(
+                    client.add_message, messages=ingest_messages(passage), user_id=user_id,
+                    conversation_id=conv_id), WRITE_TIMEOUT)
+                checkpoint.mark(user_id, cid)
+                return True
+            except Exception as e:
+                if attempt + 1 == MAX_ATTEMPTS:
+                    print(f"❌ 写入失败 {user_id} {cid}: {e}")
+                    return False
+                await asyncio.sleep(2 ** (attempt + 1))
+
+    async def worker():
+        while True:
+            try:
+                user_id, cid, passage = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            counts["ok" if await write(user_id, cid, passage) else "failed"] += 1
+            done = counts["ok"] + counts["failed"]
+            if done % 20 == 0 or done == total:
+                print(f"[{done}/{total}] 成功 {counts['ok']}，失败 {counts['failed']}")
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return counts["ok"], counts["failed"]
+
+
+# ================= 命令行 =================
+def all_memos_users():
+    with get_pool().connection() as conn:
+        return [r[0] for r in conn.execute("SELECT memos_user_id FROM users WHERE memos_user_id IS NOT NULL")]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="把资料切分、去重后批量写入 MemOS 长期记忆（可断点续传）")
+    parser.add_argument("sources", nargs="*", default=[DEFAULT_SOURCE], help="资料文本文件（UTF-8）")
+    parser.add_argument("--user", action="append", default=[], help="目标 MemOS user_id，可重复")
+    parser.add_argument("--users-file", help="每行一个 MemOS user_id")
+    parser.add_argument("--all-users", action="store_true", help="users.db 里的全部用户")
+    parser.add_argument("--conv", default=CONV_ID)
+    parser.add_argument("--checkpoint", default=CHECKPOINT_FILE)
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    parser.add_argument("--rate", type=float, default=RATE, help="每秒平均写入数")
+    parser.add_argument("--burst", type=int, default=BURST)
+    parser.add_argument("--dry-run", action="store_true", help="只打印切分结果")
+    args = parser.parse_args(argv)
+
+    passages = load_passages(args.sources)
+    print(f"📚 {len(args.sources)} 份资料切分出 {len(passages)} 条片段（已去重）")
+    if args.dry_run:
+        for cid, passage in passages:
+            print(f"- {cid} ({len(passage)}字) {passage[:60]}")
+        return 0
+
+    users = list(args.user)
+    if args.users_file:
+        with open(args.users_file, "r", encoding="utf-8") as f:
+            users += [line.strip() for line in f if line.strip()]
+    if args.all_users:
+        users += all_memos_users()
+    users = list(dict.fromkeys(users))
+    if not users:
+        parser.error("请用 --user / --users-file / --all-users 指定目标用户")
+
+    checkpoint = Checkpoint(args.checkpoint)
+    jobs = [(u, cid, p) for u in users for cid, p in passages if (u, cid) not in checkpoint.done]
+    skipped = len(users) * len(passages) - len(jobs)
+    print(f"🚀 {len(users)} 个用户，待写入 {len(jobs)} 条（检查点已完成 {skipped} 条）")
+    if not jobs:
+        checkpoint.close()
+        return 0
+
+    from memos.api.client import MemOSClient
+    client = MemOSClient(api_key=MEMOS_API_KEY)
+    start = time.perf_counter()
+    try:
+        ok, failed = asyncio.run(ingest(client, jobs, checkpoint, args.conv, args.concurrency, args.rate, args.burst))
+    except KeyboardInterrupt:
+        print("\n⏸️ 已中断，重新运行同一命令即可从检查点继续")
+        return 130
+    finally:
+        checkpoint.close()
+    print(f"\n✅ 灌注完成：成功 {ok}，失败 {failed}，耗时 {time.perf_counter() - start:.1f}s")
+    if failed:
+        print("⚠️ 失败的片段没有记入检查点，重新运行即可补写")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
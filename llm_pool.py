@@ -0,0 +1,282 @@
+import os
+import json
+import time
+import asyncio
+from collections import deque
+
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+from memos_adapter import CircuitBreaker
+
+# ================= 配置区 =================
+LLM_ENDPOINTS_FILE = "llm_endpoints.json"  # 上游列表文件（也可用环境变量 LLM_ENDPOINTS 直接给 JSON）
+MAX_CONNECTIONS = 64          # 每个上游的 HTTP 连接池上限
+MAX_KEEPALIVE = 32            # 其中保持长连接的数量
+KEEPALIVE_EXPIRY = 60.0       # 空闲长连接保留多久（秒），省掉每次请求的 TLS 握手
+CONNECT_TIMEOUT = 5.0
+READ_TIMEOUT = 120.0          # 两个 chunk 之间最长等待（秒）
+ENDPOINT_FAILURES = 3         # 连续失败多少次后暂停该上游
+ENDPOINT_COOLDOWN = 20.0      # 暂停多少秒后放一个试探请求
+TTFT_SAMPLES = 200            # 每个上游保留最近多少次首字耗时
+INITIAL_TTFT = 1.0            # 还没有样本时假设的首字耗时（秒）
+HEDGE_ENABLED = False         # 对冲请求：首字迟迟不来就向另一个上游再发一份，谁先出字用谁
+HEDGE_PERCENTILE = 0.9        # 等待超过该上游首字耗时的这个分位数就对冲
+HEDGE_MIN_DELAY = 0.3         # 对冲等待的下限 / 上限（秒）
+HEDGE_MAX_DELAY = 3.0
+HEDGE_MIN_SAMPLES = 20        # 样本太少时分位数不可靠，按上限等待
+
+
+def load_endpoints(default=None):
+    """读取上游配置：环境变量 LLM_ENDPOINTS > LLM_ENDPOINTS_FILE > default（单个上游）
+
+    每项形如 {"name", "base_url", "api_key", "model", "weight", "max_connections", "headers"}，
+    只有 base_url / api_key / model 必填。
+    """
+    raw = os.environ.get("LLM_ENDPOINTS")
+    if raw:
+        return json.loads(raw)
+    path = os.environ.get("LLM_ENDPOINTS_FILE", LLM_ENDPOINTS_FILE)
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    return [default] if default else []
+
+
+class LLMUnavailable(RuntimeError):
+    """所有上游都失败或都在熔断中；最后一个上游的错误挂在 __cause__ 上"""
+
+
+class Endpoint:
+    """一个 OpenAI 兼容的上游：独立的长连接池 + 健康状态 + 首字耗时统计"""
+
+    def __init__(self, base_url, api_key, model, name=None, weight=1.0, max_connections=MAX_CONNECTIONS,
+                 max_keepalive=MAX_KEEPALIVE, headers=None):
+        self.name = name or base_url
+        self.model = model
+        self.weight = weight
+        http_client = DefaultAsyncHttpxClient(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive,
+                                keepalive_expiry=KEEPALIVE_EXPIRY),
+        )
+        # 重试由池子负责（换上游），SDK 自己不重试
+        self.client = AsyncOpenAI(api_key=api_key, base_url=base_url, default_headers=headers,
+                                  http_client=http_client, max_retries=0,
+                                  timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT))
+        self.breaker = CircuitBreaker(ENDPOINT_FAILURES, ENDPOINT_COOLDOWN, name=f"LLM 上游 {self.name}")
+        self.ttfts = deque(maxlen=TTFT_SAMPLES)
+        self.ewma = INITIAL_TTFT
+        self.inflight = 0
+        self.requests = 0
+        self.errors = 0
+
+    def record_ttft(self, seconds):
+        # 第一个样本直接替换初始假设值
+        self.ewma = seconds if not self.ttfts else 0.8 * self.ewma + 0.2 * seconds
+        self.ttfts.append(seconds)
+
+    def score(self):
+        """越小越优先：平均首字耗时 × 当前负载 × 最近连续失败次数，再按权重折算"""
+        return self.ewma * (1 + self.inflight) * (1 + self.breaker.failures) / self.weight
+
+    def percentile(self, p):
+        if len(self.ttfts) < HEDGE_MIN_SAMPLES:
+            return None
+        samples = sorted(self.ttfts)
+        return samples[min(len(samples) - 1, int(p * len(samples)))]
+
+    def snapshot(self):
+        samples = sorted(self.ttfts)
+        return {
+            "name": self.name,
+            "model": self.model,
+            "state": self.breaker.state,
+            "inflight": self.inflight,
+            "requests": self.requests,
+            "errors": self.errors,
+            "ewma_ttft_ms": round(self.ewma * 1000, 1),
+            "p50_ttft_ms": round(samples[len(samples) // 2] * 1000, 1) if samples else None,
+            "p90_ttft_ms": round(samples[int(0.9 * len(samples))] * 1000, 1) if samples else None,
+        }
+
+
+class _Opened:
+    """已经收到首个内容块的流：head 是已读出的 chunk，之后从 it 继续读"""
+
+    def __init__(self, endpoint, stream, it, head):
+        self.endpoint = endpoint
+        self.stream = stream
+        self.it = it
+        self.head = head
+
+
+class LLMPool:
+    """多个上游之间按健康状况和首字耗时路由，失败自动切换，可选对冲请求
+
+    出字之前的失败（连接错误、限流、5xx）会换下一个上游重试；已经开始输出之后的失败直接抛出，
+    因为前端已经看到了一半的回答。
+    """
+
+    def __init__(self, endpoints, hedge=HEDGE_ENABLED):
+        if not endpoints:
+            raise ValueError("at least one LLM endpoint is required")
+        self.endpoints = [e if isinstance(e, Endpoint) else Endpoint(**e) for e in endpoints]
+        self.hedge = hedge
+        self.failovers = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def pick(self, exclude=()):
+        """选出当前最优的可用上游；全部熔断时返回 None"""
+        for endpoint in sorted((e for e in self.endpoints if e not in exclude), key=Endpoint.score):
+            if endpoint.breaker.allow():
+                return endpoint
+        return None
+
+    def _hedge_delay(self, endpoint):
+        p = endpoint.percentile(HEDGE_PERCENTILE)
+        if p is None:
+            return HEDGE_MAX_DELAY
+        return min(HEDGE_MAX_DELAY, max(HEDGE_MIN_DELAY, p))
+
+    async def _open(self, endpoint, messages, extra):
+        """向一个上游发起流式请求，一直读到第一个带内容的 chunk（或流结束）"""
+        endpoint.inflight += 1
+        endpoint.requests += 1
+        t0 = time.monotonic()
+        stream = None
+        try:
+            stream = await endpoint.client.chat.completions.create(
+                model=endpoint.model, messages=messages, stream=True, **extra)
+            it = stream.__aiter__()
+            head = []
+            async for chunk in it:
+                head.append(chunk)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    break
+            endpoint.record_ttft(time.monotonic() - t0)
+            endpoint.breaker.record(True)
+            return _Opened(endpoint, stream, it, head)
+        except asyncio.CancelledError:
+            # 对冲中输掉的一方：关掉连接，不算失败
+            if stream is not None:
+                await stream.close()
+            endpoint.inflight -= 1
+            raise
+        except Exception:
+            endpoint.errors += 1
+            endpoint.breaker.record(False)
+            endpoint.inflight -= 1
+            if stream is not None:
+                await stream.close()
+            raise
+
+    async def _first(self, messages, extra):
+        """拿到第一个出字的上游；出字前失败就换下一个，开启对冲时等待超阈值再并发一份"""
+        tried = []
+        pending = {}  # task -> endpoint
+        last_error = None
+
+        def launch():
+            endpoint = self.pick(exclude=tried)
+            if endpoint is None:
+                return None
+            tried.append(endpoint)
+            pending[asyncio.create_task(self._open(endpoint, messages, extra))] = endpoint
+            return endpoint
+
+        primary = launch()
+        if primary is None:
+            raise LLMUnavailable("no healthy LLM endpoint available")
+        hedged = not self.hedge
+        backup = None
+        try:
+            while pending:
+                timeout = None if hedged else self._hedge_delay(primary)
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    backup = launch()
+                    if backup is not None:
+                        self.hedges += 1
+                        print(f"🪁 {primary.name} {timeout:.2f}s 未出字，对冲到 {backup.name}")
+                    continue
+                for task in done:
+                    endpoint = pending.pop(task)
+                    if task.exception() is None:
+                        if endpoint is backup:
+                            self.hedge_wins += 1
+                        return task.result()
+                    last_error = task.exception()
+                    print(f"⚠️ LLM 上游 {endpoint.name} 出字前失败: {last_error}")
+                if not pending and launch() is not None:
+                    self.failovers += 1
+            raise LLMUnavailable(f"all LLM endpoints failed: {last_error}") from last_error
+        finally:
+            # 输掉的对冲请求（或调用方被取消时所有在途请求）一律取消
+            for task in pending:
+                task.cancel()
+            results = await asyncio.gather(*pending, return_exceptions=True)
+            for result in results:
+                # 同一轮里两边都出了字：多出来的那条流直接关掉
+                if isinstance(result, _Opened):
+                    result.endpoint.inflight -= 1
+                    await result.stream.close()
+
+    async def stream_chat(self, messages, **extra):
+        """流式对话，逐个产出 ChatCompletionChunk（和直接用 SDK 时一样）"""
+        opened = await self._first(messages, extra)
+        endpoint = opened.endpoint
+        try:
+            for chunk in opened.head:
+                yield chunk
+            async for chunk in opened.it:
+                yield chunk
+        except Exception:
+            endpoint.errors += 1
+            endpoint.breaker.record(False)
+            raise
+        finally:
+            endpoint.inflight -= 1
+            await opened.stream.close()
+
+    async def complete(self, messages, **extra):
+        """非流式调用（问候、摘要等后台任务），失败时依次换上游"""
+        tried = []
+        last_error = None
+        while True:
+            endpoint = self.pick(exclude=tried)
+            if endpoint is None:
+                if last_error is None:
+                    raise LLMUnavailable("no healthy LLM endpoint available")
+                raise LLMUnavailable(f"all LLM endpoints failed: {last_error}") from last_error
+            tried.append(endpoint)
+            endpoint.inflight += 1
+            endpoint.requests += 1
+            try:
+                completion = await endpoint.client.chat.completions.create(
+                    model=endpoint.model, messages=messages, **extra)
+            except Exception as e:
+                endpoint.errors += 1
+                endpoint.breaker.record(False)
+                last_error = e
+                print(f"⚠️ LLM 上游 {endpoint.name} 调用失败: {e}")
+                self.failovers += 1
+                continue
+            finally:
+                endpoint.inflight -= 1
+            endpoint.breaker.record(True)
+            return completion
+
+    def snapshot(self):
+        return {
+            "hedge": self.hedge,
+            "failovers": self.failovers,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "endpoints": [e.snapshot() for e in self.endpoints],
+        }
+
+    async def close(self):
+        for endpoint in self.endpoints:
+            await endpoint.client.close()
@@ -0,0 +1,160 @@
+"""基于 chat_history 的本地召回：SQLite FTS5 全文索引 + BM25 排序
+
+MemOS 慢或不可用时，/chat 仍然可以从本地旧对话里找回相关内容（毫秒级）。
+分词在 Python 里完成后写进 chat_fts.terms（FTS5 只按空格切）：
+LaTeX 命令变成 tex_<命令名>，中文按相邻两字切分，英文单词和数字原样小写。
+每条索引的 owner 是 (用户, 对话) 的哈希，召回只在当前对话里找。
+索引随 ChatWriter 的每批写入在同一个事务里增量更新；删除对话时由触发器同步删除。
+
+    python local_recall.py --rebuild     # 从 chat_history 重建整个索引
+"""
+import re
+import sys
+import time
+import hashlib
+
+from db import get_pool, run_db, CLEARED_UPTO
+from metrics import timed
+
+# ================= 配置区 =================
+INDEX_BATCH = 1000        # 每个事务最多补建多少行索引
+LOCAL_RECALL_TOP = 5      # 每次召回的旧消息条数
+QUERY_MAX_TERMS = 32      # 查询最多取多少个词，避免超长问题拖慢检索
+SNIPPET_CHARS = 200       # 每条旧消息最多放多少字进 prompt
+
+_LATEX_CMD = re.compile(r"\\([a-zA-Z]+)")
+_CJK_RUN = re.compile(r"[\u3400-\u9fff]+")
+_WORD = re.compile(r"[a-zA-Z]+|\d+(?:\.\d+)?")
+
+
+# ================= 分词 =================
+def tokenize(text):
+    """LaTeX 感知的分词：\\frac{a}{b} -> tex_frac a b，"微积分" -> 微积 积分"""
+    tokens = [f"tex_{cmd.lower()}" for cmd in _LATEX_CMD.findall(text)]
+    rest = _LATEX_CMD.sub(" ", text)
+    for run in _CJK_RUN.findall(rest):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    tokens.extend(word.lower() for word in _WORD.findall(rest))
+    return tokens
+
+
+def owner_token(username, conv_id):
+    """用户名可能含任意字符，索引里存 (用户, 对话) 的哈希，作为 FTS 列过滤条件"""
+    return "u" + hashlib.sha1(f"{username}\n{conv_id}".encode("utf-8")).hexdigest()[:16]
+
+
+def match_expression(username, conv_id, query):
+    terms = list(dict.fromkeys(tokenize(query)))[:QUERY_MAX_TERMS]
+    if not terms:
+        return None
+    quoted = " OR ".join(f'"{t}"' for t in terms)
+    return f"owner:{owner_token(username, conv_id)} AND terms:({quoted})"
+
+
+# ================= 索引维护 =================
+def index_new_rows(conn, limit=INDEX_BATCH):
+    """把 fts_upto 之后的新对话加入索引，返回本次处理的行数；调用方负责事务
+
+    作为 chat_writer 的 batch hook 时和对话本身一起提交，索引不会落后于对话表。
+    """
+    upto = conn.execute("SELECT value FROM meta WHERE key='fts_upto'").fetchone()[0]
+    rows = conn.execute("SELECT id, username, conv_id, content FROM chat_history WHERE id > ? ORDER BY id LIMIT ?",
+                        (upto, limit)).fetchall()
+    if not rows:
+        return 0
+    conn.executemany("INSERT OR REPLACE INTO chat_fts (rowid, owner, terms) VALUES (?, ?, ?)",
+                     [(i, owner_token(u, conv), " ".join(tokenize(c or ""))) for i, u, conv, c in rows])
+    conn.execute("UPDATE meta SET value=? WHERE key='fts_upto'", (rows[-1][0],))
+    return len(rows)
+
+
+def catch_up(batch=INDEX_BATCH):
+    """补建启动前积压的索引（老库第一次启用时就是全量建索引），分批提交"""
+    total = 0
+    while True:
+        with get_pool().connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            n = index_new_rows(conn, batch)
+            conn.commit()
+        total += n
+        if n < batch:
+            return total
+
+
+def rebuild():
+    """清空后从 chat_history 重建整个索引"""
+    with get_pool().connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM chat_fts")
+        conn.execute("UPDATE meta SET value=0 WHERE key='fts_upto'")
+        conn.commit()
+    total = catch_up()
+    with get_pool().connection() as conn:
+        conn.execute("INSERT INTO chat_fts (chat_fts) VALUES ('optimize')")
+        conn.commit()
+    return total
+
+
+# ================= 查询 =================
+def search_local(username, conv_id, query, window, limit=LOCAL_RECALL_TOP):
+    """该对话里 BM25 最相关的旧消息 [(role, content)]；最近 window 条已经作为短期历史放进 prompt，跳过"""
+    match = match_expression(username, conv_id, query)
+    if match is None:
+        return []
+    with get_pool().connection() as conn:
+        return conn.execute(
+            "SELECT h.role, h.content FROM chat_fts f JOIN chat_history h ON h.id = f.rowid "
+            f"WHERE chat_fts MATCH ? AND f.rowid > {CLEARED_UPTO} AND f.rowid < COALESCE("
+            "(SELECT id FROM chat_history WHERE username=? AND conv_id=? ORDER BY id DESC LIMIT 1 OFFSET ?), 0) "
+            "ORDER BY bm25(chat_fts, 0.0, 1.0) LIMIT ?",
+            (match, username, username, conv_id, max(window - 1, 0), limit)).fetchall()
+
+
+def format_hits(rows):
+    """和 MemOS 的记忆摘要同样的条目格式，拼进 system prompt"""
+    if not rows:
+        return ""
+    lines = [f"• {'学生曾问' if role == 'user' else '你曾答'}: {content[:SNIPPET_CHARS]}" for role, content in rows]
+    return "【相关旧对话】\n" + "\n".join(lines)
+
+
+class LocalRecall:
+    """/chat 用的异步入口，顺带统计命中情况（只在事件循环线程里更新）"""
+
+    def __init__(self, window, limit=LOCAL_RECALL_TOP):
+        self.window = window
+        self.limit = limit
+        self.queries = 0
+        self.hits = 0
+        self.errors = 0
+
+    async def recall(self, username, conv_id, query):
+        """返回给 AI 看的摘要，没有命中或出错时返回空串"""
+        self.queries += 1
+        try:
+            with timed("local_recall"):
+                rows = await run_db(search_local, username, conv_id, query, self.window, self.limit)
+        except Exception as e:
+            self.errors += 1
+            print(f"⚠️ 本地召回失败: {e}")
+            return ""
+        if rows:
+            self.hits += 1
+            print(f"📚 本地索引召回 {len(rows)} 条旧对话")
+        return format_hits(rows)
+
+    def snapshot(self):
+        return {"queries": self.queries, "hits": self.hits, "errors": self.errors}
+
+
+if __name__ == "__main__":
+    if "--rebuild" not in sys.argv[1:]:
+        print(__doc__)
+        sys.exit(1)
+    from db import init_db
+    init_db()
+    start = time.perf_counter()
+    print(f"✅ 已重建本地召回索引：{rebuild()} 行，耗时 {time.perf_counter() - start:.1f}s")
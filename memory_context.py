@@ -0,0 +1,143 @@
+import heapq
+from collections import OrderedDict
+
+from context import count_tokens, truncate_to_sentences, MEMORY_TOKEN_BUDGET
+
+# ================= 配置区 =================
+MEMORY_TOP_K = 5              # 最多放几条记忆
+PREFERENCE_TOP_K = 3          # 最多放几条偏好
+CANDIDATE_FACTOR = 3          # 先按相关度取 top_k * 这么多条候选，去重后再取 top_k
+MEMORY_ITEM_TOKENS = 120      # 单条记忆的 token 上限（按句截断）
+PREFERENCE_ITEM_TOKENS = 50   # 单条偏好的 token 上限
+SHINGLE_SIZE = 3              # 近似去重用的字符 shingle 长度
+DUPLICATE_THRESHOLD = 0.7     # shingle 集合的 Jaccard 相似度达到多少视为重复
+RENDER_CACHE_SIZE = 2000      # 渲染结果缓存条数
+
+
+def shingles(text, size=SHINGLE_SIZE):
+    text = "".join(text.split()).lower()
+    if len(text) <= size:
+        return {text}
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+def jaccard(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class MemoryCompressor:
+    """把 MemOS 的检索结果压成给 AI 看的记忆摘要
+
+    按相关度用堆取 top-k（不对整个列表排序），同一件事的近似重复记忆只留相关度最高的一条，
+    每条按句子截断，整体不超过 MEMORY_TOKEN_BUDGET。
+    同一用户拿到同样的检索结果（缓存命中或 MemOS 返回没变）时直接复用渲染好的摘要。
+    只在事件循环线程里使用，不需要加锁。
+    """
+
+    def __init__(self, top_k=MEMORY_TOP_K, preference_k=PREFERENCE_TOP_K, budget=MEMORY_TOKEN_BUDGET,
+                 cache_size=RENDER_CACHE_SIZE):
+        self.top_k = top_k
+        self.preference_k = preference_k
+        self.budget = budget
+        self.cache_size = cache_size
+        self._cache = OrderedDict()  # (user_id, 指纹) -> 渲染结果
+        self.hits = 0
+        self.misses = 0
+        self.merged = 0
+
+    @staticmethod
+    def fingerprint(memos_result):
+        memories = memos_result.get("memory_detail_list") or ()
+        preferences = memos_result.get("preference_detail_list") or ()
+        return hash((
+            tuple((m.get("memory_key"), m.get("memory_value"), m.get("relativity")) for m in memories),
+            tuple(p.get("preference") for p in preferences),
+        ))
+
+    def render(self, memos_result, user_id=None):
+        """返回 {"summary": 摘要文本, "memories": 条数, "preferences": 条数, "merged": 去掉的重复条数}"""
+        if not memos_result:
+            return {"summary": "", "memories": 0, "preferences": 0, "merged": 0}
+        key = (user_id, self.fingerprint(memos_result))
+        cached = self._cache.get(key)
+        if cached is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return cached
+        self.misses += 1
+        parsed = self._build(memos_result)
+        self._cache[key] = parsed
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return parsed
+
+    def _select(self, items, k, text_of, score_of):
+        """相关度最高、彼此不重复的 k 条"""
+        chosen, seen, merged = [], [], 0
+        for item in heapq.nlargest(k * CANDIDATE_FACTOR, items, key=score_of):
+            text = text_of(item)
+            if not text:
+                continue
+            sh = shingles(text)
+            if any(jaccard(sh, other) >= DUPLICATE_THRESHOLD for other in seen):
+                merged += 1
+                continue
+            chosen.append(item)
+            seen.append(sh)
+            if len(chosen) == k:
+                break
+        return chosen, merged
+
+    def _build(self, memos_result):
+        memories, merged = self._select(
+            memos_result.get("memory_detail_list") or [], self.top_k,
+            lambda m: m.get("memory_value", ""), lambda m: m.get("relativity") or 0)
+        preferences, merged_prefs = self._select(
+            memos_result.get("preference_detail_list") or [], self.preference_k,
+            lambda p: p.get("preference", ""), lambda p: 0)
+        self.merged += merged + merged_prefs
+
+        # 按相关度从高到低装入，装满整体预算就停
+        remaining = self.budget
+        memory_lines, pref_lines = [], []
+        for m in memories:
+            line = f"• {m.get('memory_key', '')}: {truncate_to_sentences(m['memory_value'], MEMORY_ITEM_TOKENS)}"
+            cost = count_tokens(line) + 1
+            if cost > remaining:
+                break
+            memory_lines.append(line)
+            remaining -= cost
+        for p in preferences:
+            line = f"• {truncate_to_sentences(p['preference'], PREFERENCE_ITEM_TOKENS)}"
+            cost = count_tokens(line) + 1
+            if cost > remaining:
+                break
+            pref_lines.append(line)
+            remaining -= cost
+
+        parts = []
+        if memory_lines:
+            parts.append("【历史记忆】\n" + "\n".join(memory_lines))
+        if pref_lines:
+            parts.append("【用户偏好】\n" + "\n".join(pref_lines))
+        return {
+            "summary": "\n\n".join(parts),
+            "memories": len(memory_lines),
+            "preferences": len(pref_lines),
+            "merged": merged + merged_prefs,
+        }
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "merged": self.merged,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+memory_compressor = MemoryCompressor()
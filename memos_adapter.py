@@ -0,0 +1,302 @@
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import observe
+from db import run_db, read_meta, bump_meta
+
+# ================= 配置区 =================
+MEMOS_MAX_WORKERS = 8      # 同时进行的 MemOS 调用上限（专用线程池大小）
+SEARCH_TIMEOUT = 2.0       # search_memory 的截止时间（秒），超时就不带记忆继续
+ADD_TIMEOUT = 15.0         # add_message 的截止时间（秒）
+BREAKER_FAILURES = 5       # 连续失败多少次后熔断
+BREAKER_COOLDOWN = 30.0    # 熔断后多少秒放一个试探请求过去
+RECALL_CACHE_SIZE = 2000   # 检索结果缓存条数
+RECALL_CACHE_TTL = 120.0   # 检索结果缓存有效期（秒）
+SHARED_CHECK_INTERVAL = 1.0  # 多 worker 时每个用户最多每隔多少秒查一次其他进程的写入
+
+
+# _call 没有真正发出请求时的结果标记
+SKIPPED = object()
+
+
+class CircuitBreaker:
+    """简单的三态熔断器：closed -> open（连续失败）-> half-open（冷却后试探一次）"""
+
+    def __init__(self, failures=BREAKER_FAILURES, cooldown=BREAKER_COOLDOWN, name="MemOS"):
+        self.name = name
+        self.max_failures = failures
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record(self, ok):
+        with self._lock:
+            self._probing = False
+            if ok:
+                self.failures = 0
+                self.opened_at = None
+                return
+            self.failures += 1
+            if self.failures >= self.max_failures or self.opened_at is not None:
+                if self.opened_at is None:
+                    print(f"⛔ {self.name} 连续失败 {self.failures} 次，熔断 {self.cooldown:.0f} 秒")
+                self.opened_at = time.monotonic()
+
+
+class CallStats:
+    def __init__(self):
+        self.calls = 0
+        self.ok = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.skipped = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def as_dict(self):
+        return {
+            "calls": self.calls,
+            "ok": self.ok,
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+            "skipped": self.skipped,
+            "avg_ms": round(self.total_time / self.calls * 1000, 1) if self.calls else 0.0,
+            "max_ms": round(self.max_time * 1000, 1),
+        }
+
+
+def normalize_query(query):
+    """折叠空白、统一大小写，让只差空格的问题命中同一条缓存"""
+    return " ".join(query.split()).lower()
+
+
+class RecallCache:
+    """search_memory 结果缓存，键为 (memos_user_id, conv_id, 规范化后的 query)
+
+    TTL + LRU 淘汰；该用户写入新记忆（add）时整体失效。
+    相同键的并发请求合并成一个在途请求（single-flight）。
+    只在事件循环线程里使用，不需要加锁。
+
+    shared 为 True（多 worker）时，写入还会把 users.db 里 meta 的 memos:<user_id> 计数加一，
+    其他进程读缓存前对比这个计数，发现变了就丢掉该用户的本地条目。
+    """
+
+    def __init__(self, maxsize=RECALL_CACHE_SIZE, ttl=RECALL_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items = OrderedDict()  # key -> (expires_at, result)
+        self._inflight = {}          # key -> asyncio.Future
+        self._user_gen = {}          # user_id -> 失效次数，用来丢弃失效前发出的在途结果
+        self.shared = False
+        self._versions = {}          # user_id -> (上次检查时间, 看到的计数)
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def _sync_user(self, user_id):
+        now = time.monotonic()
+        seen = self._versions.get(user_id)
+        if seen is not None and now - seen[0] < SHARED_CHECK_INTERVAL:
+            return
+        version = await run_db(read_meta, f"memos:{user_id}")
+        if seen is not None and version != seen[1]:
+            self.invalidate_user(user_id)
+        self._versions[user_id] = (now, version)
+        if len(self._versions) > self.maxsize:
+            self._versions.pop(next(iter(self._versions)))
+
+    async def get_or_load(self, user_id, conv_id, query, loader):
+        if self.shared:
+            await self._sync_user(user_id)
+        key = (user_id, conv_id, normalize_query(query))
+        item = self._items.get(key)
+        if item is not None:
+            if item[0] > time.monotonic():
+                self._items.move_to_end(key)
+                self.hits += 1
+                return item[1]
+            del self._items[key]
+
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        gen = self._user_gen.get(user_id, 0)
+        try:
+            result = await loader()
+        except BaseException:
+            # 发起者被取消（如客户端断开）时，合并进来的请求按“无记忆”继续
+            future.set_result(None)
+            raise
+        finally:
+            self._inflight.pop(key, None)
+        future.set_result(result)
+        # 失败结果（None）不缓存；检索期间用户写入了新记忆也不缓存
+        if result is not None and self._user_gen.get(user_id, 0) == gen:
+            self._items[key] = (time.monotonic() + self.ttl, result)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+        return result
+
+    def peek(self, user_id, conv_id, query):
+        """只读缓存，不计入命中统计，也不发起请求"""
+        item = self._items.get((user_id, conv_id, normalize_query(query)))
+        if item is not None and item[0] > time.monotonic():
+            return item[1]
+        return None
+
+    def invalidate_user(self, user_id):
+        self._user_gen[user_id] = self._user_gen.get(user_id, 0) + 1
+        for key in [k for k in self._items if k[0] == user_id]:
+            del self._items[key]
+
+    async def publish_user(self, user_id):
+        """通知其他 worker：该用户的记忆变了"""
+        if self.shared:
+            await run_db(bump_meta, f"memos:{user_id}")
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "shared": self.shared,
+            "size": len(self._items),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+class MemoryAdapter:
+    """MemOSClient 的异步封装
+
+    MemOSClient 是同步 HTTP 客户端，这里把调用放进专用的有界线程池，
+    每次调用有截止时间，超时/失败/熔断时返回 None，调用方不带记忆继续即可。
+    超时的调用在线程里仍会跑完，所以线程全忙时新请求直接跳过，而不是排队。
+    """
+
+    def __init__(self, client, max_workers=MEMOS_MAX_WORKERS):
+        self.client = client
+        self.max_workers = max_workers
+        self.breaker = CircuitBreaker()
+        self.stats = {"search": CallStats(), "add": CallStats()}
+        self.recall_cache = RecallCache()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="newton-memos") \
+            if client else None
+        self._busy = 0
+        self._lock = threading.Lock()
+
+    @property
+    def available(self):
+        return self.client is not None
+
+    async def _call(self, kind, timeout, func, **kwargs):
+        """返回 (是否成功, 结果)；没有真正发出请求（不可用 / 线程占满 / 熔断中）时结果是 SKIPPED"""
+        stats = self.stats[kind]
+        if not self.available:
+            return False, SKIPPED
+        with self._lock:
+            if self._busy >= self.max_workers:
+                stats.skipped += 1
+                return False, SKIPPED
+            self._busy += 1
+        if not self.breaker.allow():
+            with self._lock:
+                self._busy -= 1
+            stats.skipped += 1
+            return False, SKIPPED
+
+        def release(_future):
+            with self._lock:
+                self._busy -= 1
+
+        stats.calls += 1
+        start = time.perf_counter()
+        # 占用在 future 结束时归还：超时取消的任务如果还在线程池队列里就不会执行，
+        # 归还不能放在任务函数里，否则 _busy 漏减，线程池最终被当成一直占满
+        future = self._executor.submit(func, **kwargs)
+        future.add_done_callback(release)
+        try:
+            result = await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.TimeoutError:
+            stats.timeouts += 1
+            self.breaker.record(False)
+            print(f"⏱️ MemOS {kind} 超过 {timeout}s，跳过")
+            return False, None
+        except Exception as e:
+            stats.errors += 1
+            self.breaker.record(False)
+            print(f"⚠️ MemOS {kind} 失败: {e}")
+            return False, None
+        finally:
+            elapsed = time.perf_counter() - start
+            stats.total_time += elapsed
+            stats.max_time = max(stats.max_time, elapsed)
+            observe(f"memos_{kind}", elapsed)
+        stats.ok += 1
+        self.breaker.record(True)
+        return True, result
+
+    async def search(self, query, user_id, conversation_id, timeout=SEARCH_TIMEOUT, use_cache=True):
+        """检索记忆，失败/超时/熔断时返回 None"""
+        async def load():
+            ok, result = await self._call("search", timeout, getattr(self.client, "search_memory", None),
+                                          query=query, user_id=user_id, conversation_id=conversation_id)
+            return result if ok else None
+
+        if not use_cache:
+            return await load()
+        return await self.recall_cache.get_or_load(user_id, conversation_id, query, load)
+
+    async def add(self, messages, user_id, conversation_id, timeout=ADD_TIMEOUT):
+        """写入记忆：成功返回 True，失败返回 False，熔断中或线程占满没有发出请求时返回 None"""
+        # 不论成败都让缓存失效：超时的写入可能已经在远端生效
+        self.recall_cache.invalidate_user(user_id)
+        ok, result = await self._call("add", timeout, getattr(self.client, "add_message", None),
+                                      messages=messages, user_id=user_id, conversation_id=conversation_id)
+        if result is SKIPPED:
+            return None
+        self.recall_cache.invalidate_user(user_id)
+        await self.recall_cache.publish_user(user_id)
+        return ok
+
+    def snapshot(self):
+        return {
+            "available": self.available,
+            "breaker": self.breaker.state,
+            "busy": self._busy,
+            "search": self.stats["search"].as_dict(),
+            "add": self.stats["add"].as_dict(),
+            "recall_cache": self.recall_cache.stats(),
+        }
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
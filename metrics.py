@@ -0,0 +1,199 @@
+import json
+import time
+import uuid
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# ================= 配置区 =================
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+ACCESS_LOG_FILE = "access.log"   # JSON 访问日志，一行一条；设为 None 输出到控制台
+REQUEST_ID_HEADER = "x-request-id"
+
+# 当前请求的上下文：request_id、路由、各阶段耗时（后台任务里为 None）
+_request = contextvars.ContextVar("request", default=None)
+
+
+class Histogram:
+    """Prometheus 风格的累积直方图，按标签分组；可以在任意线程里 observe"""
+
+    def __init__(self, name, help_text, label_names, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}  # labels -> [每个桶的计数..., +Inf 计数, 总和]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._series.items())
+        for labels, series in items:
+            base = ",".join(f'{n}="{v}"' for n, v in zip(self.label_names, labels))
+            sep = "," if base else ""
+            for bound, count in zip(self.buckets, series):
+                lines.append(f'{self.name}_bucket{{{base}{sep}le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{base}{sep}le="+Inf"}} {series[-2]}')
+            lines.append(f"{self.name}_count{{{base}}} {series[-2]}")
+            lines.append(f"{self.name}_sum{{{base}}} {series[-1]:.6f}")
+        return lines
+
+
+stage_seconds = Histogram("newton_stage_seconds", "Time spent in each request stage", ("route", "stage"))
+request_seconds = Histogram("newton_request_seconds", "Request duration including the streamed body",
+                            ("route", "status"))
+
+
+# ================= 阶段计时 =================
+def route_label(scope):
+    """指标里的 route 标签：路由匹配后的路径模板（/static/{name}），没匹配上的请求合并成 unmatched
+
+    直接用实际路径的话，每个带哈希的静态文件、每个对话 id 都会变成一条新的时间序列。
+    """
+    return getattr(scope.get("route"), "path", None) or "unmatched"
+
+
+def observe(stage, seconds):
+    """记录一个阶段的耗时：进直方图，同时记到当前请求的访问日志里"""
+    ctx = _request.get()
+    if ctx is not None and ctx["done"]:
+        # 请求里排下的定时器/后台任务会继承上下文，响应结束后的耗时算后台
+        ctx = None
+    stage_seconds.observe(seconds, route_label(ctx["scope"]) if ctx else "background", stage)
+    if ctx is not None:
+        ctx["stages"][stage] = round(ctx["stages"].get(stage, 0.0) + seconds * 1000, 1)
+
+
+@contextmanager
+def timed(stage):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - t0)
+
+
+async def timed_await(stage, awaitable):
+    """给 gather 里的单个协程计时"""
+    t0 = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        observe(stage, time.perf_counter() - t0)
+
+
+def annotate(**fields):
+    """往当前请求的访问日志里加字段（如用户名）"""
+    ctx = _request.get()
+    if ctx is not None and not ctx["done"]:
+        ctx["extra"].update(fields)
+
+
+def current_request_id():
+    ctx = _request.get()
+    return ctx["request_id"] if ctx else None
+
+
+# ================= 访问日志 =================
+access_logger = logging.getLogger("newton.access")
+access_logger.propagate = False
+
+
+def _access_log(record):
+    # 第一次写日志时才打开文件（admin.py、bench 等只 import 不写日志）
+    if not access_logger.handlers:
+        handler = logging.FileHandler(ACCESS_LOG_FILE, encoding="utf-8") if ACCESS_LOG_FILE else logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        access_logger.addHandler(handler)
+        access_logger.setLevel(logging.INFO)
+    access_logger.info(json.dumps(record, ensure_ascii=False))
+
+
+class RequestMetricsMiddleware:
+    """纯 ASGI 中间件：分配 request_id，流式响应的最后一块发完才记总耗时和访问日志
+
+    （BaseHTTPMiddleware 在响应头发出时就返回了，量不到流式回答的真实时长。）
+    """
+
+    def __init__(self, app, skip_paths=("/metrics",)):
+        self.app = app
+        self.skip_paths = skip_paths
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.skip_paths:
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope.get("headers") or [])
+        request_id = headers.get(REQUEST_ID_HEADER.encode(), b"").decode()[:64] or uuid.uuid4().hex[:16]
+        ctx = {"request_id": request_id, "scope": scope, "stages": {}, "extra": {}, "done": False}
+        token = _request.set(ctx)
+        t0 = time.perf_counter()
+        status = 500
+        logged = False
+
+        def finish():
+            nonlocal logged
+            if logged:
+                return
+            logged = True
+            ctx["done"] = True
+            elapsed = time.perf_counter() - t0
+            request_seconds.observe(elapsed, route_label(scope), str(status))
+            _access_log({
+                "ts": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "request_id": request_id,
+                "method": scope["method"],
+                "path": scope["path"],
+                "status": status,
+                "duration_ms": round(elapsed * 1000, 1),
+                "stages_ms": ctx["stages"],
+                **ctx["extra"],
+            })
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message.setdefault("headers", []).append((REQUEST_ID_HEADER.encode(), request_id.encode()))
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                finish()
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            finish()
+            _request.reset(token)
+
+
+# ================= /metrics 输出 =================
+def render(gauges=None, counters=None):
+    """Prometheus 文本格式；gauges / counters 是 {指标名: 值} 或 {指标名: [(标签dict, 值), ...]}
+
+    counters 是只增不减的累计值，名字按惯例以 _total 结尾。
+    """
+    lines = stage_seconds.render() + request_seconds.render()
+    series = [(name, value, "gauge") for name, value in (gauges or {}).items()]
+    series += [(name, value, "counter") for name, value in (counters or {}).items()]
+    for name, value, kind in series:
+        lines.append(f"# TYPE {name} {kind}")
+        if isinstance(value, list):
+            for labels, v in value:
+                label_text = ",".join(f'{k}="{lv}"' for k, lv in labels.items())
+                lines.append(f"{name}{{{label_text}}} {v}")
+        else:
+            lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
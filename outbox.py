@@ -0,0 +1,237 @@
+import sys
+import json
+import time
+import asyncio
+from collections import OrderedDict
+
+from db import get_pool, run_db, chat_writer, WORKER_ID
+
+# ================= 配置区 =================
+OUTBOX_BATCH = 200          # 每轮最多领取多少条
+OUTBOX_POLL_INTERVAL = 2.0  # 没有新记录时的轮询间隔（秒）
+OUTBOX_MAX_ATTEMPTS = 10    # 超过后标记为 failed，不再自动重试
+OUTBOX_BACKOFF_BASE = 2.0   # 指数退避：base * 2^(attempts-1) 秒
+OUTBOX_BACKOFF_MAX = 600.0
+OUTBOX_LEASE = 60.0         # 领取后多少秒内没完成视为崩溃遗留，可被重新领取
+
+# 一条记录现在可以领取：待投递且过了退避时间，或 sending 但租约已过期（进程崩溃遗留）
+_READY = ("(({t}.status='pending' AND {t}.next_attempt_at<=:now) OR "
+          "({t}.status='sending' AND {t}.lease_until<:now))")
+
+# 本进程的领取标记（多进程部署时区分是谁领走的）
+_CLAIM_TOKEN = WORKER_ID
+
+
+# ================= 发件箱表操作 =================
+def claim_batch(limit=OUTBOX_BATCH):
+    """领取可投递的记录，按用户分组、保持每个用户内部的先后顺序
+
+    每个用户只取“队头”连续可投递的记录：队头还在退避、被别的进程领走或已经 failed 时，
+    该用户后面的记录也不动，保证写入 MemOS 的顺序和对话顺序一致（投递成功的记录直接删除，
+    所以表里任何一条更早的记录都会挡住后面的）。failed 的记录要等 retry_failed 放回队列
+    （POST /api/outbox/retry 或 python outbox.py --retry-failed）。
+    status='sending' 且租约过期的记录（进程崩溃遗留）会被重新领取。
+    """
+    now = time.time()
+    with get_pool().connection() as conn:
+        # 在 SQL 里先挑出各用户队头连续可投递的记录再 LIMIT：被挡住的用户积压再多也占不满一批
+        picked = conn.execute(
+            f"SELECT r.id, r.username, r.memos_user_id, r.conv_id, r.messages FROM memos_outbox r "
+            f"WHERE {_READY.format(t='r')} AND NOT EXISTS (SELECT 1 FROM memos_outbox e "
+            f"WHERE e.username = r.username AND e.id < r.id AND NOT {_READY.format(t='e')}) "
+            f"ORDER BY r.id LIMIT :limit", {"now": now, "limit": limit}).fetchall()
+        if not picked:
+            return []
+        ids = [p[0] for p in picked]
+        marks = ",".join("?" * len(ids))
+        conn.execute(
+            f"UPDATE memos_outbox SET status='sending', lease_until=?, claimed_by=? "
+            f"WHERE id IN ({marks}) AND (status='pending' OR lease_until<?)",
+            [now + OUTBOX_LEASE, _CLAIM_TOKEN] + ids + [now])
+        # 只保留确实被本进程领到的（多进程时可能被抢走一部分）
+        mine = {r[0] for r in conn.execute(
+            f"SELECT id FROM memos_outbox WHERE id IN ({marks}) AND status='sending' AND claimed_by=?",
+            ids + [_CLAIM_TOKEN])}
+        conn.commit()
+    return [p for p in picked if p[0] in mine]
+
+
+def complete(ids):
+    with get_pool().connection() as conn:
+        conn.executemany("DELETE FROM memos_outbox WHERE id=?", [(i,) for i in ids])
+        conn.commit()
+
+
+def fail(ids, error):
+    """投递失败：退避后重试，超过次数标记为 failed"""
+    now = time.time()
+    with get_pool().connection() as conn:
+        for row_id in ids:
+            attempts = conn.execute("SELECT attempts FROM memos_outbox WHERE id=?", (row_id,)).fetchone()
+            if attempts is None:
+                continue
+            attempts = attempts[0] + 1
+            delay = min(OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1), OUTBOX_BACKOFF_MAX)
+            status = "failed" if attempts >= OUTBOX_MAX_ATTEMPTS else "pending"
+            conn.execute(
+                "UPDATE memos_outbox SET status=?, attempts=?, next_attempt_at=?, lease_until=0, last_error=? "
+                "WHERE id=?", (status, attempts, now + delay, error, row_id))
+        conn.commit()
+
+
+def release(ids):
+    """放回队列，不计失败次数"""
+    with get_pool().connection() as conn:
+        conn.executemany("UPDATE memos_outbox SET status='pending', lease_until=0 WHERE id=?", [(i,) for i in ids])
+        conn.commit()
+
+
+def release_mine():
+    """把本进程领走但没完成的记录放回队列（正常退出时调用）"""
+    with get_pool().connection() as conn:
+        conn.execute("UPDATE memos_outbox SET status='pending', lease_until=0 "
+                     "WHERE status='sending' AND claimed_by=?", (_CLAIM_TOKEN,))
+        conn.commit()
+
+
+def retry_failed():
+    """把所有 failed 记录放回队列（排障后手动调用）"""
+    with get_pool().connection() as conn:
+        cur = conn.execute(
+            "UPDATE memos_outbox SET status='pending', attempts=0, next_attempt_at=0 WHERE status='failed'")
+        conn.commit()
+        return cur.rowcount
+
+
+def outbox_status(limit=50):
+    """发件箱状态：各状态计数 + 最近的排队/失败记录"""
+    with get_pool().connection() as conn:
+        counts = dict(conn.execute("SELECT status, COUNT(*) FROM memos_outbox GROUP BY status").fetchall())
+        items = conn.execute(
+            "SELECT id, username, conv_id, status, attempts, next_attempt_at, last_error, created_at "
+            "FROM memos_outbox ORDER BY id DESC LIMIT ?", (limit,)
+        ).fetchall()
+    return {
+        "counts": {s: counts.get(s, 0) for s in ("pending", "sending", "failed")},
+        "items": [
+            {
+                "id": i, "username": u, "conv_id": c, "status": st, "attempts": a,
+                "next_attempt_at": n, "last_error": e, "created_at": t,
+            }
+            for i, u, c, st, a, n, e, t in items
+        ],
+    }
+
+
+# ================= 后台投递 =================
+class OutboxWorker:
+    """把发件箱里的记录批量投递到 MemOS
+
+    同一用户同一会话的连续记录合并成一次 add_message；不同用户并发投递。
+    对话落盘时（ChatWriter 提交）会唤醒它，平时按 OUTBOX_POLL_INTERVAL 轮询。
+    """
+
+    def __init__(self, memory):
+        self.memory = memory
+        self._wake = None
+        self._loop = None
+        self._task = None
+        self._stopping = False
+        self.sent = 0
+        self.failed = 0
+        self.skipped = 0
+
+    def start(self):
+        if not self.memory.available:
+            return
+        self._stopping = False
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        chat_writer.add_listener(self._notify)
+        self._task = asyncio.create_task(self._run())
+
+    def wake(self):
+        """立即投递一轮（在事件循环线程里调用）"""
+        if self._wake is not None:
+            self._wake.set()
+
+    def _notify(self, _count):
+        # 在写入线程里被调用
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._wake.set)
+
+    async def _run(self):
+        # 不能只靠 cancel 退出：唤醒和取消同时到达时，wait_for 可能吞掉取消（Python 3.11）
+        while not self._stopping:
+            try:
+                sent = await self.drain_once()
+            except Exception as e:
+                print(f"❌ 发件箱投递出错: {e}")
+                sent = 0
+            if sent:
+                continue
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def drain_once(self):
+        rows = await run_db(claim_batch)
+        if not rows:
+            return 0
+        per_user = OrderedDict()
+        for row in rows:
+            per_user.setdefault(row[1], []).append(row)
+        results = await asyncio.gather(*(self._send_user(user_rows) for user_rows in per_user.values()))
+        return sum(results)
+
+    async def _send_user(self, rows):
+        sent = 0
+        # 相邻且会话相同的记录合并成一批
+        groups = []
+        for row in rows:
+            if groups and groups[-1][0][3] == row[3]:
+                groups[-1].append(row)
+            else:
+                groups.append([row])
+        for i, group in enumerate(groups):
+            ids = [r[0] for r in group]
+            messages = [m for r in group for m in json.loads(r[4])]
+            ok = await self.memory.add(messages=messages, user_id=group[0][2], conversation_id=group[0][3])
+            if ok is None:
+                # 熔断中或线程占满，请求根本没发出去：原样放回，不消耗重试次数（MemOS 宕机不会把记录推到 failed）
+                await run_db(release, [r[0] for g in groups[i:] for r in g])
+                self.skipped += len(ids)
+                break
+            if not ok:
+                # 当前批退避重试；后面的放回队列，等队头成功后再按顺序投递
+                await run_db(fail, ids, "MemOS add_message failed")
+                await run_db(release, [r[0] for g in groups[i + 1:] for r in g])
+                self.failed += len(ids)
+                break
+            await run_db(complete, ids)
+            self.sent += len(ids)
+            sent += len(ids)
+        return sent
+
+    async def stop(self):
+        if self._task is not None:
+            self._stopping = True
+            self._wake.set()
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            await run_db(release_mine)
+
+
+if __name__ == "__main__":
+    if "--retry-failed" not in sys.argv[1:]:
+        print("用法: python outbox.py --retry-failed    # 排障后把 failed 记录放回队列（服务端运行中也可以执行）")
+        sys.exit(1)
+    from db import init_db
+    init_db()
+    print(f"✅ 已把 {retry_failed()} 条 failed 记录放回队列")
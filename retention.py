@@ -0,0 +1,324 @@
+"""chat_history 的冷热分层：旧对话归档成按用户分段的压缩文件，清空请求后台分批删除，空闲页增量回收
+
+热表只保留每个对话最近的消息（prompt、滚动摘要、本地召回都只用到这些），体积稳定，能常驻页缓存。
+只归档已经并入滚动摘要（history_summaries.upto_id）的消息，所以 prompt 不会因为归档丢上下文。
+
+    python retention.py --archive     # 立即归档一轮
+    python retention.py --purge       # 立即执行积压的清空
+    python retention.py --vacuum      # 离线整理：老库切换到增量回收模式并 VACUUM（会锁库，停服时执行）
+"""
+import os
+import sys
+import json
+import gzip
+import time
+import asyncio
+import hashlib
+
+from db import get_pool, run_db, try_lease, get_chat_page, WORKER_ID, CLEARED_UPTO
+
+# 可选依赖：装了 zstandard 就用 zstd（更快、更小），否则用 gzip
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# ================= 配置区 =================
+ARCHIVE_DIR = "archive"        # 归档文件目录：archive/<用户哈希>/<起始id>-<结束id>.jsonl.gz
+RETENTION_KEEP_LAST = 200      # 每个对话热表里保留最近多少条
+RETENTION_MAX_AGE_DAYS = 90    # 超过多少天的消息归档（即使还在最近 N 条里）
+ARCHIVE_BATCH = 2000           # 每个归档段最多多少条
+ARCHIVE_INTERVAL = 3600.0      # 归档 + 增量回收的间隔（秒）
+PURGE_BATCH = 500              # 清空时每个事务最多删多少行，避免长时间占住写锁
+PURGE_INTERVAL = 30.0          # 没被唤醒时多久检查一次积压的清空
+VACUUM_PAGES = 2000            # 每轮最多回收多少个空闲页（4KB/页）
+
+
+# ================= 归档文件 =================
+def _user_dir(username):
+    return os.path.join(ARCHIVE_DIR, hashlib.sha1(username.encode("utf-8")).hexdigest()[:16])
+
+
+def write_segment(username, rows):
+    """rows 为 [(id, role, content, timestamp)]，写成压缩的 JSONL，返回 (路径, 字节数)
+
+    先写临时文件再改名：进程中途被杀最多留下一个没登记的文件，下次归档同一批时覆盖。
+    """
+    data = "".join(json.dumps({"id": i, "role": r, "content": c, "ts": t}, ensure_ascii=False) + "\n"
+                   for i, r, c, t in rows).encode("utf-8")
+    if zstandard is not None:
+        ext, blob = ".jsonl.zst", zstandard.ZstdCompressor(level=10).compress(data)
+    else:
+        ext, blob = ".jsonl.gz", gzip.compress(data, 6)
+    directory = _user_dir(username)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{rows[0][0]}-{rows[-1][0]}{ext}")
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(blob)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return path, len(blob)
+
+
+def read_segment(path):
+    with open(path, "rb") as f:
+        blob = f.read()
+    if path.endswith(".zst"):
+        data = zstandard.ZstdDecompressor().decompress(blob)
+    else:
+        data = gzip.decompress(blob)
+    return [json.loads(line) for line in data.decode("utf-8").splitlines()]
+
+
+def read_archive(username, conv_id, before_id=None, limit=50):
+    """从该对话的归档里读 before_id 之前（更旧）的最多 limit 条，按从新到旧排列"""
+    with get_pool().connection() as conn:
+        segments = conn.execute(
+            f"SELECT path FROM archive_segments WHERE username=? AND conv_id=? AND last_id > {CLEARED_UPTO} "
+            "AND first_id < ? ORDER BY last_id DESC",
+            (username, conv_id, username, before_id if before_id is not None else 2 ** 63 - 1)).fetchall()
+    result = []
+    for (path,) in segments:
+        rows = [r for r in read_segment(path) if before_id is None or r["id"] < before_id]
+        result.extend(reversed(rows))
+        if len(result) >= limit:
+            break
+    return result[:limit]
+
+
+def read_history_page(username, conv_id, before_id=None, limit=50):
+    """给前端翻页用：先读热表，热表到头后接着读归档；返回值同 db.get_chat_page
+
+    归档的一定比热表里的旧（按 id 前缀归档），所以两段直接拼起来就是连续的。
+    """
+    messages, next_before = get_chat_page(username, conv_id, before_id, limit)
+    if next_before is not None:
+        return messages, next_before
+    stored = [m["id"] for m in messages if m["id"] is not None]  # 还没落盘的不占页大小
+    oldest = stored[0] if stored else before_id
+    need = limit - len(stored)
+    # 多读一条用来判断归档里还有没有更旧的
+    archived = read_archive(username, conv_id, oldest, need + 1)
+    if not archived:
+        return messages, None
+    older = [{"id": r["id"], "role": r["role"], "content": r["content"], "timestamp": r["ts"]}
+             for r in reversed(archived[:need])]
+    if len(archived) <= need:
+        return older + messages, None
+    return older + messages, (older[0]["id"] if older else oldest)
+
+
+# ================= 归档 =================
+def archive_limit(conn, username, conv_id, summarized_upto):
+    """该对话可以归档的 id 上界（不含）：已并入摘要，且（不在最近 N 条里，或早于保留天数）"""
+    nth = conn.execute("SELECT id FROM chat_history WHERE username=? AND conv_id=? ORDER BY id DESC LIMIT 1 OFFSET ?",
+                       (username, conv_id, RETENTION_KEEP_LAST - 1)).fetchone()
+    young = conn.execute("SELECT MIN(id) FROM chat_history WHERE username=? AND conv_id=? "
+                         "AND timestamp >= datetime('now', ?)",
+                         (username, conv_id, f"-{RETENTION_MAX_AGE_DAYS} days")).fetchone()[0]
+    by_count = nth[0] if nth else 0
+    by_age = young if young is not None else summarized_upto + 1
+    return min(summarized_upto + 1, max(by_count, by_age))
+
+
+def archive_conversation(username, conv_id, summarized_upto):
+    """把该对话可归档的消息分段写成文件并从热表删除，返回归档条数"""
+    total = 0
+    while True:
+        with get_pool().connection() as conn:
+            limit_id = archive_limit(conn, username, conv_id, summarized_upto)
+            rows = conn.execute(
+                "SELECT id, role, content, timestamp FROM chat_history WHERE username=? AND conv_id=? "
+                f"AND id > {CLEARED_UPTO} AND id < ? ORDER BY id LIMIT ?",
+                (username, conv_id, username, limit_id, ARCHIVE_BATCH)).fetchall()
+        if not rows:
+            return total
+        path, size = write_segment(username, rows)
+        with get_pool().connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "INSERT INTO archive_segments (username, conv_id, first_id, last_id, first_ts, last_ts, rows, bytes, "
+                "chars, path) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (username, conv_id, rows[0][0], rows[-1][0], rows[0][3], rows[-1][3], len(rows), size,
+                 sum(len(r[2]) for r in rows), path))
+            # 搬进归档不算删除：置上 archiving 让 user_stats_del 触发器不扣统计（提交前复位，别的连接看不到）
+            conn.execute("UPDATE meta SET value=1 WHERE key='archiving'")
+            conn.execute("DELETE FROM chat_history WHERE username=? AND conv_id=? AND id BETWEEN ? AND ?",
+                         (username, conv_id, rows[0][0], rows[-1][0]))
+            conn.execute("UPDATE meta SET value=0 WHERE key='archiving'")
+            conn.commit()
+        total += len(rows)
+        if len(rows) < ARCHIVE_BATCH:
+            return total
+
+
+def archive_pass():
+    """归档一轮：只看摘要水位之下还有热数据的对话"""
+    with get_pool().connection() as conn:
+        convs = conn.execute(
+            "SELECT s.username, s.conv_id, s.upto_id FROM history_summaries s WHERE EXISTS "
+            "(SELECT 1 FROM chat_history h WHERE h.username = s.username AND h.conv_id = s.conv_id "
+            "AND h.id <= s.upto_id)").fetchall()
+    return sum(archive_conversation(username, conv_id, upto) for username, conv_id, upto in convs)
+
+
+# ================= 清空 =================
+def purge_clears():
+    """执行 clear_chat_history 留下的清空水位：分批删热表、删归档文件，完成后撤掉水位，返回删除的行数"""
+    with get_pool().connection() as conn:
+        clears = conn.execute("SELECT username, upto_id FROM history_clears").fetchall()
+    total = 0
+    for username, upto in clears:
+        while True:
+            with get_pool().connection() as conn:
+                n = conn.execute(
+                    "DELETE FROM chat_history WHERE id IN "
+                    "(SELECT id FROM chat_history WHERE username=? AND id<=? LIMIT ?)",
+                    (username, upto, PURGE_BATCH)).rowcount
+                conn.commit()
+            total += n
+            if n < PURGE_BATCH:
+                break
+        with get_pool().connection() as conn:
+            segments = conn.execute("SELECT id, path FROM archive_segments WHERE username=? AND last_id<=?",
+                                    (username, upto)).fetchall()
+        for _, path in segments:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        with get_pool().connection() as conn:
+            if segments:
+                # 归档时没扣的统计这时扣掉（chars 为空的是老的归档段，归档时已经扣过了）
+                marks = ",".join("?" * len(segments))
+                rows, chars = conn.execute(
+                    f"SELECT COALESCE(SUM(rows), 0), COALESCE(SUM(chars), 0) FROM archive_segments "
+                    f"WHERE id IN ({marks}) AND chars IS NOT NULL", [i for i, _ in segments]).fetchone()
+                conn.execute("UPDATE user_stats SET messages = messages - ?, chars = chars - ? WHERE username=?",
+                             (rows, chars, username))
+                conn.execute("UPDATE meta SET value = value + 1 WHERE key='history_version'")
+            conn.executemany("DELETE FROM archive_segments WHERE id=?", [(i,) for i, _ in segments])
+            # 期间又清空过一次（水位变了）就留到下一轮
+            conn.execute("DELETE FROM history_clears WHERE username=? AND upto_id=?", (username, upto))
+            conn.commit()
+    return total
+
+
+# ================= 空间回收 =================
+def incremental_vacuum(pages=VACUUM_PAGES):
+    """回收最多 pages 个空闲页，返回回收数；库不是增量回收模式（老库没整理过）时什么都不做"""
+    with get_pool().connection() as conn:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            return 0
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if free:
+            # execute() 只 step 一次（每次只回收一页），executescript 会一直执行到完成
+            conn.executescript(f"PRAGMA incremental_vacuum({pages})")
+        return min(free, pages)
+
+
+def full_vacuum():
+    """离线整理：切换到增量回收模式并重写整个库"""
+    with get_pool().connection() as conn:
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+
+
+def retention_stats():
+    with get_pool().connection() as conn:
+        segments, rows, size = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(rows), 0), COALESCE(SUM(bytes), 0) FROM archive_segments").fetchone()
+        pending = conn.execute("SELECT COUNT(*) FROM history_clears").fetchone()[0]
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        pages = conn.execute("PRAGMA page_count").fetchone()[0]
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    return {
+        "archived_segments": segments,
+        "archived_rows": rows,
+        "archived_bytes": size,
+        "pending_clears": pending,
+        "db_bytes": pages * page_size,
+        "free_bytes": free * page_size,
+    }
+
+
+# ================= 后台任务 =================
+class RetentionWorker:
+    """后台执行清空、归档和空间回收
+
+    清空请求会唤醒它立即删除，平时每 PURGE_INTERVAL 检查一次；
+    归档和回收每 ARCHIVE_INTERVAL 一轮，多 worker 时只由持有租约的进程执行。
+    """
+
+    def __init__(self):
+        self._wake = None
+        self._task = None
+        self._stopping = False
+        self._next_archive = 0.0
+        self.archived = 0
+        self.purged = 0
+        self.vacuumed_pages = 0
+
+    def start(self):
+        self._stopping = False
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    def wake(self):
+        if self._wake is not None:
+            self._wake.set()
+
+    async def _run(self):
+        # 和 OutboxWorker 一样靠 _stopping 退出，不只靠 cancel
+        while not self._stopping:
+            try:
+                self.purged += await run_db(purge_clears)
+                if time.monotonic() >= self._next_archive:
+                    self._next_archive = time.monotonic() + ARCHIVE_INTERVAL
+                    if await run_db(try_lease, "retention", WORKER_ID, ARCHIVE_INTERVAL * 2):
+                        archived = await run_db(archive_pass)
+                        if archived:
+                            print(f"🗄️ 已归档 {archived} 条旧对话")
+                        self.archived += archived
+                        self.vacuumed_pages += await run_db(incremental_vacuum)
+            except Exception as e:
+                print(f"⚠️ 历史归档/清理出错: {e}")
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), PURGE_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    def snapshot(self):
+        return {"archived": self.archived, "purged": self.purged, "vacuumed_pages": self.vacuumed_pages}
+
+    async def stop(self):
+        if self._task is not None:
+            self._stopping = True
+            self._wake.set()
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+if __name__ == "__main__":
+    args = set(sys.argv[1:])
+    if not args & {"--archive", "--purge", "--vacuum"}:
+        print(__doc__)
+        sys.exit(1)
+    from db import init_db
+    init_db()
+    if "--purge" in args:
+        print(f"🧹 已删除 {purge_clears()} 条清空的历史")
+    if "--archive" in args:
+        print(f"🗄️ 已归档 {archive_pass()} 条旧对话")
+    if "--vacuum" in args:
+        start = time.perf_counter()
+        full_vacuum()
+        print(f"✅ VACUUM 完成，耗时 {time.perf_counter() - start:.1f}s")
+    print(retention_stats())
@@ -1,32 +1,73 @@
 import uvicorn
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, PlainTextResponse, Response
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
-import sqlite3
-import hashlib
-import uuid
 import os
 import json
+import gzip
+import hashlib
+import time
 import asyncio
-from openai import AsyncOpenAI  # 🔥 使用 OpenAI SDK
+from contextlib import asynccontextmanager
 
 # --- 保留 Memos 用于记忆 ---
 from memos.api.client import MemOSClient
 
+# --- 数据访问层（连接池 + WAL） ---
+from memos_adapter import MemoryAdapter
+from outbox import OutboxWorker, outbox_status, retry_failed
+from greetings import GreetingService, get_greeting, save_greeting
+from context import assemble_messages, get_history_summary, HistorySummarizer, count_tokens
+from answer_cache import answer_cache, replay, ANSWER_CACHE_ENABLED
+from streaming import wants_ndjson, frame, coalesce, BlockTracker, NDJSON_MEDIA_TYPE
+from admission import admission, AdmissionRejected
+from llm_pool import LLMPool, load_endpoints  # 🔥 OpenAI SDK（多上游）
+import local_recall
+from local_recall import LocalRecall
+from memory_context import memory_compressor
+from retention import RetentionWorker, retention_stats, read_history_page
+from static_assets import StaticAssets
+import metrics
+from metrics import timed, timed_await, observe, annotate, current_request_id, RequestMetricsMiddleware
+
+from db import init_db, get_user, create_user, verify_user, get_chat_history, queue_chat_messages, \
+    clear_chat_history, run_db, chat_writer, close_pool, user_cache, recent_history, \
+    create_conversation, switch_conversation, list_conversations
+
 # ================= 配置区 =================
 OPENAI_API_KEY = "yourapi"
 OPENAI_BASE_URL = "your_url"
 OPENAI_MODEL = "your_model"
 MEMOS_API_KEY = "yourapi"
-DB_FILE = "users.db"
-
-# 初始化 OpenAI Client
-openai_client = AsyncOpenAI(
-    api_key=OPENAI_API_KEY,
-    base_url=OPENAI_BASE_URL,
-    default_headers={"x-foo": "true"}
-)
+HISTORY_LIMIT = 20  # 20条=10轮对话
+HISTORY_PAGE_SIZE = 30  # 前端恢复对话时每页多少条（首屏只拉最新一页，往上滚再拉更早的）
+HISTORY_PAGE_MAX = 200
+GZIP_MIN_BYTES = 1024  # 超过这个大小的 JSON 响应才压缩
+# /chat 记忆检索的延迟预算（秒）。None 表示一直等到检索结束（或适配器超时）；
+# 设置后超出预算就先用登录时预热的基础记忆开始生成，检索在后台继续并写入缓存
+RECALL_BUDGET = None
+BASELINE_MEMORY_QUERY = "用户的学习历史、数学水平、性格特点、过往对话"
+# /chat 长期记忆的来源：
+#   "memos"       只用 MemOS
+#   "fallback"    先 MemOS，失败/超时/没结果时用本地旧对话索引（local_recall.py）
+#   "local_first" 先查本地索引，没命中再问 MemOS
+#   "merge"       两边并发，结果合并
+RECALL_POLICY = "fallback"
+STREAM_USAGE = True  # 流式请求时让上游在最后一块返回 token 用量（不支持 stream_options 的服务商改为 False）
+# worker 进程数（环境变量 NEWTON_WORKERS）。大于 1 时各进程共用 users.db：
+# 每用户并发和后台任务靠库里的租约协调，记忆缓存靠 meta 计数跨进程失效，最近消息窗口关闭
+WORKERS = int(os.environ.get("NEWTON_WORKERS", "1"))
+
+# 初始化 OpenAI 上游池：llm_endpoints.json 或环境变量 LLM_ENDPOINTS 可配置多个上游，否则只用上面这一个
+llm = LLMPool(load_endpoints(default={
+    "name": "default",
+    "base_url": OPENAI_BASE_URL,
+    "api_key": OPENAI_API_KEY,
+    "model": OPENAI_MODEL,
+    "headers": {"x-foo": "true"},
+}))
 
 # 初始化 Memos
 try:
@@ -35,147 +76,129 @@ try:
 except:
     mem_client = None
 
+# 所有 MemOS 调用都走异步适配器（有界线程池 + 截止时间 + 熔断）
+memory = MemoryAdapter(mem_client)
+# 对话结束后的记忆写入先落到 users.db 的发件箱，由后台批量投递
+outbox_worker = OutboxWorker(memory)
+# 清空历史的后台删除、旧对话归档和空间回收
+retention_worker = RetentionWorker()
+# 本地旧对话索引：每批对话写入时在同一个事务里增量更新
+local_index = LocalRecall(window=HISTORY_LIMIT)
+if RECALL_POLICY != "memos":
+    chat_writer.add_batch_hook(local_recall.index_new_rows)
+# 前端页面和静态资源（build_static.py 的产物，启动时读进内存）
+static_assets = StaticAssets()
+
+if WORKERS > 1:
+    recent_history.enabled = False
+    memory.recall_cache.shared = True
+    admission.configure(WORKERS)
+
+
+# 后台任务需要保留引用，否则可能被垃圾回收
+_background_tasks = set()
 
-# ================= 数据库 =================
-def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute(
-        '''CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, password_hash TEXT, memos_user_id TEXT, current_conv_id TEXT)''')
-    # 新增对话历史表
-    c.execute(
-        '''CREATE TABLE IF NOT EXISTS chat_history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT,
-            role TEXT,
-            content TEXT,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-        )''')
-    conn.commit()
-    conn.close()
-
-
-def get_user(username):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE username=?", (username,))
-    user = c.fetchone()
-    conn.close()
-    return user
-
-
-def create_user(username, password):
-    if get_user(username): return False
-    memos_uid = f"user_{username}_{str(uuid.uuid4())[:8]}"
-    pwd_hash = hashlib.sha256(password.encode()).hexdigest()
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("INSERT INTO users VALUES (?, ?, ?, ?)", (username, pwd_hash, memos_uid, "conv_default"))
-    conn.commit()
-    conn.close()
-    return True
-
-
-def verify_user(username, password):
-    user = get_user(username)
-    if not user: return False
-    return user[1] == hashlib.sha256(password.encode()).hexdigest()
-
-
-# 对话历史管理函数
-def get_chat_history(username, limit=10):
-    """获取用户最近的对话历史"""
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute(
-        "SELECT role, content FROM chat_history WHERE username=? ORDER BY id DESC LIMIT ?",
-        (username, limit)
-    )
-    rows = c.fetchall()
-    conn.close()
-    # 反转顺序（从旧到新）
-    return [{"role": role, "content": content} for role, content in reversed(rows)]
-
-
-# MemOS 数据解析函数
-def parse_memos_result(memos_result: dict) -> dict:
-    """解析 MemOS 返回的结果，提取关键信息"""
-    parsed = {
-        "memories": [],
-        "preferences": [],
-        "summary": ""
-    }
-    
-    # 提取记忆列表
-    if "memory_detail_list" in memos_result:
-        for mem in memos_result["memory_detail_list"]:
-            parsed["memories"].append({
-                "key": mem.get("memory_key", ""),
-                "value": mem.get("memory_value", ""),
-                "tags": mem.get("tags", []),
-                "relativity": mem.get("relativity", 0)
-            })
-    
-    # 提取偏好列表
-    if "preference_detail_list" in memos_result:
-        for pref in memos_result["preference_detail_list"]:
-            parsed["preferences"].append({
-                "preference": pref.get("preference", ""),
-                "reasoning": pref.get("reasoning", "")
-            })
-    
-    # 生成简洁摘要（给AI看的）
-    memory_texts = []
-    if parsed["memories"]:
-        # 取前5条最相关的记忆
-        top_memories = sorted(parsed["memories"], key=lambda x: x["relativity"], reverse=True)[:5]
-        for m in top_memories:
-            # 提取memory_value的主要内容
-            value = m['value'][:200] if len(m['value']) > 200 else m['value']
-            memory_texts.append(f"• {m['key']}: {value}")
-    
-    pref_texts = []
-    if parsed["preferences"]:
-        # 取前3条偏好
-        for p in parsed["preferences"][:3]:
-            pref_texts.append(f"• {p['preference'][:100]}")
-    
-    summary_parts = []
-    if memory_texts:
-        summary_parts.append("【历史记忆】\n" + "\n".join(memory_texts))
-    if pref_texts:
-        summary_parts.append("【用户偏好】\n" + "\n".join(pref_texts))
-    
-    parsed["summary"] = "\n\n".join(summary_parts) if summary_parts else ""
-    
-    return parsed
 
+def spawn(coro):
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
 
-def save_chat_message(username, role, content):
-    """保存单条对话消息"""
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute(
-        "INSERT INTO chat_history (username, role, content) VALUES (?, ?, ?)",
-        (username, role, content)
+
+async def recall_memory(memos_uid, conv_id, query, budget=None):
+    """检索并解析长期记忆，返回给 AI 看的摘要（没有记忆时返回空串）
+
+    budget 不为 None 时最多等 budget 秒；超时后检索在后台继续（结果进缓存），
+    本次先用登录时预热的基础记忆。
+    """
+    if not memory.available:
+        return ""
+    try:
+        search = spawn(memory.search(query=query, user_id=memos_uid, conversation_id=conv_id))
+        if budget is None:
+            res = await search
+        else:
+            try:
+                res = await asyncio.wait_for(asyncio.shield(search), budget)
+            except asyncio.TimeoutError:
+                res = memory.recall_cache.peek(memos_uid, conv_id, BASELINE_MEMORY_QUERY)
+                print(f"⏱️ 记忆检索超出 {budget}s 预算，使用{'基础记忆' if res else '空记忆'}先行生成")
+
+        # top-k + 近似去重 + 按句截断，同样的检索结果直接复用渲染好的摘要
+        parsed = memory_compressor.render(res, memos_uid)
+        if parsed["summary"]:
+            print(f"✅ 检索到 {parsed['memories']} 条记忆, {parsed['preferences']} 条偏好"
+                  + (f"（合并 {parsed['merged']} 条重复）" if parsed["merged"] else ""))
+        else:
+            print(f"ℹ️ 未检索到相关记忆")
+        return parsed["summary"]
+    except Exception as e:
+        print(f"⚠️ MemOS检索失败: {e}")
+        return ""
+
+
+async def recall_context(username, memos_uid, conv_id, query, budget=None):
+    """按 RECALL_POLICY 组合 MemOS 与本地索引（都只在当前对话里找），返回给 AI 看的长期记忆摘要"""
+    if RECALL_POLICY == "local_first":
+        return await local_index.recall(username, conv_id, query) or \
+            await recall_memory(memos_uid, conv_id, query, budget=budget)
+    if RECALL_POLICY == "merge":
+        remote, local = await asyncio.gather(recall_memory(memos_uid, conv_id, query, budget=budget),
+                                             local_index.recall(username, conv_id, query))
+        return "\n\n".join(part for part in (remote, local) if part)
+    remote = await recall_memory(memos_uid, conv_id, query, budget=budget)
+    if remote or RECALL_POLICY == "memos":
+        return remote
+    return await local_index.recall(username, conv_id, query)
+
+
+async def warm_user(username):
+    """登录成功后预热：填充最近消息窗口、把基础记忆检索进缓存，首次 /chat 和 /api/greet 不用走冷路径"""
+    user = await run_db(get_user, username)
+    if not user:
+        return
+    await asyncio.gather(
+        run_db(get_chat_history, username, user[3], limit=HISTORY_LIMIT),
+        memory.search(query=BASELINE_MEMORY_QUERY, user_id=user[2], conversation_id=user[3]),
+        return_exceptions=True,
     )
-    conn.commit()
-    conn.close()
 
 
-def clear_chat_history(username):
-    """清除用户的对话历史"""
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("DELETE FROM chat_history WHERE username=?", (username,))
-    conn.commit()
-    conn.close()
+def too_busy(e):
+    """准入被拒时的快速 429，带上建议的重试间隔"""
+    print(f"🚦 上游繁忙（{e.reason}），建议 {e.retry_after}s 后重试")
+    return HTTPException(429, "Newton is busy, please retry shortly", headers={"Retry-After": str(e.retry_after)})
 
 
 # ================= FastAPI =================
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+    static_assets.load()
+    outbox_worker.start()
+    greeting_service.start()
+    retention_worker.start()
+    if RECALL_POLICY != "memos":
+        # 老库第一次启用或上次退出时的积压：后台补建索引
+        spawn(run_db(local_recall.catch_up))
+    yield
+    await greeting_service.stop()
+    await summarizer.stop()
+    # 退出前把写入队列里还没落盘的对话全部提交
+    await asyncio.to_thread(chat_writer.stop)
+    await outbox_worker.stop()
+    await retention_worker.stop()
+    close_pool()
+    memory.close()
+    await llm.close()
+
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"],
+                   expose_headers=["Retry-After", "ETag"],
                    allow_headers=["*"])
+# 每个请求分配 request_id，记录各阶段耗时和 JSON 访问日志
+app.add_middleware(RequestMetricsMiddleware)
 
 
 class AuthRequest(BaseModel):
@@ -196,100 +219,123 @@ class ClearHistoryRequest(BaseModel):
     userId: str
 
 
+class NewConversationRequest(BaseModel):
+    userId: str
+    title: str = None
+
+
+class SwitchConversationRequest(BaseModel):
+    userId: str
+    convId: str
+
+
 @app.post("/api/register")
 async def register(req: AuthRequest):
-    return {"success": True, "message": "Account created"} if create_user(req.username, req.password) else {
+    return {"success": True, "message": "Account created"} if await run_db(create_user, req.username, req.password) else {
         "success": False, "message": "Username exists"}
 
 
 @app.post("/api/login")
 async def login(req: AuthRequest):
-    return {"success": True, "message": "Login successful"} if verify_user(req.username, req.password) else {
-        "success": False, "message": "Invalid credentials"}
+    if not await run_db(verify_user, req.username, req.password):
+        return {"success": False, "message": "Invalid credentials"}
+    spawn(warm_user(req.username))
+    return {"success": True, "message": "Login successful"}
 
 
 # === 问候接口 (OpenAI SDK + MemOS 记忆检索) ===
-@app.post("/api/greet")
-async def greet_endpoint(req: GreetRequest):
-    user = get_user(req.userId)
-    if not user: raise HTTPException(401, "User not found")
-    
-    memos_uid, conv_id = user[2], user[3]
-    
-    # 🔥 从 MemOS 检索用户记忆
-    memory_context = ""
-    if mem_client:
-        try:
-            print(f"🧠 检索 {req.userId} 的记忆...")
-            # 检索与用户特征相关的记忆
-            res = mem_client.search_memory(
-                query="用户的学习历史、数学水平、性格特点、过往对话",
-                user_id=memos_uid,
-                conversation_id=conv_id
-            )
-            
-            # 解析记忆
-            parsed = parse_memos_result(res)
-            if parsed["summary"]:
-                memory_context = f"\n\n{parsed['summary']}"
-                print(f"✅ 检索到 {len(parsed['memories'])} 条记忆, {len(parsed['preferences'])} 条偏好")
-        except Exception as e:
-            print(f"⚠️ Greet记忆检索失败: {e}")
+DEFAULT_GREETING = "欢迎回到自然哲学的殿堂。"
+
+
+async def build_greet_prompt(username, memos_uid, conv_id, fresh=False):
+    """检索用户记忆并构造问候提示词；fresh=True 时绕过检索缓存，拿最新的记忆"""
+    print(f"🧠 检索 {username} 的记忆...")
+    if fresh and memory.available:
+        res = await memory.search(query=BASELINE_MEMORY_QUERY, user_id=memos_uid, conversation_id=conv_id,
+                                  use_cache=False)
+        summary = memory_compressor.render(res, memos_uid)["summary"]
+    else:
+        summary = await recall_memory(memos_uid, conv_id, BASELINE_MEMORY_QUERY)
+    memory_context = f"\n\n{summary}" if summary else ""
     
     # 简化提示词
     if memory_context:
-        prompt_text = f"用户{req.userId}登录了。你对他的记忆：{memory_context}。请用严谨、古典的牛顿语气写一句简短问候（50字内）。"
-    else:
-        prompt_text = f"用户{req.userId}登录了。请用严谨、古典的牛顿语气写一句简短问候（50字内）。"
-    
-    greeting = "欢迎回到自然哲学的殿堂。"
-    try:
-        # 🔥 使用 OpenAI SDK 生成个性化问候
-        completion = await openai_client.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=[{"role": "user", "content": prompt_text}]
-        )
-        greeting = completion.choices[0].message.content
-        print(f"💬 生成问候: {greeting[:50]}...")
-    except Exception as e:
-        print(f"❌ Greeting生成失败: {e}")
+        return f"用户{username}登录了。你对他的记忆：{memory_context}。请用严谨、古典的牛顿语气写一句简短问候（50字内）。"
+    return f"用户{username}登录了。请用严谨、古典的牛顿语气写一句简短问候（50字内）。"
 
-    return {"greeting": greeting}
 
+async def generate_greeting(username):
+    """后台预生成问候：用最新记忆调用一次 LLM（非流式）"""
+    user = await run_db(get_user, username)
+    if not user:
+        return None
+    prompt_text = await build_greet_prompt(username, user[2], user[3], fresh=True)
+    completion = await llm.complete([{"role": "user", "content": prompt_text}])
+    return completion.choices[0].message.content
 
-# === 对话接口 (OpenAI SDK 流式实现 + 多轮对话 + MemOS深度集成) ===
-@app.post("/chat")
-async def chat_endpoint(req: ChatRequest):
-    user = get_user(req.userId)
-    if not user: raise HTTPException(401, "User not found")
-    memos_uid, conv_id = user[2], user[3]
 
-    # 获取短期对话历史（最近10轮）
-    history = get_chat_history(req.userId, limit=20)  # 20条=10轮对话
+greeting_service = GreetingService(generate_greeting)
+
+
+@app.post("/api/greet")
+async def greet_endpoint(req: GreetRequest):
+    annotate(user=req.userId)
+    with timed("user_lookup"):
+        user = await run_db(get_user, req.userId)
+    if not user: raise HTTPException(401, "User not found")
     
-    # 🔥 检索长期记忆（MemOS）
-    memory_context = ""
-    if mem_client:
+    # 有预生成的问候就直接返回
+    with timed("greeting_read"):
+        stored = await run_db(get_greeting, req.userId)
+    if stored:
+        annotate(greeting="stored")
+        return {"greeting": stored[0], "version": stored[1]}
+
+    # 没有时现场流式生成一条，并存下来供下次登录使用；上游繁忙时先用默认问候，不让登录卡住
+    try:
+        ticket = await admission.acquire(req.userId)
+    except AdmissionRejected:
+        return {"greeting": DEFAULT_GREETING, "version": 0}
+    memos_uid, conv_id = user[2], user[3]
+    try:
+        with timed("memory_recall"):
+            prompt_text = await build_greet_prompt(req.userId, memos_uid, conv_id)
+    except BaseException:
+        ticket.release()
+        raise
+
+    async def greeting_generator():
+        greeting = ""
+        t_call = time.perf_counter()
+        t_first = None
         try:
-            print(f"🔍 MemOS检索中: {req.message[:50]}...")
-            res = mem_client.search_memory(
-                query=req.message, 
-                user_id=memos_uid, 
-                conversation_id=conv_id
-            )
-            
-            # 使用专门的解析函数
-            parsed = parse_memos_result(res)
-            if parsed["summary"]:
-                memory_context = parsed["summary"]
-                print(f"✅ 检索到 {len(parsed['memories'])} 条记忆, {len(parsed['preferences'])} 条偏好")
-            else:
-                print(f"ℹ️ 未检索到相关记忆")
+            # 🔥 使用 OpenAI SDK 流式生成个性化问候
+            stream = llm.stream_chat([{"role": "user", "content": prompt_text}])
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    if t_first is None:
+                        t_first = time.perf_counter()
+                        observe("ttft", t_first - t_call)
+                    greeting += chunk.choices[0].delta.content
+                    yield chunk.choices[0].delta.content
+            if t_first is not None:
+                observe("stream", time.perf_counter() - t_first)
+            print(f"💬 生成问候: {greeting[:50]}...")
         except Exception as e:
-            print(f"⚠️ MemOS检索失败: {e}")
+            print(f"❌ Greeting生成失败: {e}")
+            if not greeting:
+                yield DEFAULT_GREETING
+            return
+        finally:
+            ticket.release()
+        if greeting:
+            await run_db(save_greeting, req.userId, greeting)
+
+    return StreamingResponse(greeting_generator(), media_type="text/plain", background=BackgroundTask(ticket.aclose))
+
 
-    # B. 构造 Prompt
-    system_instruction = """
+# === 对话接口 (OpenAI SDK 流式实现 + 多轮对话 + MemOS深度集成) ===
+SYSTEM_INSTRUCTION = """
     【角色设定】你是艾萨克·牛顿爵士。
     【行为准则】
     1. 利用【记忆片段】回答，不要暴露你是读数据库。
@@ -297,70 +343,195 @@ async def chat_endpoint(req: ChatRequest):
     3. 性格严谨、古典、傲慢。
     4. 如果没有要求,请说中文
     """
+
+
+async def summarize_history(old_summary, old_messages):
+    """把滑出窗口的旧对话并入滚动摘要（非流式 LLM 调用，后台执行）"""
+    transcript = "\n".join(f"{'学生' if m['role'] == 'user' else '牛顿'}: {m['content']}" for m in old_messages)
+    prompt_text = (
+        "请把下面的师生对话压缩成要点摘要，保留学生的水平、卡住的地方、已经讲过的结论和关键公式，"
+        "每条一行，总长不超过300字。\n"
+        f"【已有摘要】\n{old_summary or '（无）'}\n【新增对话】\n{transcript}"
+    )
+    completion = await llm.complete([{"role": "user", "content": prompt_text}])
+    return completion.choices[0].message.content
+
+
+summarizer = HistorySummarizer(summarize_history, window=HISTORY_LIMIT)
+
+
+@app.post("/chat")
+async def chat_endpoint(req: ChatRequest, request: Request):
+    t_start = time.perf_counter()
+    annotate(user=req.userId)
+    with timed("user_lookup"):
+        user = await run_db(get_user, req.userId)
+    if not user: raise HTTPException(401, "User not found")
+    memos_uid, conv_id = user[2], user[3]
+    # 队列已满时立刻 429，不必先做检索
+    try:
+        admission.check(req.userId)
+    except AdmissionRejected as e:
+        raise too_busy(e)
+
+    # 短期对话历史、早前对话摘要与长期记忆（MemOS）互不依赖，并发获取
+    print(f"🔍 MemOS检索中: {req.message[:50]}...")
+    history, summary, memory_context = await asyncio.gather(
+        timed_await("history_read", run_db(get_chat_history, req.userId, conv_id, limit=HISTORY_LIMIT)),
+        timed_await("summary_read", run_db(get_history_summary, req.userId, conv_id)),
+        timed_await("memory_recall", recall_context(req.userId, memos_uid, conv_id, req.message, budget=RECALL_BUDGET)),
+    )
+
+    # B. 在 token 预算内构造 Prompt（问题只作为最后一条 user 消息出现一次）
+    with timed("prompt_build"):
+        messages, ctx_stats = assemble_messages(SYSTEM_INSTRUCTION, req.message, history,
+                                                memory_context=memory_context, summary=summary)
     
-    # 构造系统消息
-    if memory_context:
-        system_message = f"【系统指令】{system_instruction}\n【记忆】{memory_context}\n【问题】{req.message}"
-    else:
-        system_message = f"【系统指令】{system_instruction}\n【问题】{req.message}"
-    
-    # 构建完整的消息列表
-    messages = [{"role": "system", "content": system_message}]
-    messages.extend(history)  # 短期历史
-    messages.append({"role": "user", "content": req.message})  # 当前问题
-    
-    print(f"💬 短期历史: {len(history)//2}轮 | 长期记忆: {'有' if memory_context else '无'} | 总消息: {len(messages)}")
+    print(f"💬 短期历史: {ctx_stats['history_kept']//2}轮 (丢弃 {ctx_stats['history_dropped']} 条) | "
+          f"长期记忆: {'有' if memory_context else '无'} | 摘要: {'有' if summary else '无'} | "
+          f"约 {ctx_stats['tokens']} tokens")
+
+    # 答案缓存（可选）：只有 prompt 里没有任何个性化内容时，同一道题的回答才能共享
+    cache_key = None
+    if ANSWER_CACHE_ENABLED and not (memory_context or summary or history):
+        cache_key = answer_cache.key_for(req.message)
+    cached_answer = answer_cache.get(cache_key) if cache_key else None
+    annotate(cached=cached_answer is not None)
+
+    # 准入控制：回放缓存不占上游，其余排队等空位（全局并发 + 每用户一路 + 轮转公平）
+    ticket = None
+    if cached_answer is None:
+        try:
+            ticket = await admission.acquire(req.userId)
+        except AdmissionRejected as e:
+            raise too_busy(e)
+        observe("queue_wait", ticket.waited)
+        if ticket.waited > 0.5:
+            print(f"🚦 {req.userId} 排队 {ticket.waited:.1f}s 后开始生成")
+
+    usage = {}
+    t_ready = time.perf_counter()
+
+    async def token_source():
+        """逐个产出回答的文本增量（缓存回放或上游流式）"""
+        if cached_answer is not None:
+            print(f"📦 命中答案缓存，回放中...")
+            async for piece in replay(cached_answer):
+                yield piece
+            return
+
+        print(f"⚡ DEBUG: 使用 OpenAI SDK 流式调用 (多轮对话)...")
+        
+        # 🔥 使用 OpenAI SDK 流式调用，传递完整的消息历史
+        extra = {"stream_options": {"include_usage": True}} if STREAM_USAGE else {}
+        # 出字前失败会自动换上游；开启对冲时首字太慢会向另一个上游并发一份
+        t_call = time.perf_counter()
+        t_first = None
+        stream = llm.stream_chat(messages, **extra)
+
+        # 流式输出
+        async for chunk in stream:
+            if getattr(chunk, "usage", None):
+                usage.update(chunk.usage.model_dump(exclude_none=True))
+            if chunk.choices and len(chunk.choices) > 0:
+                if chunk.choices[0].delta.content:
+                    if t_first is None:
+                        t_first = time.perf_counter()
+                        observe("ttft", t_first - t_call)
+                    yield chunk.choices[0].delta.content  # 🔥 直接吐出字符
+        if t_first is not None:
+            observe("stream", time.perf_counter() - t_first)
+
+    def finish_turn(full_text):
+        if cache_key and cached_answer is None and full_text:
+            answer_cache.put(cache_key, full_text)
+
+        # 保存本轮对话到数据库；MemOS 可用时同一事务写入发件箱，由后台投递，不占用这条连接
+        if full_text:
+            queue_chat_messages(req.userId, conv_id, [("user", req.message), ("assistant", full_text)],
+                                memos_uid=memos_uid if memory.available else None)
+            print(f"💾 对话已加入写入队列")
+            # 对话告一段落后，在后台为下次登录预生成问候，并把滑出窗口的旧对话并入摘要
+            greeting_service.schedule(req.userId)
+            summarizer.schedule(req.userId, conv_id)
+
+    def release_slot():
+        if ticket is not None:
+            ticket.release()
 
     async def response_generator():
         full_text = ""
         try:
-            print(f"⚡ DEBUG: 使用 OpenAI SDK 流式调用 (多轮对话)...")
-            
-            # 🔥 使用 OpenAI SDK 流式调用，传递完整的消息历史
-            stream = await openai_client.chat.completions.create(
-                model=OPENAI_MODEL,
-                messages=messages,
-                stream=True
-            )
-
-            # 流式输出
-            async for chunk in stream:
-                if chunk.choices and len(chunk.choices) > 0:
-                    if chunk.choices[0].delta.content:
-                        content = chunk.choices[0].delta.content
-                        full_text += content
-                        yield content  # 🔥 直接吐出字符
-
-            # 保存本轮对话到数据库
-            if full_text:
-                await asyncio.to_thread(save_chat_message, req.userId, "user", req.message)
-                await asyncio.to_thread(save_chat_message, req.userId, "assistant", full_text)
-                print(f"💾 对话已保存到数据库")
-            
-            # 存储到 Memos（如果可用）
-            if mem_client and full_text:
-                msgs = [{"role": "user", "content": req.message}, {"role": "assistant", "content": full_text}]
-                await asyncio.to_thread(mem_client.add_message, messages=msgs, user_id=memos_uid,
-                                        conversation_id=conv_id)
-                print(f"💾 Memory saved to Memos.")
+            async for piece in token_source():
+                full_text += piece
+                yield piece
+            release_slot()
+            finish_turn(full_text)
 
         except Exception as e:
             print(f"❌ Error: {e}")
             import traceback
             traceback.print_exc()
             yield f"\n[Network Error: {str(e)}]"
+        finally:
+            release_slot()
+
+    async def ndjson_generator():
+        """分帧协议：meta 帧 -> 若干 delta 帧（合并后的增量 + 稳定前缀长度）-> done 帧（耗时与用量）"""
+        yield frame({
+            "type": "meta",
+            "request_id": current_request_id(),
+            "prep_ms": round((t_ready - t_start) * 1000, 1),
+            "queue_ms": round(ticket.waited * 1000, 1) if ticket else 0.0,
+            "history": ctx_stats["history_kept"],
+            "memory": bool(memory_context),
+            "cached": cached_answer is not None,
+        })
+        tracker = BlockTracker()
+        ttft = None
+        try:
+            async for piece in coalesce(token_source()):
+                if ttft is None:
+                    ttft = time.perf_counter() - t_start
+                stable = tracker.feed(piece)
+                yield frame({"type": "delta", "text": piece, "stable": stable})
+            release_slot()
+            full_text = tracker.text
+            finish_turn(full_text)
+            if not usage:
+                # 上游没返回用量（或回放缓存）时按本地计数估算
+                usage.update(prompt_tokens=ctx_stats["tokens"], completion_tokens=count_tokens(full_text),
+                             estimated=True)
+            yield frame({
+                "type": "done",
+                "ttft_ms": round(ttft * 1000, 1) if ttft is not None else None,
+                "total_ms": round((time.perf_counter() - t_start) * 1000, 1),
+                "usage": usage,
+            })
+        except Exception as e:
+            print(f"❌ Error: {e}")
+            import traceback
+            traceback.print_exc()
+            yield frame({"type": "error", "message": str(e)})
+        finally:
+            release_slot()
 
-    return StreamingResponse(response_generator(), media_type="text/plain")
+    # 生成器没来得及启动（客户端提前断开）时，由后台任务兜底归还名额
+    background = BackgroundTask(ticket.aclose) if ticket else None
+    if wants_ndjson(request):
+        return StreamingResponse(ndjson_generator(), media_type=NDJSON_MEDIA_TYPE, background=background)
+    return StreamingResponse(response_generator(), media_type="text/plain", background=background)
 
 
 # === 清除对话历史接口 ===
 @app.post("/api/clear-history")
 async def clear_history_endpoint(req: ClearHistoryRequest):
-    user = get_user(req.userId)
+    user = await run_db(get_user, req.userId)
     if not user: raise HTTPException(401, "User not found")
     
     try:
-        clear_chat_history(req.userId)
+        await run_db(clear_chat_history, req.userId)
+        retention_worker.wake()
         print(f"🗑️ 已清除用户 {req.userId} 的对话历史")
         return {"success": True, "message": "对话历史已清除"}
     except Exception as e:
@@ -368,7 +539,128 @@ async def clear_history_endpoint(req: ClearHistoryRequest):
         return {"success": False, "message": f"清除失败: {str(e)}"}
 
 
+# === 恢复对话：分页读取历史 ===
+def cached_json(request, payload):
+    """紧凑 JSON + ETag（If-None-Match 命中时回 304）+ 按需 gzip"""
+    body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    etag = '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+    # 浏览器每次都带 If-None-Match 回来验证，清空历史后旧页不会被继续使用
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache", "Vary": "Accept-Encoding"}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    if len(body) >= GZIP_MIN_BYTES and "gzip" in request.headers.get("accept-encoding", ""):
+        body = gzip.compress(body, 6)
+        headers["Content-Encoding"] = "gzip"
+    return Response(body, media_type="application/json", headers=headers)
+
+
+@app.get("/api/history")
+async def history_endpoint(userId: str, request: Request, conv: str = None, before: int = None,
+                           limit: int = HISTORY_PAGE_SIZE):
+    """返回 {"messages": [[id, role, content], ...] 从旧到新, "next": 下一页的 before，null 表示到头}
+
+    conv 不传时读当前对话。热表到头后接着读归档；最新一页包含刚说完、还没落盘的消息（id 为 null）。
+    """
+    user = await run_db(get_user, userId)
+    if not user: raise HTTPException(401, "User not found")
+    limit = max(1, min(limit, HISTORY_PAGE_MAX))
+    with timed("history_page"):
+        messages, next_before = await run_db(read_history_page, userId, conv or user[3], before, limit)
+    return cached_json(request, {
+        "messages": [[m["id"], m["role"], m["content"]] for m in messages],
+        "next": next_before,
+    })
+
+
+# === 多对话：列出 / 新建 / 切换 ===
+@app.get("/api/conversations")
+async def conversations_endpoint(userId: str):
+    user = await run_db(get_user, userId)
+    if not user: raise HTTPException(401, "User not found")
+    return {"current": user[3], "conversations": await run_db(list_conversations, userId)}
+
+
+@app.post("/api/conversations")
+async def new_conversation_endpoint(req: NewConversationRequest):
+    user = await run_db(get_user, req.userId)
+    if not user: raise HTTPException(401, "User not found")
+    conv_id = await run_db(create_conversation, req.userId, req.title)
+    print(f"🆕 {req.userId} 新建对话 {conv_id}")
+    return {"success": True, "conv_id": conv_id}
+
+
+@app.post("/api/conversations/switch")
+async def switch_conversation_endpoint(req: SwitchConversationRequest):
+    user = await run_db(get_user, req.userId)
+    if not user: raise HTTPException(401, "User not found")
+    if not await run_db(switch_conversation, req.userId, req.convId):
+        return {"success": False, "message": "对话不存在"}
+    return {"success": True, "conv_id": req.convId}
+
+
+# === 运行状态 ===
+@app.get("/api/stats")
+async def stats_endpoint():
+    return {"user_cache": user_cache.stats(), "memos": memory.snapshot(), "answer_cache": answer_cache.stats(),
+            "admission": admission.stats(), "llm": llm.snapshot(), "local_recall": local_index.snapshot(),
+            "memory_context": memory_compressor.stats(), "static": static_assets.snapshot(),
+            "retention": {**retention_worker.snapshot(), **await run_db(retention_stats)}}
+
+
+# === Prometheus 指标：各阶段耗时直方图 + 运行状态 ===
+@app.get("/metrics")
+async def metrics_endpoint():
+    adm = admission.stats()
+    llm_snap = llm.snapshot()
+    gauges = {
+        "newton_admission_active": adm["active"],
+        "newton_admission_queued": adm["queued"],
+        "newton_llm_inflight": [({"endpoint": e["name"]}, e["inflight"]) for e in llm_snap["endpoints"]],
+        "newton_user_cache_hit_rate": user_cache.stats()["hit_rate"],
+        "newton_memos_busy": memory.snapshot()["busy"],
+    }
+    counters = {
+        "newton_admission_rejected_total": adm["rejected"],
+        "newton_llm_errors_total": [({"endpoint": e["name"]}, e["errors"]) for e in llm_snap["endpoints"]],
+    }
+    return PlainTextResponse(metrics.render(gauges, counters), media_type="text/plain; version=0.0.4")
+
+
+# === MemOS 发件箱状态（排队中 / 失败的记忆写入） ===
+@app.get("/api/outbox")
+async def outbox_endpoint():
+    status = await run_db(outbox_status)
+    status["worker"] = {"sent": outbox_worker.sent, "failed": outbox_worker.failed,
+                        "skipped": outbox_worker.skipped}
+    return status
+
+
+@app.post("/api/outbox/retry")
+async def outbox_retry_endpoint():
+    """排障后把 failed 记录放回队列；failed 的队头会挡住该用户后面的所有记录"""
+    retried = await run_db(retry_failed)
+    outbox_worker.wake()
+    return {"success": True, "retried": retried}
+
+
+# === 前端页面：本地托管（预压缩 + 带哈希的文件名永久缓存），不再依赖外部 CDN ===
+@app.get("/")
+async def index_page(request: Request):
+    return static_assets.response(request, "index.html")
+
+
+@app.get("/static/{name}")
+async def static_file(name: str, request: Request):
+    response = static_assets.response(request, name)
+    if response is None: raise HTTPException(404, "Not found")
+    return response
+
+
 if __name__ == "__main__":
+    # 迁移只在父进程里跑一次；worker 进程各自重新 import 本模块，客户端和连接池都在子进程里创建
     init_db()
-    print("🚀 Newton Server (OpenAI SDK Mode) starting...")
-    uvicorn.run(app, host="0.0.0.0", port=5050)
+    print(f"🚀 Newton Server (OpenAI SDK Mode) starting with {WORKERS} worker(s)...")
+    if WORKERS > 1:
+        uvicorn.run("server:app", host="0.0.0.0", port=5050, workers=WORKERS)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=5050)
@@ -0,0 +1,121 @@
+"""前端页面和静态资源的托管（server.py 的 / 和 /static/<文件名>）
+
+build_static.py 构建好的 static/dist 在启动时整个读进内存（连同 .gz / .br 预压缩版本），
+请求时按 Accept-Encoding 直接返回对应的字节，不在请求路径上压缩或读盘。
+带内容哈希的文件名永久缓存（immutable）；index.html 每次用 ETag 验证，没变就回 304。
+没有构建过时退回开发模式：直接托管源码里的 index.html（第三方库仍走 CDN）。
+"""
+import os
+import gzip
+import json
+import hashlib
+import mimetypes
+
+from fastapi.responses import Response
+
+# ================= 配置区 =================
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SOURCE_HTML = os.path.join(BASE_DIR, "index.html")
+# 压测时可以用环境变量指向另一份构建产物
+DIST_DIR = os.environ.get("NEWTON_STATIC_DIST", os.path.join(BASE_DIR, "static", "dist"))
+STATIC_PREFIX = "/static/"
+# index.html 直接引用的本地文件（开发模式下原样托管，构建时加上内容哈希）
+LOCAL_FILES = ("newton.jpg",)
+# 值得压缩的类型；字体（woff2）和图片本身已经压缩过
+COMPRESSIBLE = (".html", ".css", ".js", ".json", ".svg", ".txt")
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+mimetypes.add_type("font/woff2", ".woff2")
+mimetypes.add_type("text/javascript", ".js")
+
+
+class _Asset:
+    __slots__ = ("variants", "etag", "media_type", "cache_control")
+
+    def __init__(self, body, media_type, cache_control, gz=None, br=None):
+        digest = hashlib.sha1(body).hexdigest()[:16]
+        # 同一内容的不同编码是不同的表示，ETag 也要区分
+        self.variants = {"identity": (body, f'"{digest}"')}
+        if gz is not None:
+            self.variants["gzip"] = (gz, f'"{digest}-gz"')
+        if br is not None:
+            self.variants["br"] = (br, f'"{digest}-br"')
+        self.etag = digest
+        self.media_type = media_type
+        self.cache_control = cache_control
+
+
+def _read(path):
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+class StaticAssets:
+    def __init__(self, dist_dir=DIST_DIR):
+        self.dist_dir = dist_dir
+        self.built = False
+        self._assets = {}
+        self.served = 0
+        self.not_modified = 0
+
+    def load(self):
+        """读入 static/dist（按 manifest.json），没有构建产物时退回开发模式"""
+        manifest = _read(os.path.join(self.dist_dir, "manifest.json"))
+        assets = {}
+        if manifest is not None:
+            for name in json.loads(manifest)["files"]:
+                path = os.path.join(self.dist_dir, name)
+                assets[name] = _Asset(
+                    _read(path), self._media_type(name),
+                    REVALIDATE if name == "index.html" else IMMUTABLE,
+                    gz=_read(path + ".gz"), br=_read(path + ".br"))
+            self.built = True
+        else:
+            html = _read(SOURCE_HTML)
+            for name in LOCAL_FILES:
+                html = html.replace(name.encode(), (STATIC_PREFIX + name).encode())
+                assets[name] = _Asset(_read(os.path.join(BASE_DIR, name)), self._media_type(name), REVALIDATE)
+            assets["index.html"] = _Asset(html, "text/html; charset=utf-8", REVALIDATE, gz=gzip.compress(html, 6))
+            self.built = False
+            print("ℹ️ 未找到 static/dist，托管源码里的 index.html（第三方库走 CDN）；"
+                  "运行 python build_static.py 生成离线可用的版本")
+        self._assets = assets
+        return len(assets)
+
+    @staticmethod
+    def _media_type(name):
+        if name.endswith(".html"):
+            return "text/html; charset=utf-8"
+        media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        if media_type.startswith("text/"):
+            media_type += "; charset=utf-8"
+        return media_type
+
+    def response(self, request, name):
+        """返回 name 对应的响应；不存在时返回 None"""
+        asset = self._assets.get(name)
+        if asset is None:
+            return None
+        accept = request.headers.get("accept-encoding", "")
+        encoding = "identity"
+        if "br" in accept and "br" in asset.variants:
+            encoding = "br"
+        elif "gzip" in accept and "gzip" in asset.variants:
+            encoding = "gzip"
+        body, etag = asset.variants[encoding]
+        headers = {"ETag": etag, "Cache-Control": asset.cache_control, "Vary": "Accept-Encoding"}
+        if asset.etag in request.headers.get("if-none-match", ""):
+            self.not_modified += 1
+            return Response(status_code=304, headers=headers)
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        self.served += 1
+        return Response(body, media_type=asset.media_type, headers=headers)
+
+    def snapshot(self):
+        return {"built": self.built, "files": len(self._assets), "served": self.served,
+                "not_modified": self.not_modified}
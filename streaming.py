@@ -0,0 +1,110 @@
+import json
+import asyncio
+
+# ================= 配置区 =================
+COALESCE_WINDOW = 0.05    # 合并窗口（秒）：窗口内到达的增量合成一帧
+COALESCE_MAX_CHARS = 96   # 攒够这么多字符不等窗口结束，立即发出
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+def wants_ndjson(request):
+    """客户端通过 Accept 头（或 ?stream=ndjson）选择分帧协议，否则保持原来的纯文本流"""
+    if request.query_params.get("stream") == "ndjson":
+        return True
+    return NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+def frame(obj):
+    return json.dumps(obj, ensure_ascii=False) + "\n"
+
+
+async def coalesce(source, window=COALESCE_WINDOW, max_chars=COALESCE_MAX_CHARS):
+    """把逐 token 的增量合并成较大的块：第一段到达后最多等 window 秒，或攒够 max_chars 就发出
+
+    上游卡住时也会按时把已攒的部分发出去（用带超时的 wait，而不是等下一个 token）。
+    """
+    loop = asyncio.get_running_loop()
+    it = source.__aiter__()
+    buf = ""
+    deadline = None
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(it.__anext__())
+            timeout = max(0.0, deadline - loop.time()) if buf else None
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+            if not done:
+                yield buf
+                buf = ""
+                continue
+            task, pending = pending, None
+            try:
+                piece = task.result()
+            except StopAsyncIteration:
+                break
+            if not buf:
+                deadline = loop.time() + window
+            buf += piece
+            if len(buf) >= max_chars:
+                yield buf
+                buf = ""
+        if buf:
+            yield buf
+    finally:
+        # 消费方提前关掉（客户端断开）时也要关闭上游，否则它的 finally（释放 LLM 连接等）要等垃圾回收才执行；
+        # 还在跑的 __anext__ 先取消并等它结束，不然 aclose 会报 "already running"
+        if pending is not None:
+            pending.cancel()
+            await asyncio.wait({pending})
+            if not pending.cancelled():
+                pending.exception()
+        aclose = getattr(source, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+
+class BlockTracker:
+    """跟踪已输出文本中“稳定”的前缀长度
+
+    稳定边界 = 不在 $$ 公式块、``` 代码块内的空行（段落结束），或闭合后紧跟换行的 $$ 块之后。
+    边界之前的内容以后不会再变，前端只需渲染一次，之后只重绘边界之后的尾巴。
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.stable = 0
+        self._scanned = 0
+        self._in_math = False
+        self._in_code = False
+        self._math_closed_at = -1
+
+    def feed(self, piece):
+        self.text += piece
+        text = self.text
+        # 只扫描新到的部分；结尾处可能被切断的 "$$"/"\n\n"/"```" 留到下一块再判断
+        i = self._scanned
+        end = len(text)
+        while i < end:
+            if text.startswith("```", i) and (i == 0 or text[i - 1] == "\n"):
+                self._in_code = not self._in_code
+                i += 3
+                continue
+            if not self._in_code and text.startswith("$$", i):
+                self._in_math = not self._in_math
+                i += 2
+                if not self._in_math:
+                    self._math_closed_at = i
+                continue
+            if text[i] == "\n" and i == self._math_closed_at:
+                # 公式块闭合后紧跟换行，才算块结束（"$$...$$后文" 仍属于同一段）
+                self.stable = i + 1
+            if not self._in_code and not self._in_math and text.startswith("\n\n", i):
+                self.stable = i + 2
+                i += 2
+                continue
+            if text[i] in "`$\n" and end - i < 3:
+                break
+            i += 1
+        self._scanned = i
+        return self.stable
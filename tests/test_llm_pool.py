@@ -0,0 +1,186 @@
+"""llm_pool.LLMPool 的故障切换 / 对冲 / 全部不可用，上游是 bench/fake_openai.py 起的本地假服务
+
+    python -m pytest -q tests
+"""
+import os
+import sys
+import time
+import socket
+import asyncio
+import subprocess
+
+import httpx
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_DIR = os.path.join(ROOT_DIR, "bench")
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import llm_pool
+from llm_pool import LLMPool, LLMUnavailable
+from fake_openai import ANSWER
+
+MESSAGES = [{"role": "user", "content": "何为流数？"}]
+
+
+def free_port():
+    """拿一个当前没人监听的端口（关掉之后连接它就是 connection refused）"""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class FakeUpstream:
+    def __init__(self, **options):
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        args = [sys.executable, os.path.join(BENCH_DIR, "fake_openai.py"), "--port", str(self.port),
+                "--jitter", "0", "--token-delay", "0"]
+        for key, value in options.items():
+            args += [f"--{key.replace('_', '-')}", str(value)]
+        self.proc = subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.time() + 20
+        while True:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f"fake_openai 启动失败: {args}")
+            try:
+                httpx.get(f"{self.url}/stats", timeout=0.5)
+                return
+            except httpx.HTTPError:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.1)
+
+    def endpoint(self, name):
+        return {"name": name, "base_url": f"{self.url}/v1", "api_key": "test", "model": "fake"}
+
+    def stats(self):
+        return httpx.get(f"{self.url}/stats").json()
+
+    def stop(self):
+        self.proc.terminate()
+        self.proc.wait(10)
+
+
+def refused(name):
+    return {"name": name, "base_url": f"http://127.0.0.1:{free_port()}/v1", "api_key": "test", "model": "fake"}
+
+
+@pytest.fixture(scope="module")
+def fast():
+    upstream = FakeUpstream(ttft=0.05)
+    yield upstream
+    upstream.stop()
+
+
+@pytest.fixture(scope="module")
+def slow():
+    upstream = FakeUpstream(ttft=5.0)
+    yield upstream
+    upstream.stop()
+
+
+@pytest.fixture(scope="module")
+def broken():
+    upstream = FakeUpstream(ttft=0.0, error_rate=1.0, error_status=503)
+    yield upstream
+    upstream.stop()
+
+
+async def collect(pool):
+    """跑一次流式对话，返回拼好的文本"""
+    text = ""
+    try:
+        async for chunk in pool.stream_chat(MESSAGES):
+            if chunk.choices and chunk.choices[0].delta.content:
+                text += chunk.choices[0].delta.content
+    finally:
+        await pool.close()
+    return text
+
+
+# ================= 故障切换 =================
+def test_failover_on_5xx(fast, broken):
+    pool = LLMPool([broken.endpoint("broken"), fast.endpoint("fast")])
+    # 初始分数相同，按配置顺序先试 broken
+    assert asyncio.run(collect(pool)) == ANSWER
+    assert pool.failovers == 1
+    first, second = pool.endpoints
+    assert (first.errors, first.inflight) == (1, 0)
+    assert (second.requests, second.errors, second.inflight) == (1, 0, 0)
+
+
+def test_failover_on_connection_refused(fast):
+    pool = LLMPool([refused("down"), fast.endpoint("fast")])
+    assert asyncio.run(collect(pool)) == ANSWER
+    assert pool.failovers == 1
+    assert pool.endpoints[0].errors == 1
+
+
+def test_complete_fails_over(fast, broken):
+    async def run():
+        try:
+            return await pool.complete(MESSAGES)
+        finally:
+            await pool.close()
+
+    pool = LLMPool([broken.endpoint("broken"), fast.endpoint("fast")])
+    completion = asyncio.run(run())
+    assert completion.choices[0].message.content == ANSWER
+    assert pool.failovers == 1
+
+
+# ================= 对冲 =================
+def test_hedge_returns_faster_stream_and_cancels_loser(fast, slow, monkeypatch):
+    # 没有首字样本时按 HEDGE_MAX_DELAY 等待，调小让测试不用等 3 秒
+    monkeypatch.setattr(llm_pool, "HEDGE_MAX_DELAY", 0.2)
+    cancelled_before = slow.stats()["cancelled"]
+    pool = LLMPool([slow.endpoint("slow"), fast.endpoint("fast")], hedge=True)
+
+    t0 = time.monotonic()
+    assert asyncio.run(collect(pool)) == ANSWER
+    assert time.monotonic() - t0 < 2.0  # 没有等慢上游的 5 秒首字
+    assert (pool.hedges, pool.hedge_wins) == (1, 1)
+    loser, winner = pool.endpoints
+    assert loser.inflight == 0 and winner.inflight == 0
+    assert loser.errors == 0  # 被取消的一方不算失败，不会把它熔断
+
+    # 连接关掉之后假上游那边的生成器会被取消
+    deadline = time.time() + 5
+    while slow.stats()["cancelled"] == cancelled_before:
+        assert time.time() < deadline, "输掉的对冲请求没有被取消"
+        time.sleep(0.05)
+
+
+# ================= 全部不可用 =================
+def test_stream_raises_when_all_endpoints_down(broken):
+    pool = LLMPool([refused("down"), broken.endpoint("broken")])
+    with pytest.raises(LLMUnavailable) as info:
+        asyncio.run(collect(pool))
+    assert info.value.__cause__ is not None
+    assert all(e.inflight == 0 for e in pool.endpoints)
+
+
+def test_complete_raises_when_all_endpoints_down(broken):
+    async def run():
+        try:
+            return await pool.complete(MESSAGES)
+        finally:
+            await pool.close()
+
+    pool = LLMPool([refused("down"), broken.endpoint("broken")])
+    with pytest.raises(LLMUnavailable):
+        asyncio.run(run())
+    assert all(e.inflight == 0 for e in pool.endpoints)
+
+
+def test_raises_without_trying_when_all_breakers_open(broken):
+    pool = LLMPool([refused("down"), broken.endpoint("broken")])
+    for endpoint in pool.endpoints:
+        for _ in range(llm_pool.ENDPOINT_FAILURES):
+            endpoint.breaker.record(False)
+    requests_before = broken.stats()["requests"]
+    with pytest.raises(LLMUnavailable, match="no healthy"):
+        asyncio.run(collect(pool))
+    assert broken.stats()["requests"] == requests_before
@@ -14,25 +14,21 @@ if not exist "env\Scripts\python.exe" (
     exit
 )
 
-:: 2. 启动后端 (API 服务 - 端口 5050)
-echo [1/2] 正在启动后端核心 (Port 5050)...
+:: 2. 启动后端 (API + 网页托管 - 端口 5050)
+:: 网页和 static 资源也由 server.py 直接提供，不再需要 http.server
+:: 先运行 python build_static.py 生成 static\dist，离线也能打开页面
+echo [1/1] 正在启动后端核心 (Port 5050)...
 start "Newton_Backend_API" /min ".\env\Scripts\python.exe" server.py
 
-:: 3. 启动前端 (Web 服务 - 端口 8000)
-:: 这就是你想要的那行指令！它把当前文件夹变成一个网站
-echo [2/2] 正在启动网页托管 (Port 8000)...
-start "Newton_Web_Host" /min ".\env\Scripts\python.exe" -m http.server 8000
-
-:: 4. 提示访问地址
+:: 3. 提示访问地址
 echo.
 echo ==========================================
 echo      ✅ 服务已全部上线！
 echo ==========================================
 echo.
-echo 本机访问: http://localhost:8000
+echo 本机访问: http://localhost:5050
 echo.
-echo 局域网其他设备访问: http://10.21.156.83:8000
-echo (确保你已经在 index.html 里改好了 apiBase IP)
+echo 局域网其他设备访问: http://10.21.156.83:5050
 echo.
 echo ==========================================
 pause
\ No newline at end of file
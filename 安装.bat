@@ -13,4 +13,8 @@ call env\Scripts\activate
 python -m pip install --upgrade pip
 :: 4. 安装所有依赖 (已加入 MemoryOS)
 pip install fastapi uvicorn google-generativeai pydantic requests MemoryOS
-pip install streamlit pandas
\ No newline at end of file
+pip install streamlit pandas
+:: 5. 预压缩静态资源用 brotli（可选，没有它只生成 .gz）
+pip install brotli
+:: 6. 下载前端第三方库并构建 static\dist（需要联网，只需执行一次）
+python build_static.py
\ No newline at end of file